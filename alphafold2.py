@@ -1,6 +1,7 @@
 import os
 import pathlib
 import signal
+import threading
 import time
 import sys
 import getopt
@@ -11,6 +12,15 @@ from absl import logging
 import docker
 from docker import types
 
+import alphafold_progress
+import cost_model
+import db_staging
+import instrument
+import msa_store
+import structure_cache
+import supervise
+from fasta_utils import fasta_target_name, sequence_length
+
 
 
 _ROOT_MOUNT_DIRECTORY = '/mnt/'
@@ -34,28 +44,8 @@ def _create_mount(mount_name: str, path: str) -> Tuple[types.Mount, str]:
                       type='bind', read_only=True)
   return mount, str(mounted_path)
 
-def docker_service(fasta_paths,
-                   alphafold_path='/home/xyzhang/alphafold-main/',
-                   use_gpu=True,
-                   run_relax=True,
-                   enable_gpu_relax=True,
-                   gpu_devices='all',
-                   output_dir='/tmp/alphafold',
-                   data_dir='/mnt/nfs02/57t02/af2/download/',
-                   docker_image_name='alphafold',
-                   max_template_date='2020-05-14',
-                   db_preset='full_dbs',
-                   model_preset='monomer',
-                   num_multimer_predictions_per_model=5,
-                   benchmark=False,
-                   use_precomputed_msas=False,
-                   docker_user=f'{os.geteuid()}:{os.getegid()}'):
-    assert model_preset in ['monomer', 'monomer_casp14', 'monomer_ptm', 'multimer'], print(
-        'model preset is not in available values')
-    assert db_preset in ['full_dbs', 'reduced_dbs'], print(
-        'db_preset is not in available values')
-
-
+def _database_paths(data_dir, db_preset, model_preset):
+    """Return the (flag name, path) pairs of the databases a preset needs."""
     # You can individually override the following paths if you have placed the
     # data in locations other than the FLAGS.data_dir.
 
@@ -97,24 +87,6 @@ def docker_service(fasta_paths,
     # Path to a file mapping obsolete PDB IDs to their replacements.
     obsolete_pdbs_path = os.path.join(data_dir, 'pdb_mmcif', 'obsolete.dat')
 
-    data_dir_path = pathlib.Path(data_dir)
-    if alphafold_path == data_dir_path or alphafold_path in data_dir_path.parents:
-        raise app.UsageError(
-            f'The download directory {data_dir} should not be a subdirectory '
-            f'in the AlphaFold repository directory. If it is, the Docker build is '
-            f'slow since the large databases are copied during the image creation.')
-
-    mounts = []
-    command_args = []
-
-    # Mount each fasta path as a unique target directory.
-    target_fasta_paths = []
-    for i, fasta_path in enumerate(fasta_paths):
-        mount, target_path = _create_mount(f'fasta_path_{i}', fasta_path)
-        mounts.append(mount)
-        target_fasta_paths.append(target_path)
-    command_args.append(f'--fasta_paths={",".join(target_fasta_paths)}')
-
     database_paths = [
         ('uniref90_database_path', uniref90_database_path),
         ('mgnify_database_path', mgnify_database_path),
@@ -137,6 +109,100 @@ def docker_service(fasta_paths,
             ('uniclust30_database_path', uniclust30_database_path),
             ('bfd_database_path', bfd_database_path),
         ])
+    return database_paths
+
+@instrument.instrumented('alphafold')
+def docker_service(fasta_paths,
+                   alphafold_path='/home/xyzhang/alphafold-main/',
+                   use_gpu=True,
+                   run_relax=True,
+                   enable_gpu_relax=True,
+                   gpu_devices='all',
+                   output_dir='/tmp/alphafold',
+                   data_dir='/mnt/nfs02/57t02/af2/download/',
+                   docker_image_name='alphafold',
+                   max_template_date='2020-05-14',
+                   db_preset='full_dbs',
+                   model_preset='monomer',
+                   num_multimer_predictions_per_model=5,
+                   benchmark=False,
+                   use_precomputed_msas=False,
+                   docker_user=f'{os.geteuid()}:{os.getegid()}',
+                   structure_cache_dir=None,
+                   structure_cache_max_bytes=structure_cache.DEFAULT_MAX_BYTES,
+                   msa_store_dir=None,
+                   on_event=None,
+                   on_container=None,
+                   environment=None,
+                   labels=None,
+                   runs_file=cost_model.DEFAULT_RUNS_FILE,
+                   db_scratch_dir=None,
+                   db_scratch_max_bytes=None,
+                   max_substitutions=0):
+    assert model_preset in ['monomer', 'monomer_casp14', 'monomer_ptm', 'multimer'], print(
+        'model preset is not in available values')
+    assert db_preset in ['full_dbs', 'reduced_dbs'], print(
+        'db_preset is not in available values')
+
+    data_dir_path = pathlib.Path(data_dir)
+    if alphafold_path == data_dir_path or alphafold_path in data_dir_path.parents:
+        raise app.UsageError(
+            f'The download directory {data_dir} should not be a subdirectory '
+            f'in the AlphaFold repository directory. If it is, the Docker build is '
+            f'slow since the large databases are copied during the image creation.')
+
+    # Serve already folded sequences from the structure cache and only launch
+    # the container for the remaining ones.
+    cache_keys = {}
+    if structure_cache_dir:
+        pending_fasta_paths = []
+        for fasta_path in fasta_paths:
+            key = structure_cache.cache_key(
+                fasta_path, model_preset, db_preset, max_template_date,
+                run_relax, num_multimer_predictions_per_model)
+            target_dir = os.path.join(output_dir, fasta_target_name(fasta_path))
+            if not structure_cache.lookup(structure_cache_dir, key, target_dir):
+                cache_keys[fasta_path] = key
+                pending_fasta_paths.append(fasta_path)
+        if not pending_fasta_paths:
+            return supervise.StageResult('alphafold', 0, 0.0, 'structure cache hit')
+        fasta_paths = pending_fasta_paths
+
+    # Stage MSAs that were already searched for these sequences. AlphaFold only
+    # reuses an MSA file when it exists and runs the search for missing ones, so
+    # a single hit is enough to turn use_precomputed_msas on.
+    msa_keys = {}
+    if msa_store_dir:
+        for fasta_path in fasta_paths:
+            key = msa_store.msa_key(fasta_path, db_preset, model_preset)
+            target_dir = os.path.join(output_dir, fasta_target_name(fasta_path))
+            if msa_store.stage_msas(msa_store_dir, key, target_dir):
+                use_precomputed_msas = True
+            elif model_preset != 'multimer' and msa_store.derive_msas(
+                    msa_store_dir, fasta_path, target_dir, db_preset, max_substitutions):
+                # Point mutant of a searched sequence. The derived MSAs are not
+                # harvested, so mutants are always derived from a real search.
+                use_precomputed_msas = True
+            else:
+                msa_keys[fasta_path] = key
+
+    mounts = []
+    command_args = []
+
+    # Mount each fasta path as a unique target directory.
+    target_fasta_paths = []
+    for i, fasta_path in enumerate(fasta_paths):
+        mount, target_path = _create_mount(f'fasta_path_{i}', fasta_path)
+        mounts.append(mount)
+        target_fasta_paths.append(target_path)
+    command_args.append(f'--fasta_paths={",".join(target_fasta_paths)}')
+
+    database_paths = _database_paths(data_dir, db_preset, model_preset)
+    # Mount local copies of the search databases instead of streaming them over NFS.
+    release_databases = lambda: None
+    if db_scratch_dir:
+        database_paths, release_databases = db_staging.acquire(
+            db_scratch_dir, database_paths, max_bytes=db_scratch_max_bytes)
     for name, path in database_paths:
         if path:
             mount, target_path = _create_mount(name, path)
@@ -166,29 +232,77 @@ def docker_service(fasta_paths,
         docker.types.DeviceRequest(driver='nvidia', capabilities=[['gpu']])
     ] if use_gpu else None
 
-    container = client.containers.run(
-        image=docker_image_name,
-        command=command_args,
-        device_requests=device_requests,
-        remove=True,
-        detach=True,
-        mounts=mounts,
-        user=docker_user,
-        environment={
-            'NVIDIA_VISIBLE_DEVICES': gpu_devices,
-            # The following flags allow us to make predictions on proteins that
-            # would typically be too long to fit into GPU memory.
-            'TF_FORCE_UNIFIED_MEMORY': '1',
-            'XLA_PYTHON_CLIENT_MEM_FRACTION': '4.0',
-        })
-
-    # Add signal handler to ensure CTRL+C also stops the running container.
-    signal.signal(signal.SIGINT,
-                  lambda unused_sig, unused_frame: container.kill())
-
-    for line in container.logs(stream=True):
-        logging.info(line.strip().decode('utf-8'))
-
+    container_environment = {
+        'NVIDIA_VISIBLE_DEVICES': gpu_devices,
+        # The following flags allow us to make predictions on proteins that
+        # would typically be too long to fit into GPU memory.
+        'TF_FORCE_UNIFIED_MEMORY': '1',
+        'XLA_PYTHON_CLIENT_MEM_FRACTION': '4.0',
+        # Allocate on demand, so the sampled GPU memory is what the model uses
+        # rather than the preallocated fraction.
+        'XLA_PYTHON_CLIENT_PREALLOCATE': 'false',
+    }
+    # Per job memory settings, see cost_model.memory_environment().
+    container_environment.update(environment or {})
+
+    try:
+        container = client.containers.run(
+            image=docker_image_name,
+            command=command_args,
+            device_requests=device_requests,
+            remove=False,
+            detach=True,
+            mounts=mounts,
+            user=docker_user,
+            environment=container_environment,
+            labels=labels)
+
+        if on_container is not None:
+            on_container(container)
+        stop_memory_sampling = cost_model.sample_peak_memory(
+            container, measure_device=container_environment['XLA_PYTHON_CLIENT_PREALLOCATE'] == 'false')
+
+        # Add signal handler to ensure CTRL+C also stops the running container.
+        # Signal handlers can only be installed from the main thread, pipeline
+        # stages running in worker threads rely on their caller instead.
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT,
+                          lambda unused_sig, unused_frame: container.kill())
+
+        # Container log lines are parsed into progress events, see alphafold_progress.
+        total_models = alphafold_progress.num_models(model_preset, num_multimer_predictions_per_model)
+        result = supervise.wait_container(
+            'alphafold', container, check=False,
+            on_line=alphafold_progress.line_handler(output_dir, total_models, on_event))
+        peak_memory, peak_device_memory = stop_memory_sampling()
+    finally:
+        release_databases()
+
+    # A run killed during the search leaves truncated MSAs, which would be served to every
+    # later hit and derived mutant, so only a successful run is harvested.
+    for fasta_path, key in (msa_keys.items() if result.returncode == 0 else ()):
+        msa_store.harvest_msas(msa_store_dir, key,
+                               os.path.join(output_dir, fasta_target_name(fasta_path)),
+                               fasta_path, db_preset, model_preset)
+
+    for fasta_path, key in cache_keys.items():
+        structure_cache.store(structure_cache_dir, key,
+                              os.path.join(output_dir, fasta_target_name(fasta_path)),
+                              max_bytes=structure_cache_max_bytes)
+
+    for fasta_path in fasta_paths:
+        summary = alphafold_progress.summarize(output_dir, fasta_target_name(fasta_path))
+        ranked_0 = os.path.join(output_dir, fasta_target_name(fasta_path), 'ranked_0.pdb')
+        if runs_file and os.path.exists(ranked_0):
+            # Every finished prediction refines the cost model used to schedule the next ones.
+            cost_model.record_run(runs_file, sequence_length(fasta_path), db_preset, model_preset,
+                                  *cost_model.run_costs(summary), peak_memory=peak_memory,
+                                  precomputed_msas=use_precomputed_msas,
+                                  device_memory=peak_device_memory)
+        supervise.check_result(result, ranked_0)
+    return result
+
+@instrument.instrumented('html')
 def generate_html(outdir,
                   html_name,
                   job_id=0,
@@ -227,12 +341,22 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('fasta_paths', type=str, help='the fasta_paths file, absolute path without file extension, e.g. /tmp/alphafold/Y265H.fasta')
     parser.add_argument('output_dir', type=str, help='the output_dir file, absolute path without file extension, e.g. /tmp/alphafold')
+    parser.add_argument('--structure_cache_dir', type=str, default=None, help='directory of the persistent structure cache, e.g. /tmp/alphafold_cache')
+    parser.add_argument('--msa_store_dir', type=str, default=None, help='directory of the shared MSA store, e.g. /tmp/alphafold_msas')
+    parser.add_argument('--db_scratch_dir', type=str, default=None, help='local disk directory to stage the search databases on, e.g. /scratch/af2_databases')
+    parser.add_argument('--max_substitutions', type=int, default=0, help='derive the MSAs of point mutants with up to this many substitutions from a parent in --msa_store_dir')
+    parser.add_argument('--trace_file', type=str, default=None, help='append a JSON line with the wall/CPU time, memory and I/O of every stage, e.g. /tmp/alphafold/trace.jsonl')
+    parser.add_argument('--metrics_file', type=str, default=None, help='write the stage totals of trace_file in Prometheus text format, e.g. /tmp/alphafold/metrics.prom')
     args = parser.parse_args()
-    docker_service(fasta_paths=[args.fasta_paths], output_dir=args.output_dir)
+    instrument.configure(args.trace_file)
+    docker_service(fasta_paths=[args.fasta_paths], output_dir=args.output_dir,
+                   structure_cache_dir=args.structure_cache_dir,
+                   msa_store_dir=args.msa_store_dir,
+                   db_scratch_dir=args.db_scratch_dir,
+                   max_substitutions=args.max_substitutions)
     _, receptor_name = os.path.split(args.fasta_paths)
-    file_name = os.path.join(args.output_dir, receptor_name, 'ranked_0.pdb')  # f'/tmp/alphafold/{receptor}/ranked_0.pdb'
-    while not os.path.exists(file_name):  # 判断文件是否存在
-        time.sleep(0.5)
     print('alphaflod finish!')
     generate_html(outdir=args.output_dir,
                   html_name=f'{receptor_name}_alphafold.html')
+    if args.trace_file and args.metrics_file:
+        instrument.write_prometheus(args.trace_file, args.metrics_file)
@@ -1,9 +1,11 @@
 import os
 import pathlib
 import signal
+import threading
 import time
 import sys
 import getopt
+import functools
 from typing import Tuple
 
 from absl import app
@@ -12,6 +14,21 @@ import docker
 from docker import types
 import webbrowser
 
+import alphafold_progress
+import checkpoint
+import cost_model
+import db_staging
+import docking_cache
+import ensemble_docking
+import instrument
+import msa_store
+import pipeline_graph
+import pocket_finder
+import receptor_prep
+import structure_cache
+import supervise
+from fasta_utils import fasta_target_name, sequence_length
+
 
 _ROOT_MOUNT_DIRECTORY = '/mnt/'
 
@@ -34,6 +51,7 @@ def _create_mount(mount_name: str, path: str) -> Tuple[types.Mount, str]:
                       type='bind', read_only=True)
   return mount, str(mounted_path)
 
+@instrument.instrumented('alphafold')
 def docker_service(fasta_paths,
                    alphafold_path='/home/xyzhang/alphafold-main/',
                    use_gpu=True,
@@ -49,7 +67,18 @@ def docker_service(fasta_paths,
                    num_multimer_predictions_per_model=5,
                    benchmark=False,
                    use_precomputed_msas=False,
-                   docker_user=f'{os.geteuid()}:{os.getegid()}'):
+                   docker_user=f'{os.geteuid()}:{os.getegid()}',
+                   structure_cache_dir=None,
+                   structure_cache_max_bytes=structure_cache.DEFAULT_MAX_BYTES,
+                   msa_store_dir=None,
+                   on_event=None,
+                   on_container=None,
+                   environment=None,
+                   labels=None,
+                   runs_file=cost_model.DEFAULT_RUNS_FILE,
+                   db_scratch_dir=None,
+                   db_scratch_max_bytes=None,
+                   max_substitutions=0):
     assert model_preset in ['monomer', 'monomer_casp14', 'monomer_ptm', 'multimer'], print(
         'model preset is not in available values')
     assert db_preset in ['full_dbs', 'reduced_dbs'], print(
@@ -104,6 +133,41 @@ def docker_service(fasta_paths,
             f'in the AlphaFold repository directory. If it is, the Docker build is '
             f'slow since the large databases are copied during the image creation.')
 
+    # Serve already folded sequences from the structure cache and only launch
+    # the container for the remaining ones.
+    cache_keys = {}
+    if structure_cache_dir:
+        pending_fasta_paths = []
+        for fasta_path in fasta_paths:
+            key = structure_cache.cache_key(
+                fasta_path, model_preset, db_preset, max_template_date,
+                run_relax, num_multimer_predictions_per_model)
+            target_dir = os.path.join(output_dir, fasta_target_name(fasta_path))
+            if not structure_cache.lookup(structure_cache_dir, key, target_dir):
+                cache_keys[fasta_path] = key
+                pending_fasta_paths.append(fasta_path)
+        if not pending_fasta_paths:
+            return supervise.StageResult('alphafold', 0, 0.0, 'structure cache hit')
+        fasta_paths = pending_fasta_paths
+
+    # Stage MSAs that were already searched for these sequences. AlphaFold only
+    # reuses an MSA file when it exists and runs the search for missing ones, so
+    # a single hit is enough to turn use_precomputed_msas on.
+    msa_keys = {}
+    if msa_store_dir:
+        for fasta_path in fasta_paths:
+            key = msa_store.msa_key(fasta_path, db_preset, model_preset)
+            target_dir = os.path.join(output_dir, fasta_target_name(fasta_path))
+            if msa_store.stage_msas(msa_store_dir, key, target_dir):
+                use_precomputed_msas = True
+            elif model_preset != 'multimer' and msa_store.derive_msas(
+                    msa_store_dir, fasta_path, target_dir, db_preset, max_substitutions):
+                # Point mutant of a searched sequence. The derived MSAs are not
+                # harvested, so mutants are always derived from a real search.
+                use_precomputed_msas = True
+            else:
+                msa_keys[fasta_path] = key
+
     mounts = []
     command_args = []
 
@@ -137,6 +201,11 @@ def docker_service(fasta_paths,
             ('uniclust30_database_path', uniclust30_database_path),
             ('bfd_database_path', bfd_database_path),
         ])
+    # Mount local copies of the search databases instead of streaming them over NFS.
+    release_databases = lambda: None
+    if db_scratch_dir:
+        database_paths, release_databases = db_staging.acquire(
+            db_scratch_dir, database_paths, max_bytes=db_scratch_max_bytes)
     for name, path in database_paths:
         if path:
             mount, target_path = _create_mount(name, path)
@@ -166,121 +235,245 @@ def docker_service(fasta_paths,
         docker.types.DeviceRequest(driver='nvidia', capabilities=[['gpu']])
     ] if use_gpu else None
 
-    container = client.containers.run(
-        image=docker_image_name,
-        command=command_args,
-        device_requests=device_requests,
-        remove=True,
-        detach=True,
-        mounts=mounts,
-        user=docker_user,
-        environment={
-            'NVIDIA_VISIBLE_DEVICES': gpu_devices,
-            # The following flags allow us to make predictions on proteins that
-            # would typically be too long to fit into GPU memory.
-            'TF_FORCE_UNIFIED_MEMORY': '1',
-            'XLA_PYTHON_CLIENT_MEM_FRACTION': '4.0',
-        })
-
-    # Add signal handler to ensure CTRL+C also stops the running container.
-    signal.signal(signal.SIGINT,
-                  lambda unused_sig, unused_frame: container.kill())
-
-    for line in container.logs(stream=True):
-        logging.info(line.strip().decode('utf-8'))
-
-
+    container_environment = {
+        'NVIDIA_VISIBLE_DEVICES': gpu_devices,
+        # The following flags allow us to make predictions on proteins that
+        # would typically be too long to fit into GPU memory.
+        'TF_FORCE_UNIFIED_MEMORY': '1',
+        'XLA_PYTHON_CLIENT_MEM_FRACTION': '4.0',
+        # Allocate on demand, so the sampled GPU memory is what the model uses
+        # rather than the preallocated fraction.
+        'XLA_PYTHON_CLIENT_PREALLOCATE': 'false',
+    }
+    # Per job memory settings, see cost_model.memory_environment().
+    container_environment.update(environment or {})
+
+    try:
+        container = client.containers.run(
+            image=docker_image_name,
+            command=command_args,
+            device_requests=device_requests,
+            remove=False,
+            detach=True,
+            mounts=mounts,
+            user=docker_user,
+            environment=container_environment,
+            labels=labels)
+
+        if on_container is not None:
+            on_container(container)
+        stop_memory_sampling = cost_model.sample_peak_memory(
+            container, measure_device=container_environment['XLA_PYTHON_CLIENT_PREALLOCATE'] == 'false')
+
+        # Add signal handler to ensure CTRL+C also stops the running container.
+        # Signal handlers can only be installed from the main thread, pipeline
+        # stages running in worker threads rely on their caller instead.
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT,
+                          lambda unused_sig, unused_frame: container.kill())
+
+        # Container log lines are parsed into progress events, see alphafold_progress.
+        total_models = alphafold_progress.num_models(model_preset, num_multimer_predictions_per_model)
+        result = supervise.wait_container(
+            'alphafold', container, check=False,
+            on_line=alphafold_progress.line_handler(output_dir, total_models, on_event))
+        peak_memory, peak_device_memory = stop_memory_sampling()
+    finally:
+        release_databases()
+
+    # A run killed during the search leaves truncated MSAs, which would be served to every
+    # later hit and derived mutant, so only a successful run is harvested.
+    for fasta_path, key in (msa_keys.items() if result.returncode == 0 else ()):
+        msa_store.harvest_msas(msa_store_dir, key,
+                               os.path.join(output_dir, fasta_target_name(fasta_path)),
+                               fasta_path, db_preset, model_preset)
+
+    for fasta_path, key in cache_keys.items():
+        structure_cache.store(structure_cache_dir, key,
+                              os.path.join(output_dir, fasta_target_name(fasta_path)),
+                              max_bytes=structure_cache_max_bytes)
+
+    for fasta_path in fasta_paths:
+        summary = alphafold_progress.summarize(output_dir, fasta_target_name(fasta_path))
+        ranked_0 = os.path.join(output_dir, fasta_target_name(fasta_path), 'ranked_0.pdb')
+        if runs_file and os.path.exists(ranked_0):
+            # Every finished prediction refines the cost model used to schedule the next ones.
+            cost_model.record_run(runs_file, sequence_length(fasta_path), db_preset, model_preset,
+                                  *cost_model.run_costs(summary), peak_memory=peak_memory,
+                                  precomputed_msas=use_precomputed_msas,
+                                  device_memory=peak_device_memory)
+        supervise.check_result(result, ranked_0)
+    return result
+
+
+@instrument.instrumented('pdb_to_pdbqt')
 def pdb_to_pdbqt(receptor, out_dir):
     """
 
     :param receptor: 输入的是蛋白序列文件的名称，无后缀名
     :param out_dir:输出的路径
-    :return:
+    :return: 写入pdbqt的原子数
     """
     file_name = os.path.join(out_dir, receptor, 'ranked_0.pdb')  # f'/tmp/alphafold/{receptor}/ranked_0.pdb'
-    f = open(file_name, 'r')
-    #读取每一行数据
-    lines = f.readlines()
-    new_lines = lines[:-1]
-    f_w = open(os.path.join(out_dir, f'{receptor}.pdbqt'), "w")
-    for line in new_lines:
-        f_w.write(line)
-    f.close()
-    f_w.close()
+    # 加极性氢、分配AutoDock原子类型并计算Gasteiger电荷，不需要调用外部程序
+    return receptor_prep.prepare_receptor(file_name, os.path.join(out_dir, f'{receptor}.pdbqt'))
 
+@instrument.instrumented('openbabel')
 def openbabel(ligand_file, format, out_file):
     """
     :ligand_file:为输入化合物文件名，无后缀名
     :format：为输入化合物文件格式
+    :return: supervise.StageResult
     """
     #past_file = 
-    cmd = f'obabel -i {format} {ligand_file}.{format} -opdbqt -O {out_file}'
-    return os.popen(cmd, 'r')
+    cmd = ['obabel', '-i', format, f'{ligand_file}.{format}', '-opdbqt', '-O', out_file]
+    return supervise.run_command('openbabel', cmd, expected_output=out_file)
 
-def autodock_vina_run(receptor_file, ligand_file, out_file, log_file):
+@instrument.instrumented('vina')
+def autodock_vina_run(receptor_file, ligand_file, out_file, log_file, docking_cache_dir=None,
+                      config_file='/tmp/autodock_vina/config.txt'):
     """
 
     :param receptor_file:输入的是蛋白序列文件的名称，有后缀名, 绝对路径
     :param ligand_file:输入的是化合物文件的名称，又后缀名, 绝对路径
     :param out_file:输出的对接结果文件，为pdbqt格式
     :param log_file：输出的对接结果打分值，为txt文件
-    :return:
+    :param docking_cache_dir: 对接缓存目录，相同的受体、化合物、配置和vina版本直接返回缓存的结果
+    :param config_file: vina配置文件，可以用pocket_finder.receptor_config()生成受体专用的对接盒子
+    :return: supervise.StageResult
     """
     # log_file = '/tmp/autodock_vina/log.txt'
     # out_file = '/tmp/autodock_vina/out.pdbqt'
     # ligand_file = '/tmp/autodock_vina/1.pdbqt'
     # receptor_file = '/tmp/autodock_vina/000001.pdbqt'
-    config_file = '/tmp/autodock_vina/config.txt'
-    cmd = f'/home/xyzhang/autodock/autodock_vina_1_1_2_linux_x86/bin/vina --config {config_file}' \
-        f' --receptor {receptor_file} --ligand {ligand_file} --out {out_file} --log {log_file}'
+    vina_binary = '/home/xyzhang/autodock/autodock_vina_1_1_2_linux_x86/bin/vina'
+    cmd = [vina_binary, '--config', config_file,
+           '--receptor', receptor_file, '--ligand', ligand_file, '--out', out_file, '--log', log_file]
+    if docking_cache_dir:
+        key = docking_cache.docking_key(receptor_file, ligand_file, config_file, vina_binary)
+        if docking_cache.lookup(docking_cache_dir, key, out_file, log_file):
+            return supervise.StageResult('vina', 0, 0.0, 'docking cache hit')
     # print(cmd)
-    return os.popen(cmd, 'r')
+    result = supervise.run_command('vina', cmd, expected_output=log_file)
+    if docking_cache_dir:
+        docking_cache.store(docking_cache_dir, key, out_file, log_file)
+    return result
 
 
-def alphafold_openbabel_vina(receptor, ligand_file, format, out_dir, job_id=0):
+def alphafold_openbabel_vina(receptor, ligand_file, format, out_dir, job_id=0,
+                             structure_cache_dir=None, msa_store_dir=None,
+                             docking_cache_dir=None, auto_box=False, resume=True,
+                             ensemble=False, min_plddt=None):
     """
+    化合物格式转换与AlphaFold结构预测同时进行，受体转换完成后各化合物的对接并行执行
     :param receptor: 输入的是蛋白序列文件的名称，无后缀名
-    :param ligand_file: 输入的是化合物文件的名称，无后缀名
+    :param ligand_file: 输入的是化合物文件的名称，无后缀名，也可以是多个化合物文件的列表
     :param format：为输入化合物文件格式
     :param out_dir:输出的路径
     :param job_id:
+    :param structure_cache_dir: 结构缓存目录，为None时不使用缓存
+    :param msa_store_dir: 共享MSA库目录，为None时不使用
+    :param docking_cache_dir: 对接缓存目录，为None时不使用缓存
+    :param auto_box: 在预测结构上寻找口袋，生成受体专用的对接盒子代替config.txt中的盒子
+    :param resume: 根据 f'{out_dir}/manifest.json' 跳过上次已经完成且输入输出没有变化的阶段
+    :param ensemble: 与所有排名模型对接并汇总每个化合物的结合能，见ensemble_docking.ensemble_dock()
+    :param min_plddt: ensemble时平均pLDDT低于这个值的模型不参加对接
+    :return: 各阶段的耗时 {stage name: pipeline_graph.StageTiming}
     """
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
-    _, ligand_name = os.path.split(ligand_file)
+    ligand_files = [ligand_file] if isinstance(ligand_file, str) else list(ligand_file)
     _, receptor_name = os.path.split(receptor)
-    openbabel(f'{ligand_file}', 
-              f'{format}',
-              os.path.join(out_dir, f'{ligand_name}.pdbqt'))
-    docker_service([f'{receptor}.fasta'], output_dir=out_dir)
-    file_name = os.path.join(out_dir, receptor, 'ranked_0.pdb')  # f'/tmp/alphafold/{receptor}/ranked_0.pdb'
-    while not os.path.exists(file_name):  # 判断文件是否存在
-        time.sleep(0.5)
-    print('alphaflod finish!')
-
-    pdb_to_pdbqt(receptor, out_dir)
-    # receptor_name = receptor_name.replace('.pdbqt', '')
-    # ligand_name = ligand_name.replace('.pdbqt', '')
-    autodock_vina_run(f'{receptor}.pdbqt', 
-                      f'{ligand_file}.pdbqt', 
-                      os.path.join(out_dir, f'{receptor_name}_{ligand_name}.pdbqt'),
-                      os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt'))
-    file_name = os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt')
-    while not os.path.exists(file_name):  # 判断文件是否存在
-        time.sleep(0.5)
+    receptor_pdbqt = os.path.join(out_dir, f'{receptor_name}.pdbqt')
+    ranked_0 = os.path.join(out_dir, receptor_name, 'ranked_0.pdb')
+    manifest_file = os.path.join(out_dir, checkpoint.MANIFEST_NAME)
+
+    def stage(name, fn, deps, inputs, outputs, params=None):
+        # A stage is skipped only when its inputs hash the same as in the last run, so a
+        # re-predicted structure or changed ligand invalidates everything downstream of it.
+        if resume:
+            fn = checkpoint.checkpointed(manifest_file, name, fn, inputs, outputs, params)
+        return name, fn, deps
+
+    # After an interrupted prediction, AlphaFold can pick up the MSAs it already wrote.
+    use_precomputed_msas = resume and os.path.isdir(os.path.join(out_dir, receptor_name, 'msas'))
+    stages = [
+        stage('alphafold', functools.partial(docker_service, [f'{receptor}.fasta'],
+                                             output_dir=out_dir,
+                                             use_precomputed_msas=use_precomputed_msas,
+                                             structure_cache_dir=structure_cache_dir,
+                                             msa_store_dir=msa_store_dir), [],
+              [f'{receptor}.fasta'], [ranked_0]),
+    ]
+    if ensemble:
+        ligands = []
+        for ligand in ligand_files:
+            _, ligand_name = os.path.split(ligand)
+            ligand_pdbqt = os.path.join(out_dir, f'{ligand_name}.pdbqt')
+            ligands.append((ligand_name, ligand_pdbqt))
+            stages.append(stage(f'openbabel:{ligand_name}',
+                                functools.partial(openbabel, ligand, format, ligand_pdbqt), [],
+                                [f'{ligand}.{format}'], [ligand_pdbqt]))
+        # The set of ranked models is only known once AlphaFold has finished.
+        stages.append(stage('ensemble',
+                            functools.partial(ensemble_docking.ensemble_dock, receptor_name,
+                                              ligands, out_dir, min_plddt=min_plddt,
+                                              docking_cache_dir=docking_cache_dir,
+                                              auto_box=auto_box),
+                            ['alphafold'] + [f'openbabel:{name}' for name, _ in ligands],
+                            [ranked_0] + [path for _, path in ligands],
+                            [os.path.join(out_dir, f'{receptor_name}_ensemble.json')],
+                            {'min_plddt': min_plddt, 'auto_box': auto_box}))
+        _, timings = pipeline_graph.run_stages(stages)
+        pipeline_graph.log_report(timings)
+        print('vina finish!')
+        return timings
+
+    stages.append(stage('pdb_to_pdbqt', functools.partial(pdb_to_pdbqt, receptor_name, out_dir),
+                        ['alphafold'], [ranked_0], [receptor_pdbqt]))
+    config_file = '/tmp/autodock_vina/config.txt'
+    vina_deps = ['pdb_to_pdbqt']
+    if auto_box:
+        config_file = os.path.join(out_dir, f'{receptor_name}_config.txt')
+        stages.append(stage('pocket', functools.partial(pocket_finder.receptor_config,
+                                                        ranked_0, config_file), ['alphafold'],
+                            [ranked_0, '/tmp/autodock_vina/config.txt'], [config_file]))
+        vina_deps.append('pocket')
+    for ligand in ligand_files:
+        _, ligand_name = os.path.split(ligand)
+        ligand_pdbqt = os.path.join(out_dir, f'{ligand_name}.pdbqt')
+        out_file = os.path.join(out_dir, f'{receptor_name}_{ligand_name}.pdbqt')
+        log_file = os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt')
+        stages.extend([
+            stage(f'openbabel:{ligand_name}',
+                  functools.partial(openbabel, ligand, format, ligand_pdbqt), [],
+                  [f'{ligand}.{format}'], [ligand_pdbqt]),
+            stage(f'vina:{ligand_name}',
+                  functools.partial(autodock_vina_run, receptor_pdbqt, ligand_pdbqt,
+                                    out_file, log_file,
+                                    docking_cache_dir=docking_cache_dir,
+                                    config_file=config_file),
+                  vina_deps + [f'openbabel:{ligand_name}'],
+                  [receptor_pdbqt, ligand_pdbqt, config_file], [out_file, log_file]),
+            (f'html:{ligand_name}',
+             functools.partial(generate_html,
+                               outdir=out_dir,
+                               html_name=f'{receptor_name}_{ligand_name}.html',
+                               job_id=job_id,
+                               protein_tertiary_structure_file=os.path.join(receptor_name, 'ranked_0.pdb'),
+                               protein_tertiary_structure_PDBQT_format_file=f'{receptor_name}.pdbqt',
+                               compound_PDBQT_format_file=f'{ligand_name}.pdbqt',
+                               autodock_vina_molecular_docking_result=f'{receptor_name}_{ligand_name}.pdbqt',
+                               autodock_vina_molecular_docking_scoring_value=f'{receptor_name}_{ligand_name}.txt'),
+             [f'vina:{ligand_name}']),
+        ])
+    _, timings = pipeline_graph.run_stages(stages)
+    pipeline_graph.log_report(timings)
     print('vina finish!')
-
-    generate_html(outdir=out_dir,
-                  html_name=f'{receptor_name}_{ligand_name}.html',
-                  job_id=job_id,
-                  protein_tertiary_structure_file=os.path.join(receptor, 'ranked_0.pdb'),
-                  protein_tertiary_structure_PDBQT_format_file=f'{receptor_name}.pdbqt',
-                  compound_PDBQT_format_file=f'{ligand_name}.pdbqt',
-                  autodock_vina_molecular_docking_result=f'{receptor_name}_{ligand_name}.pdbqt',
-                  autodock_vina_molecular_docking_scoring_value=f'{receptor_name}_{ligand_name}.txt'
-                  )
+    return timings
 
 
+@instrument.instrumented('html')
 def generate_html(outdir,
                   html_name,
                   job_id=0,
@@ -336,11 +529,29 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('receptor', type=str, help='the receptor file, absolute path without file extension, e.g. /tmp/alphafold/Y265H')
-    parser.add_argument('ligand', type=str, help='the ligand file, absolute path without file extension, e.g. /tmp/alphafold/1')
+    parser.add_argument('ligand', type=str, nargs='+', help='one or more ligand files, absolute path without file extension, e.g. /tmp/alphafold/1')
     parser.add_argument('formate', type=str, help='the format of ligand file, e.g. mol2')
     parser.add_argument('outdir', type=str, help='the dictionary of output files, e.g. /tmp/alphafold/Y265H_1')
+    parser.add_argument('--structure_cache_dir', type=str, default=None, help='directory of the persistent structure cache, e.g. /tmp/alphafold_cache')
+    parser.add_argument('--msa_store_dir', type=str, default=None, help='directory of the shared MSA store, e.g. /tmp/alphafold_msas')
+    parser.add_argument('--docking_cache_dir', type=str, default=None, help='directory of the docking result cache, e.g. /tmp/vina_cache')
+    parser.add_argument('--auto_box', action='store_true', help='dock into the pockets found on the predicted structure instead of the box in config.txt')
+    parser.add_argument('--no_resume', action='store_true', help='run every stage again instead of skipping the ones recorded in outdir/manifest.json')
+    parser.add_argument('--ensemble', action='store_true', help='dock every ligand against all ranked models and aggregate the scores')
+    parser.add_argument('--min_plddt', type=float, default=None, help='with --ensemble, leave models with a lower mean pLDDT out')
+    parser.add_argument('--trace_file', type=str, default=None, help='append a JSON line with the wall/CPU time, memory and I/O of every stage, e.g. /tmp/alphafold/trace.jsonl')
+    parser.add_argument('--metrics_file', type=str, default=None, help='write the stage totals of trace_file in Prometheus text format, e.g. /tmp/alphafold/metrics.prom')
     args = parser.parse_args()
-    alphafold_openbabel_vina(args.receptor, args.ligand, args.formate, args.outdir)
+    instrument.configure(args.trace_file)
+    alphafold_openbabel_vina(args.receptor, args.ligand, args.formate, args.outdir,
+                             structure_cache_dir=args.structure_cache_dir,
+                             msa_store_dir=args.msa_store_dir,
+                             docking_cache_dir=args.docking_cache_dir,
+                             auto_box=args.auto_box,
+                             resume=not args.no_resume,
+                             ensemble=args.ensemble, min_plddt=args.min_plddt)
+    if args.trace_file and args.metrics_file:
+        instrument.write_prometheus(args.trace_file, args.metrics_file)
 
     generate_html('D:\Desktop\\alphafold_openbabel_vina\生成数据',
                   'Y265H_1.html',
@@ -0,0 +1,244 @@
+import ast
+import collections
+import json
+import os
+import re
+import shlex
+import time
+
+from absl import logging
+
+
+ProgressEvent = collections.namedtuple(
+    'ProgressEvent', ['kind', 'target', 'name', 'seconds', 'detail', 'time'])
+
+# "I0716 10:05:44.379163 140127640811328 utils.py:36] Started HHblits query"
+_ABSL_LINE = re.compile(r'^[IWEF]\d{4} [\d:.]+\s+\d+\s+[\w.]+:\d+\] (.*)$')
+_PREDICTING = re.compile(r'^Predicting (\S+)$')
+_LAUNCHING = re.compile(r'^Launching subprocess "(.*)"$')
+_STARTED = re.compile(r'^Started (\w+)(?: \((.+?)\))? query$')
+_FINISHED = re.compile(r'^Finished (\w+)(?: \((.+?)\))? query in ([\d.]+) seconds$')
+_MSA_SIZE = re.compile(r'^(.+?) MSA size: (\d+) sequences\.?$')
+_TEMPLATES = re.compile(r'^Total number of templates.*?: (\d+)\.?$')
+_MODEL_START = re.compile(r'^Running model (\S+) on (\S+)$')
+_MODEL_FINISH = re.compile(r'^Total JAX model (\S+) on (\S+) predict time.*?: ([\d.]+)s$')
+_RELAX = re.compile(r'^Iteration completed: .*Time ([\d.]+) s')
+_FINAL_TIMINGS = re.compile(r'^Final timings for (\S+): (\{.*\})$')
+
+# Searches against the template databases, everything else builds the MSAs.
+_TEMPLATE_TOOLS = ('hhsearch', 'hmmsearch')
+
+
+def _databases(command):
+    """数据库文件名，hhblits的 -d 参数或jackhmmer/hmmsearch的最后一个参数"""
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return ''
+    if '-d' in args:
+        return ','.join(os.path.basename(args[i + 1]) for i, arg in enumerate(args[:-1])
+                        if arg == '-d')
+    return os.path.basename(args[-1]) if args else ''
+
+
+def _search_name(tool, databases):
+    return f'{tool}:{databases}' if databases else tool
+
+
+def parse_line(line, state, clock=time.time):
+    """
+    解析AlphaFold容器的一行日志
+    :param line: 日志行，str或bytes
+    :param state: 同一个日志流的解析状态，第一次调用时传入空dict
+    :param clock: 事件时间的来源，回放日志时可以替换
+    :return: ProgressEvent，这一行不是进度信息时返回None
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', errors='replace')
+    match = _ABSL_LINE.match(line.strip())
+    if match is None:
+        return None
+    message = match.group(1).strip()
+    target = state.get('target')
+
+    def event(kind, name=None, seconds=None, detail=None):
+        return ProgressEvent(kind, target, name, seconds, detail, clock())
+
+    match = _PREDICTING.match(message)
+    if match:
+        state['target'] = target = match.group(1)
+        return event('predict_start')
+    match = _LAUNCHING.match(message)
+    if match:
+        state['databases'] = _databases(match.group(1))
+        return None
+    match = _STARTED.match(message)
+    if match:
+        tool = match.group(1)
+        kind = 'template_search_start' if tool.lower() in _TEMPLATE_TOOLS else 'msa_start'
+        return event(kind, _search_name(tool, match.group(2) or state.get('databases')))
+    match = _FINISHED.match(message)
+    if match:
+        tool = match.group(1)
+        kind = 'template_search_finish' if tool.lower() in _TEMPLATE_TOOLS else 'msa_finish'
+        return event(kind, _search_name(tool, match.group(2) or state.pop('databases', None)),
+                     float(match.group(3)))
+    match = _MSA_SIZE.match(message)
+    if match:
+        return event('msa_size', match.group(1), detail=int(match.group(2)))
+    match = _TEMPLATES.match(message)
+    if match:
+        return event('templates', detail=int(match.group(1)))
+    match = _MODEL_START.match(message)
+    if match:
+        return event('model_start', match.group(1))
+    match = _MODEL_FINISH.match(message)
+    if match:
+        return event('model_finish', match.group(1), float(match.group(3)))
+    match = _RELAX.match(message)
+    if match:
+        return event('relax', seconds=float(match.group(1)))
+    match = _FINAL_TIMINGS.match(message)
+    if match:
+        try:
+            timings = ast.literal_eval(match.group(2))
+        except (ValueError, SyntaxError):
+            timings = None
+        return event('final_timings', match.group(1), detail=timings)
+    return None
+
+
+def parse_events(lines, clock=time.time):
+    """
+    把日志流解析成进度事件
+    :param lines: 日志行的可迭代对象，例如 container.logs(stream=True) 或保存下来的日志文件
+    :return: 生成 ProgressEvent
+    """
+    state = {}
+    for line in lines:
+        event = parse_line(line, state, clock)
+        if event is not None:
+            yield event
+
+
+def num_models(model_preset, num_multimer_predictions_per_model=5):
+    """AlphaFold一个target要跑的模型数"""
+    if model_preset == 'multimer':
+        return 5 * num_multimer_predictions_per_model
+    return 5
+
+
+def remaining_seconds(events, total_models):
+    """
+    根据已完成模型耗时的中位数估计当前target剩余的推理时间
+    :return: 秒数，还没有模型完成时返回None
+    """
+    model_times = [e.seconds for e in events if e.kind == 'model_finish']
+    if not model_times:
+        return None
+    # The first model includes the JAX compilation, later ones are faster.
+    later = sorted(model_times[1:] or model_times)
+    typical = later[len(later) // 2]
+    return max(0, total_models - len(model_times)) * typical
+
+
+def progress_file(output_dir, target):
+    return os.path.join(output_dir, f'{target}.progress.jsonl')
+
+
+def line_handler(output_dir, total_models=5, on_event=None):
+    """
+    生成supervise.wait_container()的on_line回调，解析出的事件追加到 f'{output_dir}/{target}.progress.jsonl'
+    :param total_models: 每个target的模型数，用于估计剩余时间
+    :param on_event: 每个事件的回调 on_event(ProgressEvent)
+    """
+    state = {}
+    events = []
+
+    def handle(line):
+        event = parse_line(line, state)
+        if event is None:
+            return
+        if event.kind == 'predict_start':
+            events.clear()
+        events.append(event)
+        if event.target:
+            # A new prediction of the same target replaces the events of the last run.
+            mode = 'w' if event.kind == 'predict_start' else 'a'
+            with open(progress_file(output_dir, event.target), mode) as f:
+                f.write(json.dumps(event._asdict()) + '\n')
+        if event.kind in ('msa_finish', 'template_search_finish'):
+            logging.info('%s: %s took %.1fs', event.target, event.name, event.seconds)
+        elif event.kind == 'model_finish':
+            eta = remaining_seconds(events, total_models)
+            logging.info('%s: %s predicted in %.1fs, about %.0fs of inference left',
+                         event.target, event.name, event.seconds, eta)
+        if on_event is not None:
+            on_event(event)
+
+    return handle
+
+
+def read_events(output_dir, target):
+    """读取保存的进度事件"""
+    events = []
+    path = progress_file(output_dir, target)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    events.append(ProgressEvent(**json.loads(line)))
+    return events
+
+
+def summarize(output_dir, target):
+    """
+    汇总一个target的各阶段耗时，合并AlphaFold写出的timings.json和ranking_debug.json，
+    写入 f'{output_dir}/{target}.progress.json'
+    :return: 汇总dict
+    """
+    events = read_events(output_dir, target)
+    summary = {
+        'target': target,
+        'msa_search_seconds': {},
+        'template_search_seconds': {},
+        'msa_sizes': {},
+        'templates': None,
+        'model_seconds': {},
+        'relax_seconds': 0.0,
+        'alphafold_timings': None,
+        'ranking': None,
+    }
+    for event in events:
+        if event.kind == 'msa_finish':
+            summary['msa_search_seconds'][event.name] = event.seconds
+        elif event.kind == 'template_search_finish':
+            summary['template_search_seconds'][event.name] = event.seconds
+        elif event.kind == 'msa_size':
+            summary['msa_sizes'][event.name] = event.detail
+        elif event.kind == 'templates':
+            summary['templates'] = event.detail
+        elif event.kind == 'model_finish':
+            summary['model_seconds'][event.name] = event.seconds
+        elif event.kind == 'relax':
+            summary['relax_seconds'] += event.seconds
+        elif event.kind == 'final_timings':
+            summary['alphafold_timings'] = event.detail
+    for name, key in (('timings.json', 'alphafold_timings'), ('ranking_debug.json', 'ranking')):
+        path = os.path.join(output_dir, target, name)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                summary[key] = json.load(f)
+    with open(os.path.join(output_dir, f'{target}.progress.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('log_file', type=str, help='a captured AlphaFold container log, e.g. /tmp/alphafold/Y265H.log')
+    args = parser.parse_args()
+    with open(args.log_file, 'r') as f:
+        for event in parse_events(f):
+            print(json.dumps(event._asdict()))
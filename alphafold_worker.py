@@ -0,0 +1,171 @@
+import json
+import os
+import shutil
+import time
+import uuid
+
+from absl import logging
+import docker
+from docker import types
+
+from alphafold2 import _ROOT_MOUNT_DIRECTORY, _create_mount, _database_paths
+from fasta_utils import fasta_target_name
+
+
+_SPOOL_TARGET = os.path.join(_ROOT_MOUNT_DIRECTORY, 'spool')
+_WORKER_TARGET = os.path.join(_ROOT_MOUNT_DIRECTORY, 'worker')
+_PLACEHOLDER_FASTA = 'worker.fasta'
+
+
+def _init_spool(spool_dir):
+    for name in ('incoming', 'running', 'done'):
+        os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+    stop_file = os.path.join(spool_dir, 'STOP')
+    if os.path.exists(stop_file):
+        os.remove(stop_file)
+    # run_alphafold.main() needs a fasta path to start; the worker swallows it.
+    with open(os.path.join(spool_dir, _PLACEHOLDER_FASTA), 'w') as f:
+        f.write('>worker\nA\n')
+
+
+def start_worker(spool_dir,
+                 output_dir='/tmp/alphafold',
+                 data_dir='/mnt/nfs02/57t02/af2/download/',
+                 docker_image_name='alphafold',
+                 use_gpu=True,
+                 run_relax=True,
+                 enable_gpu_relax=True,
+                 gpu_devices='all',
+                 max_template_date='2020-05-14',
+                 db_preset='full_dbs',
+                 model_preset='monomer',
+                 num_multimer_predictions_per_model=5,
+                 use_precomputed_msas=True,
+                 docker_user=f'{os.geteuid()}:{os.getegid()}',
+                 client=None):
+    """
+    启动常驻的AlphaFold容器，模型只加载一次，之后通过spool目录接收任务
+    :param spool_dir: 主机上的spool目录，用submit_job()提交任务
+    :param output_dir: 预测结果的输出路径
+    :param client: docker客户端，为None时使用docker.from_env()
+    :return: 容器对象
+    """
+    _init_spool(spool_dir)
+    mounts = [
+        types.Mount(_SPOOL_TARGET, os.path.abspath(spool_dir), type='bind'),
+        types.Mount(_WORKER_TARGET, os.path.dirname(os.path.abspath(__file__)),
+                    type='bind', read_only=True),
+    ]
+    command_args = [
+        os.path.join(_WORKER_TARGET, 'alphafold_worker_entry.py'),
+        f'--spool_dir={_SPOOL_TARGET}',
+        f'--fasta_paths={os.path.join(_SPOOL_TARGET, _PLACEHOLDER_FASTA)}',
+    ]
+    for name, path in _database_paths(data_dir, db_preset, model_preset):
+        mount, target_path = _create_mount(name, path)
+        mounts.append(mount)
+        command_args.append(f'--{name}={target_path}')
+
+    output_target_path = os.path.join(_ROOT_MOUNT_DIRECTORY, 'output')
+    mounts.append(types.Mount(output_target_path, output_dir, type='bind'))
+    command_args.extend([
+        f'--output_dir={output_target_path}',
+        f'--max_template_date={max_template_date}',
+        f'--db_preset={db_preset}',
+        f'--model_preset={model_preset}',
+        f'--use_precomputed_msas={use_precomputed_msas}',
+        f'--num_multimer_predictions_per_model={num_multimer_predictions_per_model}',
+        f'--run_relax={run_relax}',
+        f'--use_gpu_relax={enable_gpu_relax and use_gpu}',
+        '--logtostderr',
+    ])
+
+    client = client or docker.from_env()
+    device_requests = [
+        docker.types.DeviceRequest(driver='nvidia', capabilities=[['gpu']])
+    ] if use_gpu else None
+    container = client.containers.run(
+        image=docker_image_name,
+        entrypoint='python',
+        command=command_args,
+        working_dir='/app/alphafold',
+        device_requests=device_requests,
+        remove=False,
+        detach=True,
+        mounts=mounts,
+        user=docker_user,
+        environment={
+            'NVIDIA_VISIBLE_DEVICES': gpu_devices,
+            'TF_FORCE_UNIFIED_MEMORY': '1',
+            'XLA_PYTHON_CLIENT_MEM_FRACTION': '4.0',
+        })
+    logging.info('Started AlphaFold worker %s on %s', container.id, spool_dir)
+    return container
+
+
+def submit_job(spool_dir, fasta_path, job_id=None):
+    """
+    向常驻worker提交一个fasta
+    :param spool_dir: start_worker()使用的spool目录
+    :param fasta_path: fasta文件路径，有后缀名
+    :return: job_id
+    """
+    # Job ids sort in submission order, which is the order the worker claims them.
+    job_id = job_id or f'{time.time_ns():020d}_{uuid.uuid4().hex[:8]}'
+    incoming = os.path.join(spool_dir, 'incoming')
+    tmp_dir = os.path.join(incoming, f'.{job_id}')
+    os.makedirs(tmp_dir)
+    shutil.copy(fasta_path, os.path.join(tmp_dir, f'{fasta_target_name(fasta_path)}.fasta'))
+    os.rename(tmp_dir, os.path.join(incoming, job_id))
+    return job_id
+
+
+def iter_results(spool_dir, job_ids, container=None, poll_interval=1.0):
+    """
+    按完成顺序返回任务结果
+    :param spool_dir: start_worker()使用的spool目录
+    :param job_ids: submit_job()返回的job_id
+    :param container: worker容器，提供时在容器退出后报错而不是一直等待
+    :return: 生成done/<job_id>.json中的记录
+    """
+    pending = set(job_ids)
+    done = os.path.join(spool_dir, 'done')
+    while pending:
+        finished = [job_id for job_id in pending
+                    if os.path.exists(os.path.join(done, f'{job_id}.json'))]
+        for job_id in sorted(finished):
+            with open(os.path.join(done, f'{job_id}.json'), 'r') as f:
+                record = json.load(f)
+            pending.discard(job_id)
+            yield record
+        if pending and not finished:
+            if container is not None:
+                container.reload()
+                if container.status in ('exited', 'dead'):
+                    raise RuntimeError(f'AlphaFold worker exited with {len(pending)} '
+                                       f'jobs pending')
+            time.sleep(poll_interval)
+
+
+def stop_worker(spool_dir, container=None):
+    """Ask the worker to exit once the queue is empty and wait for it."""
+    open(os.path.join(spool_dir, 'STOP'), 'w').close()
+    if container is not None:
+        status = container.wait()
+        container.remove()
+        return status.get('StatusCode', -1)
+    return None
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fasta_paths', type=str, nargs='+', help='the fasta files to fold, e.g. /tmp/alphafold/Y265H.fasta')
+    parser.add_argument('output_dir', type=str, help='the output_dir file, e.g. /tmp/alphafold')
+    parser.add_argument('--spool_dir', type=str, default='/tmp/alphafold_spool', help='the spool directory shared with the worker container')
+    args = parser.parse_args()
+    container = start_worker(args.spool_dir, output_dir=args.output_dir)
+    job_ids = [submit_job(args.spool_dir, fasta_path) for fasta_path in args.fasta_paths]
+    for record in iter_results(args.spool_dir, job_ids, container=container):
+        print(f"{record['fasta_name']}: {record['status']} in {record['wall_time']:.1f}s")
+    stop_worker(args.spool_dir, container)
@@ -0,0 +1,158 @@
+"""Long-lived AlphaFold worker, started inside the AlphaFold container.
+
+It takes the flags of run_alphafold.py plus --spool_dir. run_alphafold.main()
+builds the data pipeline, loads the model parameters and the relaxer once and
+then calls predict_structure() for each fasta path; the first call is
+intercepted here and turned into a loop that serves jobs from the spool
+directory, so every job reuses the already initialised models.
+
+Spool layout (shared with alphafold_worker.py on the host):
+    incoming/<job_id>/<name>.fasta   queued jobs, oldest job_id first
+    running/<job_id>/                job being predicted, re-queued if the worker dies
+    done/<job_id>.json               result record of a finished job
+    STOP                             ask the worker to exit when idle
+"""
+import functools
+import json
+import os
+import shutil
+import sys
+import time
+import traceback
+
+
+_ALPHAFOLD_DIR = '/app/alphafold'
+# A job that was running when this many workers died is given up instead of
+# taking the next worker down as well.
+_MAX_ATTEMPTS = 2
+_ATTEMPTS_FILE = '.attempts'
+
+
+def _attempts(job_dir):
+    try:
+        with open(os.path.join(job_dir, _ATTEMPTS_FILE), 'r') as f:
+            return int(f.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def claim_next_job(spool_dir):
+    """Move the oldest queued job to running/ and return (job_id, fasta_path)."""
+    incoming = os.path.join(spool_dir, 'incoming')
+    for job_id in sorted(os.listdir(incoming)):
+        if job_id.startswith('.'):
+            continue
+        running = os.path.join(spool_dir, 'running', job_id)
+        try:
+            os.rename(os.path.join(incoming, job_id), running)
+        except OSError:
+            continue
+        attempts = _attempts(running) + 1
+        with open(os.path.join(running, _ATTEMPTS_FILE), 'w') as f:
+            f.write(str(attempts))
+        fasta_names = [name for name in os.listdir(running) if name.endswith('.fasta')]
+        if fasta_names:
+            return job_id, os.path.join(running, fasta_names[0])
+    return None
+
+
+def finish_job(spool_dir, job_id, record):
+    done = os.path.join(spool_dir, 'done')
+    tmp_file = os.path.join(done, f'.{job_id}.json')
+    with open(tmp_file, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_file, os.path.join(done, f'{job_id}.json'))
+
+
+def recover_jobs(spool_dir):
+    """
+    Move the jobs a dead worker left in running/ back to incoming/.
+
+    A job that was already running when _MAX_ATTEMPTS workers died gets an
+    error record in done/ instead. Returns the number of re-queued jobs.
+    """
+    running = os.path.join(spool_dir, 'running')
+    requeued = 0
+    for job_id in sorted(os.listdir(running)):
+        job_dir = os.path.join(running, job_id)
+        if job_id.startswith('.') or not os.path.isdir(job_dir):
+            continue
+        if os.path.exists(os.path.join(spool_dir, 'done', f'{job_id}.json')):
+            # Finished, serve() leaves the job directory behind.
+            continue
+        if _attempts(job_dir) >= _MAX_ATTEMPTS:
+            fasta_names = [name for name in os.listdir(job_dir) if name.endswith('.fasta')]
+            finish_job(spool_dir, job_id, {
+                'job_id': job_id,
+                'fasta_name': os.path.splitext(fasta_names[0])[0] if fasta_names else None,
+                'status': 'error',
+                'error': f'the worker died while running this job {_MAX_ATTEMPTS} times',
+                'wall_time': 0.0})
+            shutil.rmtree(job_dir, ignore_errors=True)
+            continue
+        os.rename(job_dir, os.path.join(spool_dir, 'incoming', job_id))
+        requeued += 1
+    return requeued
+
+
+def serve(spool_dir, predict, poll_interval=1.0):
+    """
+    处理spool目录中的任务直到出现STOP文件，开始前先用recover_jobs()重新排队上一个worker中断的任务
+    :param spool_dir: spool目录
+    :param predict: predict(fasta_path, fasta_name)，对单个fasta做结构预测
+    :param poll_interval: 没有任务时的等待秒数
+    """
+    for name in ('incoming', 'running', 'done'):
+        os.makedirs(os.path.join(spool_dir, name), exist_ok=True)
+    # Only one worker serves a spool, anything still running belongs to a worker that died.
+    recover_jobs(spool_dir)
+    while True:
+        job = claim_next_job(spool_dir)
+        if job is None:
+            if os.path.exists(os.path.join(spool_dir, 'STOP')):
+                return
+            time.sleep(poll_interval)
+            continue
+        job_id, fasta_path = job
+        fasta_name = os.path.splitext(os.path.basename(fasta_path))[0]
+        record = {'job_id': job_id, 'fasta_name': fasta_name, 'status': 'ok'}
+        start = time.monotonic()
+        try:
+            predict(fasta_path=fasta_path, fasta_name=fasta_name)
+        except Exception:  # pylint: disable=broad-except
+            record['status'] = 'error'
+            record['error'] = traceback.format_exc()
+        record['wall_time'] = time.monotonic() - start
+        finish_job(spool_dir, job_id, record)
+
+
+def main():
+    spool_dir = None
+    argv = []
+    for arg in sys.argv:
+        if arg.startswith('--spool_dir='):
+            spool_dir = arg.split('=', 1)[1]
+        else:
+            argv.append(arg)
+    if spool_dir is None:
+        raise SystemExit('--spool_dir is required')
+    sys.argv = argv
+
+    sys.path.insert(0, _ALPHAFOLD_DIR)
+    from absl import app
+    import run_alphafold
+
+    def predict_structure(**kwargs):
+        # Called by run_alphafold.main() for the placeholder fasta with the
+        # initialised pipeline, models and relaxer.
+        kwargs.pop('fasta_path')
+        kwargs.pop('fasta_name')
+        serve(spool_dir, functools.partial(original_predict_structure, **kwargs))
+
+    original_predict_structure = run_alphafold.predict_structure
+    run_alphafold.predict_structure = predict_structure
+    app.run(run_alphafold.main)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import asyncio
+import functools
+import os
+import threading
+
+from absl import logging
+import docker
+
+import alphafold2
+import alphafold2_openbabel_vina
+import docking_cache
+import pocket_finder
+import supervise
+import vina
+
+
+async def _gather(*aws):
+    """并发执行，任何一个失败或被取消时取消其余的"""
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+async def run_limited(aws, limit):
+    """
+    最多同时执行limit个协程，用于一个事件循环监管大量对接任务
+    :param aws: 协程的可迭代对象，按需取出，不会一次全部创建
+    :param limit: 同时执行的最大数量
+    :return: 结果列表，顺序与aws相同；失败的任务对应位置是异常对象
+    """
+    aws = iter(aws)
+    results = {}
+    running = {}
+    index = 0
+    try:
+        while True:
+            while len(running) < limit:
+                aw = next(aws, None)
+                if aw is None:
+                    break
+                running[asyncio.ensure_future(aw)] = index
+                index += 1
+            if not running:
+                break
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                i = running.pop(task)
+                results[i] = task.exception() if task.exception() is not None else task.result()
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+    return [results[i] for i in range(index)]
+
+
+async def openbabel(ligand_file, format, out_file):
+    """vina.openbabel()的asyncio版本"""
+    cmd = ['obabel', '-i', format, f'{ligand_file}.{format}', '-opdbqt', '-O', out_file]
+    return await supervise.run_command_async('openbabel', cmd, expected_output=out_file)
+
+
+async def autodock_vina_run(receptor_file, ligand_file, out_file, log_file, cpu=None,
+                            docking_cache_dir=None, config_file='/tmp/autodock_vina/config.txt',
+                            exhaustiveness=None, num_modes=None):
+    """
+    vina.autodock_vina_run()的asyncio版本，参数相同
+    协程被取消时杀死vina进程
+    :return: supervise.StageResult
+    """
+    cmd, extra_args = vina.vina_command(receptor_file, ligand_file, out_file, log_file, cpu,
+                                        config_file, exhaustiveness, num_modes)
+    if docking_cache_dir:
+        # Hashing the inputs reads files, keep it off the event loop.
+        key = await asyncio.to_thread(docking_cache.docking_key, receptor_file, ligand_file,
+                                      config_file, vina.VINA_BINARY, extra_args)
+        if await asyncio.to_thread(docking_cache.lookup, docking_cache_dir, key, out_file, log_file):
+            return supervise.StageResult('vina', 0, 0.0, 'docking cache hit')
+    result = await supervise.run_command_async('vina', cmd, expected_output=log_file)
+    if docking_cache_dir:
+        await asyncio.to_thread(docking_cache.store, docking_cache_dir, key, out_file, log_file)
+    return result
+
+
+def _kill(container):
+    try:
+        container.kill()
+    except docker.errors.APIError as e:
+        # Already exited.
+        logging.info('Could not kill container %s: %s', container.id, e)
+
+
+async def docker_service(fasta_paths, on_event=None, **kwargs):
+    """
+    alphafold2.docker_service()的asyncio版本，其余参数相同
+    docker SDK是阻塞的，容器的等待放在一个工作线程中；协程被取消时杀死容器
+    :param on_event: 进度事件回调，在事件循环所在的线程中调用
+    :return: supervise.StageResult
+    """
+    loop = asyncio.get_running_loop()
+    cancelled = threading.Event()
+    containers = []
+
+    def on_container(container):
+        containers.append(container)
+        if cancelled.is_set():
+            _kill(container)
+
+    if on_event is not None:
+        kwargs['on_event'] = lambda event: loop.call_soon_threadsafe(on_event, event)
+    future = loop.run_in_executor(None, functools.partial(
+        alphafold2.docker_service, fasta_paths, on_container=on_container, **kwargs))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        cancelled.set()
+        for container in list(containers):
+            await asyncio.to_thread(_kill, container)
+        # The worker thread returns as soon as the container is gone.
+        try:
+            await future
+        except Exception:  # pylint: disable=broad-except
+            pass
+        raise
+
+
+async def openbabel_vina(receptor, ligand_file, format, out_dir, job_id=0, docking_cache_dir=None):
+    """vina.openbabel_vina()的asyncio版本，化合物转换和受体转换同时进行"""
+    os.makedirs(out_dir, exist_ok=True)
+    _, ligand_name = os.path.split(ligand_file)
+    _, receptor_name = os.path.split(receptor)
+    await _gather(openbabel(ligand_file, format, os.path.join(out_dir, f'{ligand_name}.pdbqt')),
+                  asyncio.to_thread(vina.pdb_to_pdbqt, receptor, out_dir))
+    result = await autodock_vina_run(f'{receptor}.pdbqt',
+                                     f'{ligand_file}.pdbqt',
+                                     os.path.join(out_dir, f'{receptor_name}_{ligand_name}.pdbqt'),
+                                     os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt'),
+                                     docking_cache_dir=docking_cache_dir)
+    await asyncio.to_thread(
+        vina.generate_html, outdir=out_dir,
+        html_name=f'{receptor_name}_{ligand_name}.html',
+        job_id=job_id,
+        protein_tertiary_structure_PDBQT_format_file=f'{receptor_name}.pdbqt',
+        compound_PDBQT_format_file=f'{ligand_name}.pdbqt',
+        autodock_vina_molecular_docking_result=f'{receptor_name}_{ligand_name}.pdbqt',
+        autodock_vina_molecular_docking_scoring_value=f'{receptor_name}_{ligand_name}.txt')
+    return result
+
+
+async def alphafold_openbabel_vina(receptor, ligand_file, format, out_dir, job_id=0,
+                                   structure_cache_dir=None, msa_store_dir=None,
+                                   docking_cache_dir=None, auto_box=False, on_event=None):
+    """
+    alphafold2_openbabel_vina.alphafold_openbabel_vina()的asyncio版本，参数相同
+    化合物转换与AlphaFold同时进行，受体准备好后各化合物的对接并发执行
+    :param on_event: AlphaFold进度事件回调
+    :return: [vina的supervise.StageResult, ...]，与化合物顺序相同
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    ligand_files = [ligand_file] if isinstance(ligand_file, str) else list(ligand_file)
+    _, receptor_name = os.path.split(receptor)
+    receptor_pdbqt = os.path.join(out_dir, f'{receptor_name}.pdbqt')
+
+    async def prepare_receptor():
+        await docker_service([f'{receptor}.fasta'], output_dir=out_dir,
+                             structure_cache_dir=structure_cache_dir,
+                             msa_store_dir=msa_store_dir, on_event=on_event)
+        steps = [asyncio.to_thread(alphafold2_openbabel_vina.pdb_to_pdbqt, receptor_name, out_dir)]
+        if auto_box:
+            steps.append(asyncio.to_thread(
+                pocket_finder.receptor_config,
+                os.path.join(out_dir, receptor_name, 'ranked_0.pdb'),
+                os.path.join(out_dir, f'{receptor_name}_config.txt')))
+        results = await _gather(*steps)
+        return results[1] if auto_box else '/tmp/autodock_vina/config.txt'
+
+    receptor_ready = asyncio.ensure_future(prepare_receptor())
+
+    async def dock(ligand):
+        _, ligand_name = os.path.split(ligand)
+        ligand_pdbqt = os.path.join(out_dir, f'{ligand_name}.pdbqt')
+        await openbabel(ligand, format, ligand_pdbqt)
+        config_file = await asyncio.shield(receptor_ready)
+        result = await autodock_vina_run(
+            receptor_pdbqt, ligand_pdbqt,
+            os.path.join(out_dir, f'{receptor_name}_{ligand_name}.pdbqt'),
+            os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt'),
+            docking_cache_dir=docking_cache_dir, config_file=config_file)
+        await asyncio.to_thread(
+            alphafold2_openbabel_vina.generate_html,
+            outdir=out_dir,
+            html_name=f'{receptor_name}_{ligand_name}.html',
+            job_id=job_id,
+            protein_tertiary_structure_file=os.path.join(receptor_name, 'ranked_0.pdb'),
+            protein_tertiary_structure_PDBQT_format_file=f'{receptor_name}.pdbqt',
+            compound_PDBQT_format_file=f'{ligand_name}.pdbqt',
+            autodock_vina_molecular_docking_result=f'{receptor_name}_{ligand_name}.pdbqt',
+            autodock_vina_molecular_docking_scoring_value=f'{receptor_name}_{ligand_name}.txt')
+        return result
+
+    try:
+        return await _gather(*(dock(ligand) for ligand in ligand_files))
+    finally:
+        if not receptor_ready.done():
+            receptor_ready.cancel()
+            await asyncio.gather(receptor_ready, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('receptor', type=str, help='the receptor file, absolute path without file extension, e.g. /tmp/alphafold/Y265H')
+    parser.add_argument('ligand', type=str, nargs='+', help='one or more ligand files, absolute path without file extension, e.g. /tmp/alphafold/1')
+    parser.add_argument('formate', type=str, help='the format of ligand file, e.g. mol2')
+    parser.add_argument('outdir', type=str, help='the dictionary of output files, e.g. /tmp/alphafold/Y265H_1')
+    parser.add_argument('--structure_cache_dir', type=str, default=None, help='directory of the persistent structure cache, e.g. /tmp/alphafold_cache')
+    parser.add_argument('--msa_store_dir', type=str, default=None, help='directory of the shared MSA store, e.g. /tmp/alphafold_msas')
+    parser.add_argument('--docking_cache_dir', type=str, default=None, help='directory of the docking result cache, e.g. /tmp/vina_cache')
+    parser.add_argument('--auto_box', action='store_true', help='dock into the pockets found on the predicted structure instead of the box in config.txt')
+    args = parser.parse_args()
+    asyncio.run(alphafold_openbabel_vina(args.receptor, args.ligand, args.formate, args.outdir,
+                                         structure_cache_dir=args.structure_cache_dir,
+                                         msa_store_dir=args.msa_store_dir,
+                                         docking_cache_dir=args.docking_cache_dir,
+                                         auto_box=args.auto_box))
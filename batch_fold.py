@@ -0,0 +1,193 @@
+import json
+import os
+import re
+
+from absl import logging
+
+import alphafold2
+import msa_store
+import supervise
+from fasta_utils import fasta_target_name, read_fasta, read_sequences, sequence_length, write_fasta
+
+
+# Upper bounds of the length buckets. Sequences of one bucket share a container,
+# so XLA compiles each distinct length once and the batch needs the memory of its longest member.
+DEFAULT_BUCKETS = (128, 256, 384, 512, 768, 1024, 1536, 2048)
+
+
+def _safe_name(description):
+    name = description.split()[0] if description.split() else 'sequence'
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)[:64]
+
+
+def split_fasta(fasta_path, fasta_dir):
+    """
+    把包含多条序列的fasta拆成每条序列一个文件，AlphaFold对每个文件单独输出一个目录
+    :param fasta_path: fasta文件路径，有后缀名
+    :param fasta_dir: 拆分后的fasta文件的存放路径
+    :return: 拆分后的fasta文件路径列表，只有一条序列时返回[fasta_path]
+    """
+    records = read_fasta(fasta_path)
+    if len(records) <= 1:
+        return [fasta_path]
+    paths = []
+    used = set()
+    for i, (description, sequence) in enumerate(records):
+        name = _safe_name(description)
+        if name in used:
+            name = f'{name}_{i}'
+        used.add(name)
+        path = os.path.join(fasta_dir, f'{name}.fasta')
+        write_fasta(path, [(description, sequence)])
+        paths.append(path)
+    return paths
+
+
+def bucket_index(length, buckets=DEFAULT_BUCKETS):
+    """:return: 第一个上界不小于length的桶的序号，比所有上界都长时为len(buckets)"""
+    for i, bound in enumerate(buckets):
+        if length <= bound:
+            return i
+    return len(buckets)
+
+
+def plan_batches(fasta_paths, buckets=DEFAULT_BUCKETS, max_batch=32):
+    """
+    按序列长度分桶，桶内按长度排序，每个批次最多max_batch条序列
+    :param fasta_paths: 每个文件一个预测目标
+    :param max_batch: 一个容器中预测的最多序列数，限制一次失败影响的范围
+    :return: [[(target, fasta_path, length), ...], ...]，短序列的批次在前
+    """
+    targets = {}
+    for fasta_path in fasta_paths:
+        target = fasta_target_name(fasta_path)
+        if target in targets:
+            raise ValueError(f'{fasta_path} and {targets[target][1]} would both write '
+                             f'{target}/ under the output directory')
+        targets[target] = (target, fasta_path, sequence_length(fasta_path))
+    grouped = {}
+    for entry in targets.values():
+        grouped.setdefault(bucket_index(entry[2], buckets), []).append(entry)
+    batches = []
+    for index in sorted(grouped):
+        members = sorted(grouped[index], key=lambda entry: (entry[2], entry[0]))
+        for start in range(0, len(members), max_batch):
+            batches.append(members[start:start + max_batch])
+    return batches
+
+
+def _fold_batch(batch, output_dir, **kwargs):
+    """
+    在一个容器中预测一个批次
+    AlphaFold按顺序预测fasta_paths，在第一个失败的序列处退出，所以记录它失败后用剩下的序列重新启动容器
+    :return: {target: 'ok' 或 'failed'}
+    """
+    status = {}
+    pending = list(batch)
+    while pending:
+        try:
+            alphafold2.docker_service([fasta_path for _, fasta_path, _ in pending],
+                                      output_dir=output_dir, **kwargs)
+        except supervise.StageError as e:
+            logging.warning('Batch of %d sequences stopped early: %s', len(pending), e)
+        remaining = []
+        for entry in pending:
+            if os.path.exists(os.path.join(output_dir, entry[0], 'ranked_0.pdb')):
+                status[entry[0]] = 'ok'
+            else:
+                remaining.append(entry)
+        if not remaining:
+            break
+        failed = remaining[0]
+        logging.warning('AlphaFold failed on %s (%d residues)', failed[0], failed[2])
+        status[failed[0]] = 'failed'
+        pending = remaining[1:]
+    return status
+
+
+def _first_unsearched(batch, msa_store_dir, db_preset='full_dbs', max_substitutions=3):
+    """批次中第一条既没有已存储的MSA、也找不到可以派生MSA的亲本的单链序列"""
+    for entry in batch:
+        sequences = read_sequences(entry[1])
+        if len(sequences) != 1:
+            continue
+        if msa_store.has_msas(msa_store_dir, msa_store.msa_key(entry[1], db_preset)):
+            continue
+        if msa_store.find_parent(msa_store_dir, sequences[0], db_preset, max_substitutions) is None:
+            return entry
+    return None
+
+
+def batch_fold(fasta_paths, output_dir, fasta_dir=None, buckets=DEFAULT_BUCKETS, max_batch=32,
+               model_preset='monomer', **kwargs):
+    """
+    把大量序列按长度分桶后合并到少数几个AlphaFold容器中预测，分摊容器启动、模型加载和XLA编译
+    每条序列的结果仍然写到 f'{output_dir}/{target}/'，与单独预测时相同
+    :param fasta_paths: fasta文件路径列表，有后缀名；monomer预设下包含多条序列的文件被拆成每条序列一个目标
+    :param output_dir: 输出的路径
+    :param fasta_dir: 拆分后的fasta文件的存放路径，默认为 f'{output_dir}/fasta'
+    :param buckets: 长度桶的上界
+    :param max_batch: 一个容器中预测的最多序列数
+    :param model_preset: multimer预设下一个fasta文件是一个复合物，不拆分
+    其余参数传给alphafold2.docker_service()；同时给出msa_store_dir和max_substitutions时，
+    每个批次先单独预测一条找不到亲本的序列，其余的点突变体从它的MSA派生
+    :return: {target: 'ok' 或 'failed'}，同时写入 f'{output_dir}/batch_fold.json'
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    fasta_dir = fasta_dir or os.path.join(output_dir, 'fasta')
+    targets = []
+    for fasta_path in fasta_paths:
+        if model_preset == 'multimer':
+            targets.append(fasta_path)
+        else:
+            targets.extend(split_fasta(fasta_path, fasta_dir))
+
+    batches = plan_batches(targets, buckets, max_batch)
+    logging.info('Folding %d sequences in %d containers', len(targets), len(batches))
+    status = {}
+    report = []
+    derive = (kwargs.get('msa_store_dir') and kwargs.get('max_substitutions')
+              and model_preset != 'multimer')
+    for batch in batches:
+        logging.info('Batch of %d sequences, %d-%d residues', len(batch), batch[0][2], batch[-1][2])
+        batch_status = {}
+        seed = derive and len(batch) > 1 and _first_unsearched(
+            batch, kwargs['msa_store_dir'], kwargs.get('db_preset', 'full_dbs'),
+            kwargs['max_substitutions'])
+        if seed:
+            # Searching one sequence first lets the mutants in the batch derive their MSAs from it.
+            logging.info('Searching MSAs of %s before the rest of its batch', seed[0])
+            batch_status.update(_fold_batch([seed], output_dir, model_preset=model_preset, **kwargs))
+        batch_status.update(_fold_batch([entry for entry in batch if entry is not seed], output_dir,
+                                        model_preset=model_preset, **kwargs))
+        status.update(batch_status)
+        report.append([{'target': target, 'fasta_path': fasta_path, 'length': length,
+                        'status': batch_status[target]} for target, fasta_path, length in batch])
+    with open(os.path.join(output_dir, 'batch_fold.json'), 'w') as f:
+        json.dump({'buckets': list(buckets), 'batches': report}, f, indent=2)
+    failed = sorted(target for target, state in status.items() if state != 'ok')
+    if failed:
+        logging.warning('%d of %d sequences failed: %s', len(failed), len(status), ', '.join(failed))
+    return status
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fasta_paths', type=str, nargs='+', help='fasta files to fold, files with several sequences are split, e.g. /tmp/alphafold/mutants.fasta')
+    parser.add_argument('output_dir', type=str, help='the output_dir, one sub directory per sequence, e.g. /tmp/alphafold')
+    parser.add_argument('--max_batch', type=int, default=32, help='maximum number of sequences folded by one container')
+    parser.add_argument('--buckets', type=str, default=','.join(map(str, DEFAULT_BUCKETS)), help='comma separated upper bounds of the sequence length buckets')
+    parser.add_argument('--model_preset', type=str, default='monomer', help='AlphaFold model preset, multimer keeps each fasta file as one complex')
+    parser.add_argument('--structure_cache_dir', type=str, default=None, help='directory of the persistent structure cache, e.g. /tmp/alphafold_cache')
+    parser.add_argument('--msa_store_dir', type=str, default=None, help='directory of the shared MSA store, e.g. /tmp/alphafold_msas')
+    parser.add_argument('--db_scratch_dir', type=str, default=None, help='local disk directory to stage the search databases on, e.g. /scratch/af2_databases')
+    parser.add_argument('--max_substitutions', type=int, default=0, help='derive the MSAs of point mutants with up to this many substitutions from a parent in --msa_store_dir')
+    args = parser.parse_args()
+    batch_fold(args.fasta_paths, args.output_dir,
+               buckets=tuple(int(bound) for bound in args.buckets.split(',')),
+               max_batch=args.max_batch, model_preset=args.model_preset,
+               structure_cache_dir=args.structure_cache_dir,
+               msa_store_dir=args.msa_store_dir,
+               db_scratch_dir=args.db_scratch_dir,
+               max_substitutions=args.max_substitutions)
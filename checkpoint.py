@@ -0,0 +1,122 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+
+from absl import logging
+
+
+MANIFEST_NAME = 'manifest.json'
+
+_lock = threading.Lock()
+
+
+def file_digest(path):
+    """文件内容的sha256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _fingerprint(paths):
+    return {os.path.abspath(path): file_digest(path) if os.path.exists(path) else None
+            for path in paths}
+
+
+@contextlib.contextmanager
+def _locked(manifest_file):
+    # The thread lock covers stages of one process, flock other processes on the same job dir.
+    with _lock, open(f'{manifest_file}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load(manifest_file):
+    """:return: manifest dict，文件不存在时返回空的manifest"""
+    if not os.path.exists(manifest_file):
+        return {'stages': {}}
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def _save(manifest_file, manifest):
+    tmp_file = f'{manifest_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def is_complete(manifest_file, stage, inputs=(), outputs=(), params=None):
+    """
+    阶段是否已经完成且仍然有效：记录过、参数相同、输入文件内容没有变化、输出文件仍然存在且没有被改动
+    :param inputs: 阶段读取的文件
+    :param outputs: 阶段写出的文件
+    :param params: 影响结果的其他参数，可以json序列化
+    """
+    entry = load(manifest_file)['stages'].get(stage)
+    if entry is None or entry.get('params') != params:
+        return False
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+    return entry['inputs'] == _fingerprint(inputs) and entry['outputs'] == _fingerprint(outputs)
+
+
+def record(manifest_file, stage, inputs=(), outputs=(), params=None):
+    """把完成的阶段及其输入输出的哈希写入manifest"""
+    entry = {
+        'inputs': _fingerprint(inputs),
+        'outputs': _fingerprint(outputs),
+        'params': params,
+        'finished_at': time.time(),
+    }
+    with _locked(manifest_file):
+        manifest = load(manifest_file)
+        manifest['stages'][stage] = entry
+        _save(manifest_file, manifest)
+
+
+def invalidate(manifest_file, stage=None):
+    """删除一个阶段(stage为None时删除全部)的记录，下次运行时重新执行"""
+    with _locked(manifest_file):
+        manifest = load(manifest_file)
+        if stage is None:
+            manifest['stages'] = {}
+        else:
+            manifest['stages'].pop(stage, None)
+        _save(manifest_file, manifest)
+
+
+def checkpointed(manifest_file, stage, fn, inputs=(), outputs=(), params=None):
+    """
+    包装一个不带参数的阶段函数，已经完成且有效时跳过，完成后写入manifest
+    输入输出的哈希在阶段执行时才计算，可以直接用作pipeline_graph.run_stages()的阶段函数
+    :return: 不带参数的函数，跳过时返回None
+    """
+    def run():
+        if is_complete(manifest_file, stage, inputs, outputs, params):
+            logging.info('Stage %s is up to date in %s, skipping', stage, manifest_file)
+            return None
+        result = fn()
+        record(manifest_file, stage, inputs, outputs, params)
+        return result
+    return run
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('manifest_file', type=str, help='the manifest of a job directory, e.g. /tmp/alphafold/Y265H_1/manifest.json')
+    parser.add_argument('--invalidate', type=str, default=None, help='forget this stage so the next run repeats it, "all" forgets every stage')
+    args = parser.parse_args()
+    if args.invalidate:
+        invalidate(args.manifest_file, None if args.invalidate == 'all' else args.invalidate)
+    for name, entry in sorted(load(args.manifest_file)['stages'].items(), key=lambda item: item[1]['finished_at']):
+        print(f'{name}\t{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["finished_at"]))}')
@@ -0,0 +1,258 @@
+import collections
+import json
+import os
+import subprocess
+import threading
+
+from absl import logging
+import numpy as np
+
+from alphafold_progress import num_models
+
+
+# peak_memory is host memory of the container (mostly the MSA tools) and only used for
+# co-scheduling, device_memory is GPU memory of the model and decides the XLA settings.
+Estimate = collections.namedtuple('Estimate', ['msa_seconds', 'inference_seconds', 'peak_memory',
+                                               'device_memory'])
+
+DEFAULT_RUNS_FILE = os.path.expanduser('~/.alphafold_runs.jsonl')
+# Fewer recorded runs than this for a preset fall back to the priors below.
+MIN_RUNS = 3
+_REFERENCE_LENGTH = 400.0
+# Rough monomer/full_dbs numbers as (seconds or bytes at 400 residues, exponent of the length),
+# only used until a preset has recorded runs of its own. device_memory has no prior: until it
+# was measured the XLA settings stay at the safe defaults with unified memory.
+_PRIORS = {
+    'msa_seconds': (1800.0, 0.5),
+    'inference_seconds': (300.0, 2.0),
+    'peak_memory': (10 * 2 ** 30, 1.5),
+}
+# Allocation limit of a job that fits on the GPU. docker_service() turns preallocation off, so
+# the limit is not taken up front and two small jobs can share a GPU.
+_MIN_MEMORY_FRACTION = 0.2
+# A measured peak above this share of the GPU may have spilled into unified (host) memory,
+# which nvidia-smi does not count, so it says nothing about what the job needs.
+_MAX_DEVICE_FRACTION = 0.9
+_HEADROOM = 1.25
+
+_lock = threading.Lock()
+
+
+def run_costs(summary):
+    """
+    从alphafold_progress.summarize()的汇总中取出MSA耗时和推理耗时
+    优先使用AlphaFold自己写出的timings.json，其中features是MSA和模板搜索的耗时
+    :return: (msa_seconds, inference_seconds)
+    """
+    timings = summary.get('alphafold_timings')
+    if timings:
+        msa_seconds = timings.get('features', 0.0)
+        return msa_seconds, sum(v for k, v in timings.items() if k != 'features')
+    msa_seconds = (sum(summary['msa_search_seconds'].values())
+                   + sum(summary['template_search_seconds'].values()))
+    return msa_seconds, sum(summary['model_seconds'].values()) + summary['relax_seconds']
+
+
+def record_run(runs_file, length, db_preset, model_preset, msa_seconds, inference_seconds,
+               peak_memory=None, precomputed_msas=False, device_memory=None):
+    """
+    记录一次AlphaFold预测的耗时和内存，用于拟合cost model
+    :param length: 序列长度(所有链的残基数之和)
+    :param peak_memory: 容器的峰值主机内存(bytes)，未知时为None
+    :param device_memory: 容器进程的峰值GPU显存(bytes)，未知时为None
+    :param precomputed_msas: 使用了已有的MSA时MSA耗时不能用于拟合
+    """
+    line = json.dumps({
+        'length': length,
+        'db_preset': db_preset,
+        'model_preset': model_preset,
+        'msa_seconds': None if precomputed_msas else msa_seconds,
+        'inference_seconds': inference_seconds,
+        'peak_memory': peak_memory,
+        'device_memory': device_memory,
+    }) + '\n'
+    with _lock:
+        fd = os.open(runs_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+def load_runs(runs_file=DEFAULT_RUNS_FILE):
+    runs = []
+    if os.path.exists(runs_file):
+        with open(runs_file, 'r') as f:
+            for line in f:
+                if line.strip():
+                    runs.append(json.loads(line))
+    return runs
+
+
+def _fit_power_law(lengths, values):
+    """最小二乘拟合 value = a * (length / 400) ** b，返回 (a, b)"""
+    x = np.log(np.asarray(lengths, dtype=float) / _REFERENCE_LENGTH)
+    y = np.log(np.asarray(values, dtype=float))
+    if np.ptp(x) < 1e-6:
+        # A single length pins the scale but not the exponent.
+        return float(np.exp(y.mean())), None
+    b, log_a = np.polyfit(x, y, 1)
+    return float(np.exp(log_a)), float(np.clip(b, 0.0, 3.0))
+
+
+def _prior(field, db_preset, model_preset):
+    if field not in _PRIORS:
+        return None, None
+    a, b = _PRIORS[field]
+    if field == 'msa_seconds' and db_preset == 'reduced_dbs':
+        a /= 3
+    if field == 'inference_seconds':
+        a *= num_models(model_preset) / num_models('monomer')
+    return a, b
+
+
+def fit(runs, db_preset='full_dbs', model_preset='monomer'):
+    """
+    对一个预设拟合各项成本与序列长度的幂律关系
+    :return: {field: (a, b)}，field为Estimate的字段，没有先验也没有足够记录的字段为None
+    """
+    model = {}
+    for field in Estimate._fields:
+        points = [(run['length'], run[field]) for run in runs
+                  if run['db_preset'] == db_preset and run['model_preset'] == model_preset
+                  and run.get(field) and run['length'] > 0]
+        a, b = _prior(field, db_preset, model_preset)
+        if len(points) >= MIN_RUNS:
+            fitted_a, fitted_b = _fit_power_law(*zip(*points))
+            if fitted_b is None:
+                # A single measured length keeps the prior exponent, or the one of host memory
+                # for device memory, which has no prior.
+                fitted_b = b if b is not None else _PRIORS['peak_memory'][1]
+            a, b = fitted_a, fitted_b
+        model[field] = None if a is None else (a, b)
+    return model
+
+
+def predict(length, db_preset='full_dbs', model_preset='monomer', runs_file=DEFAULT_RUNS_FILE,
+            runs=None):
+    """
+    预测一次AlphaFold预测的MSA耗时、推理耗时和峰值内存
+    :param length: 序列长度
+    :param runs: 已读取的记录，为None时读取runs_file
+    :return: Estimate，device_memory在记录不足时为None
+    """
+    model = fit(load_runs(runs_file) if runs is None else runs, db_preset, model_preset)
+    scale = max(length, 1) / _REFERENCE_LENGTH
+    return Estimate(*(None if model[field] is None else model[field][0] * scale ** model[field][1]
+                      for field in Estimate._fields))
+
+
+def gpu_memory():
+    """第一块GPU的显存(bytes)，没有nvidia-smi时返回None"""
+    try:
+        output = subprocess.run(
+            ['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, timeout=30).stdout
+        return int(output.split()[0]) * 2 ** 20
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return None
+
+
+def memory_environment(device_peak, device_memory=None):
+    """
+    根据预测的峰值显存选择JAX的显存设置
+    能放进显存的任务不使用统一内存，显存上限只取需要的部分；
+    放不下或不知道能否放下的任务保持默认的 TF_FORCE_UNIFIED_MEMORY=1 和 XLA_PYTHON_CLIENT_MEM_FRACTION=4.0，
+    统一内存的上限从不降低
+    :param device_peak: 预测的峰值显存(bytes)，即Estimate.device_memory，不能用主机内存代替
+    :param device_memory: GPU显存(bytes)
+    两者任一为None时不修改默认设置
+    :return: 传给docker_service()的environment
+    """
+    if not device_memory or not device_peak:
+        return {}
+    fraction = device_peak * _HEADROOM / device_memory
+    if fraction > _MAX_DEVICE_FRACTION:
+        return {}
+    return {'TF_FORCE_UNIFIED_MEMORY': '0',
+            'XLA_PYTHON_CLIENT_MEM_FRACTION': f'{max(fraction, _MIN_MEMORY_FRACTION):.2f}'}
+
+
+def container_gpu_memory(container):
+    """容器中的进程当前占用的GPU显存之和(bytes)，取不到时返回None"""
+    top = container.top()
+    pid_column = top['Titles'].index('PID')
+    pids = {int(row[pid_column]) for row in top['Processes']}
+    try:
+        output = subprocess.run(
+            ['nvidia-smi', '--query-compute-apps=pid,used_memory', '--format=csv,noheader,nounits'],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError):
+        return None
+    used = 0
+    for line in output.decode('utf-8').splitlines():
+        fields = [field.strip() for field in line.split(',')]
+        if len(fields) == 2 and fields[0].isdigit() and int(fields[0]) in pids and fields[1].isdigit():
+            used += int(fields[1]) * 2 ** 20
+    return used
+
+
+def sample_peak_memory(container, interval=15.0, measure_device=True):
+    """
+    在后台线程中定期读取容器的主机内存用量和容器进程的GPU显存用量
+    :param measure_device: 容器中的JAX没有预分配显存(XLA_PYTHON_CLIENT_PREALLOCATE=false)，
+    为False时显存用量只是预分配的大小，不返回峰值显存
+    :return: 停止采样的函数，调用后返回 (峰值主机内存, 峰值显存)(bytes)，没有采到的为None；
+    峰值显存接近GPU容量时可能已经溢出到统一内存，也返回None
+    """
+    stop = threading.Event()
+    peak = [None, None]
+
+    def sample():
+        while True:
+            try:
+                usage = container.stats(stream=False).get('memory_stats', {})
+                value = usage.get('max_usage') or usage.get('usage')
+                if value:
+                    peak[0] = max(peak[0] or 0, value)
+                value = container_gpu_memory(container)
+                if value:
+                    peak[1] = max(peak[1] or 0, value)
+            except Exception as e:  # pylint: disable=broad-except
+                # The container may exit between two samples.
+                logging.debug('Could not read memory of container %s: %s', container.id, e)
+            if stop.wait(interval):
+                return
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+
+    def finish():
+        stop.set()
+        thread.join()
+        host_peak, device_peak = peak
+        if device_peak is not None:
+            total = gpu_memory()
+            if not measure_device or not total or device_peak >= _MAX_DEVICE_FRACTION * total:
+                device_peak = None
+        return host_peak, device_peak
+
+    return finish
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('lengths', type=int, nargs='+', help='sequence lengths to predict, e.g. 265 512')
+    parser.add_argument('--db_preset', type=str, default='full_dbs', help='AlphaFold db_preset')
+    parser.add_argument('--model_preset', type=str, default='monomer', help='AlphaFold model_preset')
+    parser.add_argument('--runs_file', type=str, default=DEFAULT_RUNS_FILE, help='the recorded runs, written by docker_service()')
+    args = parser.parse_args()
+    runs = load_runs(args.runs_file)
+    device_memory = gpu_memory()
+    for length in args.lengths:
+        estimate = predict(length, args.db_preset, args.model_preset, runs=runs)
+        device_peak = 'unknown' if estimate.device_memory is None else f'{estimate.device_memory / 2 ** 30:.1f}GB'
+        print(f'{length}\tmsa {estimate.msa_seconds:.0f}s\tinference {estimate.inference_seconds:.0f}s\t'
+              f'host {estimate.peak_memory / 2 ** 30:.1f}GB\tdevice {device_peak}\t'
+              f'{memory_environment(estimate.device_memory, device_memory)}')
@@ -0,0 +1,341 @@
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from absl import logging
+
+
+# Databases streamed by jackhmmer/hhblits/hhsearch/hmmsearch. data_dir only holds the
+# model parameters, read once per container, and the template mmCIF files are read a
+# few at a time, so both stay on the shared filesystem.
+STAGED_DATABASES = (
+    'uniref90_database_path',
+    'mgnify_database_path',
+    'bfd_database_path',
+    'uniclust30_database_path',
+    'small_bfd_database_path',
+    'pdb70_database_path',
+    'uniprot_database_path',
+    'pdb_seqres_database_path',
+)
+# Free space left on the scratch disk for everything else, e.g. job outputs.
+DEFAULT_RESERVE_BYTES = 50 * 1024 ** 3
+
+_MANIFEST = 'staging.json'
+_LEASES = '.leases'
+
+
+def _source_dir(path):
+    """_create_mount()挂载的目录：目录本身，或文件/数据库前缀所在的目录"""
+    return path if os.path.isdir(path) else os.path.dirname(path)
+
+
+def _staged_dir(scratch_dir, source_dir):
+    key = hashlib.sha256(os.path.abspath(source_dir).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(scratch_dir, f'{os.path.basename(os.path.normpath(source_dir))}-{key}')
+
+
+def _list_files(source_dir):
+    """:return: {相对路径: [size, mtime]}"""
+    files = {}
+    for root, _, names in os.walk(source_dir):
+        for name in names:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            files[os.path.relpath(path, source_dir)] = [stat.st_size, int(stat.st_mtime)]
+    return files
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 24), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_manifest(staged_dir):
+    with open(os.path.join(staged_dir, _MANIFEST), 'r') as f:
+        return json.load(f)
+
+
+def _write_manifest(staged_dir, manifest):
+    tmp_file = os.path.join(staged_dir, f'.{_MANIFEST}.{uuid.uuid4().hex}')
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_file, os.path.join(staged_dir, _MANIFEST))
+
+
+@contextlib.contextmanager
+def _try_lock(scratch_dir, name):
+    """不等待的文件锁，另一个进程持有时返回False"""
+    with open(os.path.join(scratch_dir, f'.{name}.lock'), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def is_valid(staged_dir, source_dir):
+    """
+    本地副本是否完整且与源一致：manifest存在、每个文件的大小与manifest相同、源文件的大小和修改时间没有变化
+    只比较文件属性，不读取内容；内容校验见verify()
+    """
+    try:
+        manifest = _read_manifest(staged_dir)
+    except (OSError, ValueError):
+        return False
+    if manifest['source'] != os.path.abspath(source_dir):
+        return False
+    for rel, (size, _) in manifest['files'].items():
+        path = os.path.join(staged_dir, rel)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            return False
+    try:
+        # An updated database on the shared filesystem makes the copy stale.
+        return _list_files(source_dir) == manifest['files']
+    except OSError:
+        # The shared filesystem is unreachable, the local copy is all there is.
+        return True
+
+
+def entries(scratch_dir):
+    """:return: 所有本地副本的manifest，带有path字段"""
+    result = []
+    for manifest_file in glob.glob(os.path.join(scratch_dir, '*', _MANIFEST)):
+        try:
+            manifest = _read_manifest(os.path.dirname(manifest_file))
+        except (OSError, ValueError):
+            continue
+        manifest['path'] = os.path.dirname(manifest_file)
+        result.append(manifest)
+    return result
+
+
+def _lease_dir(staged_dir):
+    return os.path.join(os.path.dirname(staged_dir), _LEASES, os.path.basename(staged_dir))
+
+
+def _in_use(staged_dir):
+    """有存活进程的租约时返回True，顺便清理已退出进程留下的租约"""
+    in_use = False
+    for lease in glob.glob(os.path.join(_lease_dir(staged_dir), '*')):
+        pid = int(os.path.basename(lease).split('-', 1)[0])
+        try:
+            os.kill(pid, 0)
+            in_use = True
+        except ProcessLookupError:
+            os.remove(lease)
+        except PermissionError:
+            in_use = True
+    return in_use
+
+
+def _take_lease(staged_dir, source_dir):
+    """
+    登记租约后再确认副本有效，无效时撤销租约；调用者必须持有该副本的_try_lock()锁，
+    _make_room()只在持有同一把锁时检查租约并删除副本，所以租约登记后副本不会被淘汰
+    :return: 租约文件，副本无效时返回None
+    """
+    lease = os.path.join(_lease_dir(staged_dir), f'{os.getpid()}-{uuid.uuid4().hex}')
+    os.makedirs(os.path.dirname(lease), exist_ok=True)
+    open(lease, 'w').close()
+    if is_valid(staged_dir, source_dir):
+        return lease
+    os.remove(lease)
+    return None
+
+
+def _make_room(scratch_dir, size, max_bytes=None, reserve_bytes=DEFAULT_RESERVE_BYTES, protect=()):
+    """按最近最少使用淘汰本地副本，直到能放下size字节；正在使用和protect中的副本不淘汰"""
+    candidates = sorted((e for e in entries(scratch_dir) if e['path'] not in protect),
+                        key=lambda e: e['last_used'])
+    used = sum(e['size'] for e in entries(scratch_dir))
+    while True:
+        free = shutil.disk_usage(scratch_dir).free
+        if free - size >= reserve_bytes and (max_bytes is None or used + size <= max_bytes):
+            return True
+        if not candidates:
+            return False
+        entry = candidates.pop(0)
+        # Leases are taken under the same lock, so no job starts using the copy while it is removed.
+        with _try_lock(scratch_dir, os.path.basename(entry['path'])) as locked:
+            if not locked or _in_use(entry['path']):
+                continue
+            shutil.rmtree(entry['path'], ignore_errors=True)
+        used -= entry['size']
+        logging.info('Evicted staged database %s (%.1f GB)', entry['source'], entry['size'] / 1024 ** 3)
+
+
+def stage_database(scratch_dir, source_dir, checksum=False, max_bytes=None,
+                   reserve_bytes=DEFAULT_RESERVE_BYTES, protect=()):
+    """
+    把一个数据库目录复制到本地scratch目录，复制到临时目录并校验后再改名，其他进程不会看到一半的副本
+    :param checksum: 同时比较源和副本的sha256并写入manifest，数据库很大时很慢
+    :param max_bytes: scratch目录中本地副本的总大小上限，为None时只受磁盘剩余空间限制
+    :param reserve_bytes: 磁盘上保留的剩余空间
+    :param protect: 不能淘汰的副本目录
+    :return: (本地副本目录, 租约文件)，租约在持有锁时登记；空间不足或另一个进程正在复制时返回(None, None)
+    """
+    os.makedirs(scratch_dir, exist_ok=True)
+    staged_dir = _staged_dir(scratch_dir, source_dir)
+    name = os.path.basename(staged_dir)
+    with _try_lock(scratch_dir, name) as locked:
+        if not locked:
+            logging.info('%s is being staged by another process, reading it from %s',
+                         name, source_dir)
+            return None, None
+        lease = _take_lease(staged_dir, source_dir)
+        if lease is not None:
+            return staged_dir, lease
+        # Leftovers of a copy that was interrupted, nobody else can hold the lock.
+        for tmp_dir in glob.glob(os.path.join(scratch_dir, f'.{name}.*.tmp')):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if _in_use(staged_dir):
+            logging.warning('Staged copy %s is stale but still in use, reading %s', staged_dir, source_dir)
+            return None, None
+        shutil.rmtree(staged_dir, ignore_errors=True)
+
+        files = _list_files(source_dir)
+        size = sum(size for size, _ in files.values())
+        if not _make_room(scratch_dir, size, max_bytes, reserve_bytes, set(protect) | {staged_dir}):
+            logging.warning('Not enough scratch space for %s (%.1f GB)', source_dir, size / 1024 ** 3)
+            return None, None
+        logging.info('Staging %s (%.1f GB) to %s', source_dir, size / 1024 ** 3, staged_dir)
+        start = time.monotonic()
+        tmp_dir = os.path.join(scratch_dir, f'.{name}.{uuid.uuid4().hex}.tmp')
+        shutil.copytree(source_dir, tmp_dir)
+        digests = {}
+        for rel, (file_size, _) in files.items():
+            path = os.path.join(tmp_dir, rel)
+            if os.path.getsize(path) != file_size:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                logging.warning('%s changed while it was copied, not staging it', source_dir)
+                return None, None
+            if checksum:
+                digests[rel] = _file_digest(path)
+                if digests[rel] != _file_digest(os.path.join(source_dir, rel)):
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    logging.warning('Checksum mismatch for %s, not staging it', rel)
+                    return None, None
+        now = time.time()
+        _write_manifest(tmp_dir, {'source': os.path.abspath(source_dir), 'files': files,
+                                  'sha256': digests or None, 'size': size,
+                                  'staged_at': now, 'last_used': now})
+        os.rename(tmp_dir, staged_dir)
+        logging.info('Staged %s in %.0fs', source_dir, time.monotonic() - start)
+        lease = _take_lease(staged_dir, source_dir)
+    return (staged_dir, lease) if lease is not None else (None, None)
+
+
+def acquire(scratch_dir, database_paths, databases=STAGED_DATABASES, stage=True, checksum=False,
+            max_bytes=None, reserve_bytes=DEFAULT_RESERVE_BYTES):
+    """
+    把docker_service()要挂载的数据库路径换成有效的本地副本，并登记租约，使用期间不会被淘汰
+    :param database_paths: alphafold2._database_paths()返回的 [(flag name, path), ...]
+    :param databases: 需要放到本地的flag name
+    :param stage: 为False时只使用已有的副本，不复制
+    :return: (替换后的database_paths, release)，容器结束后调用release()释放租约
+    """
+    os.makedirs(scratch_dir, exist_ok=True)
+    leases = []
+    staged_dirs = set()
+    result = []
+    for name, path in database_paths:
+        if name not in databases or not path:
+            result.append((name, path))
+            continue
+        source_dir = _source_dir(path)
+        staged_dir = _staged_dir(scratch_dir, source_dir)
+        if stage:
+            staged_dir, lease = stage_database(scratch_dir, source_dir, checksum, max_bytes,
+                                               reserve_bytes, protect=staged_dirs)
+        else:
+            with _try_lock(scratch_dir, os.path.basename(staged_dir)) as locked:
+                lease = _take_lease(staged_dir, source_dir) if locked else None
+        if lease is None:
+            result.append((name, path))
+            continue
+        leases.append(lease)
+        staged_dirs.add(staged_dir)
+        try:
+            manifest = _read_manifest(staged_dir)
+            manifest['last_used'] = time.time()
+            _write_manifest(staged_dir, manifest)
+        except (OSError, ValueError):
+            pass
+        local_path = staged_dir if os.path.isdir(path) else os.path.join(staged_dir, os.path.basename(path))
+        logging.info('Using staged %s: %s', name, local_path)
+        result.append((name, local_path))
+
+    def release():
+        for lease in leases:
+            if os.path.exists(lease):
+                os.remove(lease)
+
+    return result, release
+
+
+def verify(scratch_dir):
+    """
+    用manifest中的sha256重新校验本地副本的内容，删除损坏的副本
+    与_make_room()一样持有副本的锁才删除；正在复制或有租约(正在使用)的副本不删除，
+    正在使用的副本删去manifest，之后的任务不再使用它
+    :return: 被删除的副本目录列表
+    """
+    removed = []
+    for entry in entries(scratch_dir):
+        for rel, digest in (entry.get('sha256') or {}).items():
+            if _file_digest(os.path.join(entry['path'], rel)) == digest:
+                continue
+            with _try_lock(scratch_dir, os.path.basename(entry['path'])) as locked:
+                if not locked:
+                    logging.warning('%s is corrupted, but %s is being staged, not removing it',
+                                    rel, entry['path'])
+                elif _in_use(entry['path']):
+                    # Without its manifest the copy is no longer valid, new jobs read the source
+                    # and the next stage_database() replaces it once the running jobs are done.
+                    logging.warning('%s is corrupted, but %s is in use, not removing it',
+                                    rel, entry['path'])
+                    os.remove(os.path.join(entry['path'], _MANIFEST))
+                else:
+                    logging.warning('%s is corrupted, removing %s', rel, entry['path'])
+                    shutil.rmtree(entry['path'], ignore_errors=True)
+                    removed.append(entry['path'])
+            break
+    return removed
+
+
+if __name__ == '__main__':
+    import argparse
+    from alphafold2 import _database_paths
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scratch_dir', type=str, help='the local scratch directory, e.g. /scratch/af2_databases')
+    parser.add_argument('--data_dir', type=str, default='/mnt/nfs02/57t02/af2/download/', help='the AlphaFold download directory on the shared filesystem')
+    parser.add_argument('--db_preset', type=str, default='full_dbs', help='stage the databases of this db_preset')
+    parser.add_argument('--model_preset', type=str, default='monomer', help='stage the databases of this model_preset')
+    parser.add_argument('--max_gb', type=float, default=None, help='size limit of the staged databases, in GB')
+    parser.add_argument('--checksum', action='store_true', help='compare sha256 of every copied file with the source')
+    parser.add_argument('--verify', action='store_true', help='re-check the sha256 of staged copies and remove corrupted ones')
+    args = parser.parse_args()
+    if args.verify:
+        verify(args.scratch_dir)
+    else:
+        paths, release = acquire(args.scratch_dir,
+                                 _database_paths(args.data_dir, args.db_preset, args.model_preset),
+                                 checksum=args.checksum,
+                                 max_bytes=int(args.max_gb * 1024 ** 3) if args.max_gb else None)
+        release()
+        for name, path in paths:
+            print(f'{name}\t{path}')
@@ -0,0 +1,97 @@
+import functools
+import hashlib
+import os
+import shutil
+import subprocess
+import uuid
+
+from absl import logging
+
+
+_POSE_FILE = 'out.pdbqt'
+_LOG_FILE = 'log.txt'
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _config_digest(config_file):
+    # Ignore comments, blank lines and spacing so cosmetic edits still hit.
+    lines = []
+    with open(config_file, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                lines.append(' '.join(line.replace('=', ' = ').split()))
+    return hashlib.sha256('\n'.join(sorted(lines)).encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def vina_version(vina_binary):
+    """vina --version 的输出，取不到时使用可执行文件的哈希值"""
+    try:
+        process = subprocess.run([vina_binary, '--version'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT, timeout=60)
+        version = process.stdout.decode('utf-8', errors='replace').strip()
+        if process.returncode == 0 and version:
+            return version
+    except OSError:
+        pass
+    return _file_digest(vina_binary)
+
+
+def docking_key(receptor_file, ligand_file, config_file, vina_binary, extra_args=()):
+    """
+    以受体、化合物、vina配置和vina版本的内容哈希计算对接缓存键
+    :param extra_args: 会影响结果的额外命令行参数，例如 ('--exhaustiveness', '32')
+    :return: sha256 hex digest
+    """
+    digest = hashlib.sha256()
+    for part in (_file_digest(receptor_file), _file_digest(ligand_file),
+                 _config_digest(config_file), vina_version(vina_binary),
+                 ' '.join(str(arg) for arg in extra_args)):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def lookup(cache_dir, key, out_file, log_file):
+    """
+    缓存命中时把对接结果和打分值文件复制到out_file和log_file
+    :return: 命中返回True
+    """
+    entry_dir = _entry_dir(cache_dir, key)
+    if not os.path.exists(os.path.join(entry_dir, _LOG_FILE)):
+        return False
+    shutil.copyfile(os.path.join(entry_dir, _POSE_FILE), out_file)
+    shutil.copyfile(os.path.join(entry_dir, _LOG_FILE), log_file)
+    logging.info('Docking cache hit %s -> %s', key, log_file)
+    return True
+
+
+def store(cache_dir, key, out_file, log_file):
+    """把一次vina运行的结果写入缓存"""
+    entry_dir = _entry_dir(cache_dir, key)
+    if os.path.exists(entry_dir) or not os.path.exists(out_file):
+        return False
+    parent = os.path.dirname(entry_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = os.path.join(parent, f'.{key}.{uuid.uuid4().hex}')
+    os.makedirs(tmp_dir)
+    shutil.copyfile(out_file, os.path.join(tmp_dir, _POSE_FILE))
+    shutil.copyfile(log_file, os.path.join(tmp_dir, _LOG_FILE))
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    return True
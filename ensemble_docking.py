@@ -0,0 +1,189 @@
+import concurrent.futures
+import json
+import os
+import re
+
+from absl import logging
+import numpy as np
+
+import instrument
+import pocket_finder
+import receptor_prep
+import results_store
+import vina
+from supervise import StageError, StageResult
+
+
+# RT at 298 K in kcal/mol, the unit of vina affinities.
+RT = 0.593
+_RANKED = re.compile(r'^ranked_(\d+)\.pdb$')
+
+
+def mean_plddt(pdb_file):
+    """AlphaFold模型的平均pLDDT，取CA原子的B-factor列"""
+    atoms = receptor_prep.read_pdb(pdb_file)
+    ca = atoms['name'] == 'CA'
+    return float(np.mean(atoms['bfactor'][ca] if np.any(ca) else atoms['bfactor']))
+
+
+def ranked_models(model_dir, min_plddt=None, max_models=None):
+    """
+    AlphaFold输出目录中的ranked_*.pdb
+    :param min_plddt: 只保留平均pLDDT不低于这个值的模型，ranked_0总是保留
+    :param max_models: 最多保留的模型数
+    :return: [(模型名称, pdb文件, 平均pLDDT), ...]，按排名顺序
+    """
+    ranked = []
+    for name in os.listdir(model_dir):
+        match = _RANKED.match(name)
+        if match:
+            ranked.append((int(match.group(1)), name))
+    models = []
+    for rank, name in sorted(ranked):
+        pdb_file = os.path.join(model_dir, name)
+        plddt = mean_plddt(pdb_file)
+        if rank > 0 and min_plddt is not None and plddt < min_plddt:
+            logging.info('Leaving %s out of the ensemble, pLDDT %.1f < %.1f', name, plddt, min_plddt)
+            continue
+        models.append((name[:-len('.pdb')], pdb_file, plddt))
+    return models[:max_models] if max_models else models
+
+
+@instrument.instrumented('pdb_to_pdbqt')
+def _prepare_model(pdb_file, pdbqt_file, config_file=None, template_config='/tmp/autodock_vina/config.txt'):
+    receptor_prep.prepare_receptor(pdb_file, pdbqt_file)
+    if config_file is None:
+        return template_config
+    # The ranked models are not superposed, so each one gets a box around its own pocket.
+    return pocket_finder.receptor_config(pdb_file, config_file, template_config)
+
+
+def prepare_models(models, out_dir, receptor_name, auto_box=False,
+                   config_file='/tmp/autodock_vina/config.txt'):
+    """
+    每个模型只准备一次受体，所有化合物共用，各模型并行准备
+    :param models: ranked_models()的返回值
+    :return: {模型名称: (受体pdbqt文件, vina配置文件)}
+    """
+    receptors = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(models) or 1) as executor:
+        futures = {}
+        for model, pdb_file, _ in models:
+            pdbqt_file = os.path.join(out_dir, f'{receptor_name}_{model}.pdbqt')
+            model_config = os.path.join(out_dir, f'{receptor_name}_{model}_config.txt') if auto_box else None
+            futures[model] = (pdbqt_file, executor.submit(_prepare_model, pdb_file, pdbqt_file,
+                                                          model_config, config_file))
+        for model, (pdbqt_file, future) in futures.items():
+            receptors[model] = (pdbqt_file, future.result())
+    return receptors
+
+
+def aggregate(affinities, rt=RT):
+    """
+    汇总一个化合物在各模型上的最优结合能
+    :param affinities: {模型名称: 结合能(kcal/mol)}
+    :return: {'best', 'mean', 'boltzmann', 'models'}，boltzmann是以exp(-E/RT)为权重的平均结合能
+    """
+    energies = np.array(list(affinities.values()), dtype=float)
+    # Shift by the minimum so the exponentials cannot overflow.
+    weights = np.exp(-(energies - energies.min()) / rt)
+    return {
+        'best': float(energies.min()),
+        'mean': float(energies.mean()),
+        'boltzmann': float(np.sum(weights * energies) / np.sum(weights)),
+        'models': affinities,
+    }
+
+
+def ensemble_dock(receptor_name, ligands, out_dir, min_plddt=None, max_models=None,
+                  processes=None, cpu_per_vina=1, docking_cache_dir=None, auto_box=False,
+                  config_file='/tmp/autodock_vina/config.txt', results_db=None):
+    """
+    集合对接：每个化合物与AlphaFold的多个排名模型对接，(化合物, 模型)组合逐个分发到进程池，同时排队的组合数有上限
+    每个组合的结果以 f'{receptor_name}:{model}' 为受体名称写入结果库，
+    各化合物的汇总写入 f'{out_dir}/{receptor_name}_ensemble.json'
+    :param receptor_name: 受体名称，模型在 f'{out_dir}/{receptor_name}/ranked_*.pdb'
+    :param ligands: [(ligand_name, 化合物pdbqt文件), ...]，也可以是生成器
+    :param min_plddt: 平均pLDDT低于这个值的模型不参加对接
+    :param max_models: 最多使用的模型数
+    :param processes: 同时运行的vina数，默认为CPU核数除以cpu_per_vina
+    :param cpu_per_vina: 每个vina进程使用的CPU数
+    :param auto_box: 在每个模型上分别寻找口袋
+    :param results_db: 对接结果库，默认为 f'{out_dir}/results.sqlite'
+    :return: {ligand_name: aggregate()的返回值}，所有模型都失败的化合物不包含在内
+    """
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1) // cpu_per_vina)
+    models = ranked_models(os.path.join(out_dir, receptor_name), min_plddt, max_models)
+    if not models:
+        raise StageError(StageResult('ensemble', 1, 0.0, ''),
+                         f'no ranked model of {receptor_name} in {out_dir}')
+    receptors = prepare_models(models, out_dir, receptor_name, auto_box, config_file)
+    logging.info('Docking ligands against %d models of %s', len(models), receptor_name)
+
+    conn = results_store.open_store(results_db or os.path.join(out_dir, 'results.sqlite'))
+    affinities = {}
+
+    def collect(future):
+        ligand_name, model, prefix = futures.pop(future)
+        try:
+            future.result()
+        except StageError as e:
+            # A model the ligand cannot be docked into must not drop the others.
+            logging.warning('Skipping %s on %s: %s', ligand_name, model, e)
+            return
+        best = results_store.ingest(conn, f'{receptor_name}:{model}', ligand_name,
+                                    f'{prefix}.txt', f'{prefix}.pdbqt')
+        if best is not None:
+            affinities.setdefault(ligand_name, {})[model] = best
+
+    # Same bound as virtual_screening._dock_all(), large libraries are not queued up front.
+    max_in_flight = processes * 4
+    with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+        futures = {}
+        in_flight = set()
+        for ligand_name, ligand_pdbqt in ligands:
+            for model, (receptor_file, model_config) in receptors.items():
+                prefix = os.path.join(out_dir, f'{receptor_name}_{model}_{ligand_name}')
+                future = executor.submit(vina.autodock_vina_run, receptor_file, ligand_pdbqt,
+                                         f'{prefix}.pdbqt', f'{prefix}.txt', cpu=cpu_per_vina,
+                                         docking_cache_dir=docking_cache_dir,
+                                         config_file=model_config)
+                futures[future] = (ligand_name, model, prefix)
+                in_flight.add(future)
+                if len(in_flight) >= max_in_flight:
+                    done, in_flight = concurrent.futures.wait(
+                        in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        collect(future)
+        for future in concurrent.futures.as_completed(in_flight):
+            collect(future)
+    conn.close()
+
+    report = {ligand_name: aggregate(dict(sorted(scores.items())))
+              for ligand_name, scores in affinities.items()}
+    with open(os.path.join(out_dir, f'{receptor_name}_ensemble.json'), 'w') as f:
+        json.dump({'models': {model: plddt for model, _, plddt in models}, 'ligands': report},
+                  f, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('receptor_name', type=str, help='the AlphaFold target, its models are in outdir/receptor_name/ranked_*.pdb, e.g. Y265H')
+    parser.add_argument('ligands', type=str, nargs='+', help='ligand pdbqt files, e.g. /tmp/alphafold/Y265H_1/1.pdbqt')
+    parser.add_argument('outdir', type=str, help='the dictionary of output files, e.g. /tmp/alphafold/Y265H_1')
+    parser.add_argument('--min_plddt', type=float, default=None, help='leave models with a lower mean pLDDT out of the ensemble')
+    parser.add_argument('--max_models', type=int, default=None, help='dock against at most this many ranked models')
+    parser.add_argument('--cpu_per_vina', type=int, default=1, help='the --cpu value passed to each vina process')
+    parser.add_argument('--docking_cache_dir', type=str, default=None, help='directory of the docking result cache, e.g. /tmp/vina_cache')
+    parser.add_argument('--auto_box', action='store_true', help='dock into the pockets found on each model instead of the box in config.txt')
+    args = parser.parse_args()
+    ligands = [(os.path.splitext(os.path.basename(path))[0], path) for path in args.ligands]
+    for ligand_name, scores in ensemble_dock(args.receptor_name, ligands, args.outdir,
+                                             min_plddt=args.min_plddt, max_models=args.max_models,
+                                             cpu_per_vina=args.cpu_per_vina,
+                                             docking_cache_dir=args.docking_cache_dir,
+                                             auto_box=args.auto_box).items():
+        print(f'{ligand_name}\t{scores["best"]:.1f}\t{scores["mean"]:.1f}\t{scores["boltzmann"]:.1f}')
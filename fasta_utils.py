@@ -0,0 +1,64 @@
+import os
+import pathlib
+from typing import List, Tuple
+
+
+def read_fasta(fasta_path) -> List[Tuple[str, str]]:
+    """
+    读取fasta文件
+    :param fasta_path: fasta文件路径，有后缀名
+    :return: [(description, sequence), ...]
+    """
+    records = []
+    description = None
+    chunks = []
+    with open(fasta_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('>'):
+                if description is not None:
+                    records.append((description, ''.join(chunks)))
+                description = line[1:]
+                chunks = []
+            else:
+                chunks.append(line)
+    if description is not None:
+        records.append((description, ''.join(chunks)))
+    return records
+
+
+def normalize_sequence(sequence: str) -> str:
+    """Uppercase the sequence and drop whitespace and alignment gaps."""
+    return ''.join(sequence.split()).replace('-', '').replace('*', '').upper()
+
+
+def read_sequences(fasta_path) -> List[str]:
+    """Return the normalized sequences of a fasta file in file order."""
+    return [normalize_sequence(seq) for _, seq in read_fasta(fasta_path)]
+
+
+def fasta_target_name(fasta_path) -> str:
+    """Name of the directory AlphaFold creates under output_dir for this fasta."""
+    return pathlib.Path(fasta_path).stem
+
+
+def sequence_length(fasta_path) -> int:
+    """Total number of residues over all chains of a fasta file."""
+    return sum(len(seq) for seq in read_sequences(fasta_path))
+
+
+def write_fasta(fasta_path, records):
+    """
+    :param fasta_path: 输出fasta文件路径
+    :param records: [(description, sequence), ...]
+    """
+    out_dir = os.path.dirname(fasta_path)
+    if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    with open(fasta_path, 'w') as f:
+        for description, sequence in records:
+            f.write(f'>{description}\n')
+            for i in range(0, len(sequence), 60):
+                f.write(sequence[i:i + 60] + '\n')
@@ -0,0 +1,177 @@
+import collections
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+from absl import logging
+
+
+# Set by configure() and inherited by worker processes through the environment.
+TRACE_FILE_ENV = 'PIPELINE_TRACE_FILE'
+
+_lock = threading.Lock()
+# Resource usage of the child processes reaped inside the current instrumented stage.
+_children = threading.local()
+
+
+def configure(trace_file):
+    """
+    打开各阶段的耗时记录，之后每个被instrumented()包装的阶段结束时向trace_file追加一行json
+    :param trace_file: JSON lines格式的记录文件，为None时关闭记录
+    """
+    if trace_file:
+        os.environ[TRACE_FILE_ENV] = os.path.abspath(trace_file)
+    else:
+        os.environ.pop(TRACE_FILE_ENV, None)
+
+
+def _thread_usage():
+    # Per thread usage keeps in-process stages apart when the pipeline runs them in parallel.
+    return resource.getrusage(getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF))
+
+
+def add_child_usage(usage):
+    """supervise.run_command()对每个结束的子进程调用，计入当前线程正在执行的阶段"""
+    stack = getattr(_children, 'stack', None)
+    if stack:
+        stack[-1].append(usage)
+
+
+def _record(event):
+    trace_file = os.environ.get(TRACE_FILE_ENV)
+    if not trace_file:
+        return
+    line = json.dumps(event, sort_keys=True) + '\n'
+    # One write() per event on an O_APPEND file, so parallel processes do not interleave lines.
+    with _lock:
+        fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+
+
+def instrumented(stage):
+    """
+    记录一个阶段的耗时、CPU时间、子进程峰值内存、读写字节数和退出码
+    子进程的资源用量来自阶段内supervise.run_command()启动的所有进程
+    :param stage: 阶段名称，例如 'vina'
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not os.environ.get(TRACE_FILE_ENV):
+                return fn(*args, **kwargs)
+            started = time.time()
+            start = time.monotonic()
+            before = _thread_usage()
+            if not hasattr(_children, 'stack'):
+                _children.stack = []
+            children = []
+            _children.stack.append(children)
+            exit_status = 0
+            try:
+                result = fn(*args, **kwargs)
+                exit_status = getattr(result, 'returncode', 0)
+                return result
+            except BaseException as e:
+                # StageError carries the StageResult of the failed command.
+                exit_status = getattr(getattr(e, 'result', None), 'returncode', 0) or -1
+                raise
+            finally:
+                _children.stack.pop()
+                if _children.stack:
+                    _children.stack[-1].extend(children)
+                after = _thread_usage()
+                cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+                blocks_in = after.ru_inblock - before.ru_inblock
+                blocks_out = after.ru_oublock - before.ru_oublock
+                for usage in children:
+                    cpu += usage.ru_utime + usage.ru_stime
+                    blocks_in += usage.ru_inblock
+                    blocks_out += usage.ru_oublock
+                _record({
+                    'stage': stage,
+                    'function': fn.__name__,
+                    'start': started,
+                    'wall_seconds': time.monotonic() - start,
+                    'cpu_seconds': cpu,
+                    'child_processes': len(children),
+                    # ru_maxrss is in KB on Linux.
+                    'child_max_rss_bytes': max((u.ru_maxrss for u in children), default=0) * 1024,
+                    # ru_inblock/ru_oublock count 512 byte blocks of filesystem I/O.
+                    'read_bytes': blocks_in * 512,
+                    'write_bytes': blocks_out * 512,
+                    'exit_status': exit_status,
+                    'pid': os.getpid(),
+                })
+        return wrapper
+    return decorator
+
+
+def read_trace(trace_file):
+    """:return: trace_file中的所有记录"""
+    events = []
+    with open(trace_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{k}="{v}"' for k, v in sorted(labels.items())) + '}'
+
+
+def write_prometheus(trace_file, prom_file, prefix='valphafold'):
+    """
+    把记录汇总成Prometheus文本格式，可以交给node_exporter的textfile collector
+    :param trace_file: configure()使用的记录文件
+    :param prom_file: 输出的.prom文件，先写临时文件再改名
+    """
+    runs = collections.Counter()
+    sums = collections.defaultdict(lambda: collections.defaultdict(float))
+    max_rss = collections.defaultdict(int)
+    for event in read_trace(trace_file):
+        stage = event['stage']
+        runs[(stage, str(event['exit_status']))] += 1
+        for field in ('wall_seconds', 'cpu_seconds', 'read_bytes', 'write_bytes'):
+            sums[field][stage] += event[field]
+        max_rss[stage] = max(max_rss[stage], event['child_max_rss_bytes'])
+
+    lines = [f'# HELP {prefix}_stage_runs_total Number of finished stage runs by exit status.',
+             f'# TYPE {prefix}_stage_runs_total counter']
+    for (stage, status), count in sorted(runs.items()):
+        lines.append(f'{prefix}_stage_runs_total{_labels(stage=stage, exit_status=status)} {count}')
+    for field, help_text in (('wall_seconds', 'Wall clock time spent in the stage.'),
+                             ('cpu_seconds', 'CPU time of the stage and its child processes.'),
+                             ('read_bytes', 'Bytes read from the filesystem.'),
+                             ('write_bytes', 'Bytes written to the filesystem.')):
+        name = f'{prefix}_stage_{field}_total'
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for stage, value in sorted(sums[field].items()):
+            lines.append(f'{name}{_labels(stage=stage)} {value:.6g}')
+    name = f'{prefix}_stage_child_max_rss_bytes'
+    lines += [f'# HELP {name} Peak resident set size of a child process of the stage.',
+              f'# TYPE {name} gauge']
+    for stage, value in sorted(max_rss.items()):
+        lines.append(f'{name}{_labels(stage=stage)} {value}')
+
+    tmp_file = f'{prom_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_file, prom_file)
+    logging.info('Wrote metrics of %d stage runs to %s', sum(runs.values()), prom_file)
+    return prom_file
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('trace_file', type=str, help='the JSON lines trace, e.g. /tmp/alphafold/trace.jsonl')
+    parser.add_argument('prom_file', type=str, help='the Prometheus text file to write, e.g. /tmp/alphafold/metrics.prom')
+    args = parser.parse_args()
+    write_prometheus(args.trace_file, args.prom_file)
@@ -0,0 +1,622 @@
+import http.server
+import json
+import os
+import re
+import signal
+import socketserver
+import sqlite3
+import threading
+import time
+import traceback
+
+from absl import logging
+import docker
+
+import alphafold2
+import alphafold2_openbabel_vina
+import cost_model
+import pocket_finder
+import supervise
+import vina
+import vina_scheduler
+import virtual_screening
+from fasta_utils import fasta_target_name, sequence_length
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    pool TEXT NOT NULL,
+    params TEXT NOT NULL,
+    state TEXT NOT NULL,
+    after INTEGER REFERENCES jobs (id),
+    request_key TEXT UNIQUE,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    result TEXT,
+    error TEXT,
+    submitted_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    expected_seconds REAL,
+    expected_memory REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_pool_state ON jobs (pool, state, id);
+"""
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+# A job that keeps taking the server down with it is given up after this many starts.
+MAX_ATTEMPTS = 3
+# Pools whose jobs are started shortest expected runtime first instead of in arrival order.
+SJF_POOLS = ('gpu',)
+# Every second a job waits counts as this many seconds less of expected runtime, so long
+# folds are not starved by a stream of short ones.
+AGING = 1.0
+
+
+class QueueFull(RuntimeError):
+    """Raised when a pool already has its admission limit of queued jobs."""
+
+
+# AlphaFold containers of running fold jobs, killed on shutdown: they are not child processes
+# and would otherwise keep writing to output directories whose jobs recover() re-queues.
+_containers = {}
+_containers_lock = threading.Lock()
+# Docker label with the job id, finds the containers left running by a server that was killed.
+_JOB_LABEL = 'job_server.job_id'
+
+
+def _run_fold(job_id, fasta_path, output_dir, structure_cache_dir=None, msa_store_dir=None,
+              prepare_receptor=False, auto_box=False, db_scratch_dir=None, max_substitutions=0):
+    estimate = cost_model.predict(sequence_length(fasta_path))
+
+    def on_container(container):
+        with _containers_lock:
+            _containers[job_id] = container
+
+    try:
+        result = alphafold2.docker_service([fasta_path], output_dir=output_dir,
+                                           structure_cache_dir=structure_cache_dir,
+                                           msa_store_dir=msa_store_dir,
+                                           db_scratch_dir=db_scratch_dir,
+                                           max_substitutions=max_substitutions,
+                                           environment=cost_model.memory_environment(
+                                               estimate.device_memory, cost_model.gpu_memory()),
+                                           on_container=on_container,
+                                           labels={_JOB_LABEL: str(job_id)})
+    finally:
+        with _containers_lock:
+            _containers.pop(job_id, None)
+    receptor_name = fasta_target_name(fasta_path)
+    alphafold2.generate_html(outdir=output_dir, html_name=f'{receptor_name}_alphafold.html',
+                             job_id=job_id,
+                             protein_tertiary_structure_file=os.path.join(receptor_name, 'ranked_0.pdb'))
+    if prepare_receptor:
+        # Receptor preparation is cheap, doing it here keeps the dependent dock jobs independent.
+        alphafold2_openbabel_vina.pdb_to_pdbqt(receptor_name, output_dir)
+        if auto_box:
+            pocket_finder.receptor_config(os.path.join(output_dir, receptor_name, 'ranked_0.pdb'),
+                                          os.path.join(output_dir, f'{receptor_name}_config.txt'))
+    return {'returncode': result.returncode, 'wall_time': result.wall_time}
+
+
+def _run_dock(job_id, receptor, ligand_file, format, out_dir, docking_cache_dir=None, cpu=None):
+    vina.openbabel_vina(receptor, ligand_file, format, out_dir, job_id=job_id,
+                        docking_cache_dir=docking_cache_dir, cpu=cpu)
+    return {}
+
+
+def _run_dock_predicted(job_id, receptor_name, ligand_file, format, out_dir,
+                        docking_cache_dir=None, auto_box=False, cpu=None):
+    _, ligand_name = os.path.split(ligand_file)
+    ligand_pdbqt = os.path.join(out_dir, f'{ligand_name}.pdbqt')
+    config_file = '/tmp/autodock_vina/config.txt'
+    if auto_box:
+        config_file = os.path.join(out_dir, f'{receptor_name}_config.txt')
+    alphafold2_openbabel_vina.openbabel(ligand_file, format, ligand_pdbqt)
+    result = vina.autodock_vina_run(
+        os.path.join(out_dir, f'{receptor_name}.pdbqt'), ligand_pdbqt,
+        os.path.join(out_dir, f'{receptor_name}_{ligand_name}.pdbqt'),
+        os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt'),
+        cpu=cpu, docking_cache_dir=docking_cache_dir, config_file=config_file)
+    alphafold2_openbabel_vina.generate_html(
+        outdir=out_dir,
+        html_name=f'{receptor_name}_{ligand_name}.html',
+        job_id=job_id,
+        protein_tertiary_structure_file=os.path.join(receptor_name, 'ranked_0.pdb'),
+        protein_tertiary_structure_PDBQT_format_file=f'{receptor_name}.pdbqt',
+        compound_PDBQT_format_file=f'{ligand_name}.pdbqt',
+        autodock_vina_molecular_docking_result=f'{receptor_name}_{ligand_name}.pdbqt',
+        autodock_vina_molecular_docking_scoring_value=f'{receptor_name}_{ligand_name}.txt')
+    return {'returncode': result.returncode, 'wall_time': result.wall_time}
+
+
+def _run_screen(job_id, receptor, ligand_path, format, out_dir, cpu=None, **kwargs):
+    if cpu:
+        # A screen occupies one slot of the CPU pool, so it only gets that slot's cores.
+        kwargs.setdefault('max_cores', cpu)
+        kwargs.setdefault('processes', max(1, cpu // kwargs.get('cpu_per_vina', 1)))
+    results = virtual_screening.virtual_screening(receptor, ligand_path, format, out_dir, **kwargs)
+    return {'docked': len(results)}
+
+
+# kind -> (pool, function(job_id, **params)), cpu pool jobs also get cpu=cores per worker
+JOB_KINDS = {
+    'fold': ('gpu', _run_fold),
+    'dock': ('cpu', _run_dock),
+    'dock_predicted': ('cpu', _run_dock_predicted),
+    'screen': ('cpu', _run_screen),
+}
+
+
+def open_queue(db_file):
+    """
+    打开(或新建)任务队列
+    :param db_file: sqlite文件路径
+    :return: sqlite3.Connection，每个线程使用自己的连接
+    """
+    conn = sqlite3.connect(db_file, timeout=60, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(_SCHEMA)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)')]
+    for column in ('expected_seconds', 'expected_memory'):
+        if column not in columns:
+            # Queues created before the cost model.
+            conn.execute(f'ALTER TABLE jobs ADD COLUMN {column} REAL')
+    return conn
+
+
+def _job_dict(row):
+    if row is None:
+        return None
+    job = dict(row)
+    for key in ('params', 'result'):
+        if job[key] is not None:
+            job[key] = json.loads(job[key])
+    return job
+
+
+def _estimate(kind, params):
+    """fold任务的预测耗时和峰值内存，其他任务或无法预测时返回 (None, None)"""
+    if kind != 'fold':
+        return None, None
+    try:
+        estimate = cost_model.predict(sequence_length(params['fasta_path']))
+    except (OSError, KeyError) as e:
+        logging.warning('No cost estimate for %s: %s', params.get('fasta_path'), e)
+        return None, None
+    return estimate.msa_seconds + estimate.inference_seconds, estimate.peak_memory
+
+
+def _insert(conn, kind, params, after=None, request_key=None, max_queued=None):
+    if kind not in JOB_KINDS:
+        raise ValueError(f'Unknown job kind "{kind}", expected one of {sorted(JOB_KINDS)}')
+    pool = JOB_KINDS[kind][0]
+    if request_key is not None:
+        row = conn.execute('SELECT id FROM jobs WHERE request_key = ?', (request_key,)).fetchone()
+        if row is not None:
+            return row['id'], True
+    if max_queued is not None:
+        queued = conn.execute('SELECT COUNT(*) FROM jobs WHERE pool = ? AND state = ?',
+                              (pool, QUEUED)).fetchone()[0]
+        if queued >= max_queued:
+            raise QueueFull(f'{queued} {pool} jobs are already queued')
+    expected_seconds, expected_memory = _estimate(kind, params)
+    job_id = conn.execute(
+        'INSERT INTO jobs (kind, pool, params, state, after, request_key, submitted_at, '
+        'expected_seconds, expected_memory) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (kind, pool, json.dumps(params), QUEUED, after, request_key, time.time(),
+         expected_seconds, expected_memory)).lastrowid
+    return job_id, False
+
+
+def submit(conn, kind, params, after=None, request_key=None, max_queued=None):
+    """
+    提交一个任务
+    :param kind: JOB_KINDS中的任务类型
+    :param params: 任务函数的参数dict
+    :param after: 依赖的任务id，该任务完成后才开始
+    :param request_key: 客户端给出的去重键，重复提交时返回已有任务的id
+    :param max_queued: 该任务池最多排队的任务数，超过时抛出QueueFull
+    :return: 任务id
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        job_id, _ = _insert(conn, kind, params, after, request_key, max_queued)
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return job_id
+
+
+def submit_pipeline(conn, receptor, ligand_files, format, out_dir, structure_cache_dir=None,
+                    msa_store_dir=None, docking_cache_dir=None, auto_box=False,
+                    request_key=None, max_queued=None):
+    """
+    AlphaFold+对接流水线拆成一个GPU上的fold任务和每个化合物一个CPU上的对接任务，在一个事务中提交
+    GPU预测下一个受体的同时，CPU可以对接上一个受体
+    :return: [fold任务id, 对接任务id, ...]
+    """
+    if isinstance(ligand_files, str):
+        ligand_files = [ligand_files]
+    _, receptor_name = os.path.split(receptor)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        fold_id, existed = _insert(
+            conn, 'fold', {'fasta_path': f'{receptor}.fasta', 'output_dir': out_dir,
+                           'structure_cache_dir': structure_cache_dir,
+                           'msa_store_dir': msa_store_dir,
+                           'prepare_receptor': True, 'auto_box': auto_box},
+            request_key=request_key, max_queued=max_queued)
+        if existed:
+            job_ids = [fold_id] + [row['id'] for row in conn.execute(
+                'SELECT id FROM jobs WHERE after = ? ORDER BY id', (fold_id,))]
+        else:
+            job_ids = [fold_id]
+            for ligand_file in ligand_files:
+                job_ids.append(_insert(
+                    conn, 'dock_predicted',
+                    {'receptor_name': receptor_name, 'ligand_file': ligand_file, 'format': format,
+                     'out_dir': out_dir, 'docking_cache_dir': docking_cache_dir,
+                     'auto_box': auto_box},
+                    after=fold_id)[0])
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return job_ids
+
+
+def _pick(conn, pool, memory_budget=None):
+    """
+    按 预测耗时 - AGING * 等待时间 从小到大选择任务
+    已经运行的任务与候选任务的预测内存之和超过memory_budget时跳过该候选，避免两个大内存任务同时运行
+    """
+    rows = conn.execute(
+        'SELECT * FROM jobs WHERE pool = ? AND state = ? AND '
+        '(after IS NULL OR after IN (SELECT id FROM jobs WHERE state = ?)) '
+        'ORDER BY id', (pool, QUEUED, DONE)).fetchall()
+    now = time.time()
+    rows.sort(key=lambda row: ((row['expected_seconds'] or 0.0) - AGING * (now - row['submitted_at']),
+                               row['id']))
+    running, running_memory = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(expected_memory), 0) FROM jobs WHERE pool = ? AND state = ?',
+        (pool, RUNNING)).fetchone()
+    for row in rows:
+        # An idle pool always starts something, even a job larger than the budget.
+        if (memory_budget is None or running == 0
+                or running_memory + (row['expected_memory'] or 0.0) <= memory_budget):
+            return row
+    return None
+
+
+def claim(conn, pool, worker, memory_budget=None):
+    """
+    取出一个可以开始的任务并标记为running
+    依赖的任务失败或取消时，该任务也标记为失败
+    SJF_POOLS中的任务按预测耗时从短到长开始，其余任务按提交顺序
+    :param memory_budget: SJF_POOLS中同时运行的任务的预测内存之和上限(bytes)，为None时不限制
+    :return: 任务dict，没有可以开始的任务时返回None
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute(
+            'UPDATE jobs SET state = ?, error = ?, finished_at = ? WHERE state = ? AND after IN '
+            '(SELECT id FROM jobs WHERE state IN (?, ?))',
+            (FAILED, 'dependency failed', time.time(), QUEUED, FAILED, CANCELLED))
+        if pool in SJF_POOLS:
+            row = _pick(conn, pool, memory_budget)
+        else:
+            row = conn.execute(
+                'SELECT * FROM jobs WHERE pool = ? AND state = ? AND '
+                '(after IS NULL OR after IN (SELECT id FROM jobs WHERE state = ?)) '
+                'ORDER BY id LIMIT 1', (pool, QUEUED, DONE)).fetchone()
+        if row is not None:
+            conn.execute('UPDATE jobs SET state = ?, worker = ?, started_at = ?, '
+                         'attempts = attempts + 1 WHERE id = ?',
+                         (RUNNING, worker, time.time(), row['id']))
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    return _job_dict(row)
+
+
+def finish(conn, job_id, result=None, error=None):
+    """记录任务结束，error不为None时任务失败"""
+    conn.execute('UPDATE jobs SET state = ?, result = ?, error = ?, finished_at = ? '
+                 'WHERE id = ? AND state = ?',
+                 (FAILED if error is not None else DONE,
+                  json.dumps(result) if result is not None else None, error, time.time(),
+                  job_id, RUNNING))
+
+
+def _remove_containers(job_ids):
+    """
+    删除这些任务的AlphaFold容器：服务被强制结束(SIGKILL、崩溃)时_kill_running()没有执行，
+    docker仍在运行这些容器，任务重新排队后会有两个容器写同一个输出目录
+    :return: 删除的容器数
+    """
+    try:
+        containers = docker.from_env().containers.list(all=True, filters={'label': _JOB_LABEL})
+    except docker.errors.DockerException as e:
+        logging.warning('Could not list the AlphaFold containers of running jobs: %s', e)
+        return 0
+    removed = 0
+    for container in containers:
+        job_id = container.labels.get(_JOB_LABEL)
+        if job_id not in job_ids:
+            continue
+        try:
+            container.remove(force=True)
+            removed += 1
+            logging.info('Removed the AlphaFold container of interrupted job %s', job_id)
+        except docker.errors.APIError as e:
+            logging.warning('Could not remove the container of job %s: %s', job_id, e)
+    return removed
+
+
+def recover(conn):
+    """
+    服务重启时调用：上次运行中断的任务重新排队，启动次数过多的任务标记为失败
+    重新排队前删除这些任务仍在运行的AlphaFold容器
+    :return: 重新排队的任务数
+    """
+    running = {str(job_id) for job_id, in conn.execute('SELECT id FROM jobs WHERE state = ?',
+                                                        (RUNNING,))}
+    if running:
+        _remove_containers(running)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('UPDATE jobs SET state = ?, error = ?, finished_at = ? '
+                 'WHERE state = ? AND attempts >= ?',
+                 (FAILED, 'server stopped while running', time.time(), RUNNING, MAX_ATTEMPTS))
+    count = conn.execute('UPDATE jobs SET state = ?, worker = NULL WHERE state = ?',
+                         (QUEUED, RUNNING)).rowcount
+    conn.execute('COMMIT')
+    return count
+
+
+def cancel(conn, job_id):
+    """取消排队中的任务，:return: 取消成功返回True"""
+    return conn.execute('UPDATE jobs SET state = ?, finished_at = ? WHERE id = ? AND state = ?',
+                        (CANCELLED, time.time(), job_id, QUEUED)).rowcount == 1
+
+
+def get_job(conn, job_id):
+    return _job_dict(conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone())
+
+
+def list_jobs(conn, state=None, limit=100):
+    if state is None:
+        rows = conn.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT ?', (limit,))
+    else:
+        rows = conn.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id DESC LIMIT ?',
+                            (state, limit))
+    return [_job_dict(row) for row in rows]
+
+
+def _kill_running():
+    """停止服务时杀死运行中任务的容器和子进程，这些任务保持running状态，下次启动时由recover()重新排队"""
+    with _containers_lock:
+        containers = list(_containers.items())
+    for job_id, container in containers:
+        try:
+            container.kill()
+            logging.info('Killed the AlphaFold container of job %d', job_id)
+        except docker.errors.APIError as e:
+            # The container may have exited in the meantime.
+            logging.warning('Could not kill the container of job %d: %s', job_id, e)
+    killed = supervise.kill_descendants()
+    if killed:
+        logging.info('Killed %d vina/obabel processes of running jobs', killed)
+
+
+def _worker_loop(db_file, pool, worker, wake, stop, memory_budget=None, cpu=None):
+    conn = open_queue(db_file)
+    while not stop.is_set():
+        job = claim(conn, pool, worker, memory_budget)
+        if job is None:
+            with wake:
+                wake.wait(timeout=1.0)
+            continue
+        logging.info('%s starts job %d (%s)', worker, job['id'], job['kind'])
+        try:
+            params = dict(job['params'])
+            if cpu:
+                params.setdefault('cpu', cpu)
+            result = JOB_KINDS[job['kind']][1](job['id'], **params)
+            finish(conn, job['id'], result=result)
+            logging.info('Job %d done', job['id'])
+        except Exception as e:  # pylint: disable=broad-except
+            if stop.is_set():
+                # Killed by the shutdown, the job stays running so that the next start re-queues it.
+                logging.info('Job %d interrupted by the shutdown', job['id'])
+                break
+            if isinstance(e, supervise.StageError):
+                finish(conn, job['id'], error=str(e))
+                logging.error('Job %d failed: %s', job['id'], e)
+            else:
+                finish(conn, job['id'], error=traceback.format_exc())
+                logging.error('Job %d failed:\n%s', job['id'], traceback.format_exc())
+        # Dependent jobs may have become ready.
+        with wake:
+            wake.notify_all()
+    conn.close()
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        conn = open_queue(self.server.db_file)
+        try:
+            match = re.fullmatch(r'/jobs/(\d+)', self.path)
+            if match:
+                job = get_job(conn, int(match.group(1)))
+                self._send(200 if job else 404, job or {'error': 'no such job'})
+            elif self.path.split('?')[0] == '/jobs':
+                query = dict(part.split('=', 1) for part in self.path.partition('?')[2].split('&')
+                             if '=' in part)
+                try:
+                    limit = int(query.get('limit', 100))
+                except ValueError:
+                    self._send(400, {'error': f'limit must be an integer, got {query["limit"]!r}'})
+                    return
+                self._send(200, list_jobs(conn, query.get('state'), limit))
+            else:
+                self._send(404, {'error': 'not found'})
+        finally:
+            conn.close()
+
+    def do_POST(self):
+        conn = open_queue(self.server.db_file)
+        try:
+            match = re.fullmatch(r'/jobs/(\d+)/cancel', self.path)
+            if match:
+                if cancel(conn, int(match.group(1))):
+                    self._send(200, {'cancelled': True})
+                else:
+                    self._send(409, {'error': 'only queued jobs can be cancelled'})
+                return
+            if self.path != '/jobs':
+                self._send(404, {'error': 'not found'})
+                return
+            body = self._read_json()
+            kind = body.get('kind')
+            params = body.get('params', {})
+            try:
+                if kind == 'pipeline':
+                    job_ids = submit_pipeline(conn, request_key=body.get('request_key'),
+                                              max_queued=self.server.max_queued, **params)
+                else:
+                    job_ids = [submit(conn, kind, params, after=body.get('after'),
+                                      request_key=body.get('request_key'),
+                                      max_queued=self.server.max_queued)]
+            except QueueFull as e:
+                # Backpressure: the client should retry later.
+                self.send_response(429)
+                self.send_header('Retry-After', '60')
+                self.end_headers()
+                self.wfile.write(json.dumps({'error': str(e)}).encode('utf-8'))
+                return
+            except (ValueError, TypeError) as e:
+                self._send(400, {'error': str(e)})
+                return
+            with self.server.wake:
+                self.server.wake.notify_all()
+            self._send(201, {'id': job_ids[0], 'jobs': job_ids})
+        finally:
+            conn.close()
+
+    def log_message(self, format, *args):
+        logging.info('%s %s', self.address_string(), format % args)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _raise_interrupt():
+    raise KeyboardInterrupt
+
+
+def serve(db_file, host='127.0.0.1', port=8765, socket_path=None, gpu_workers=1,
+          cpu_workers=None, max_queued=1000, memory_budget=None):
+    """
+    运行任务服务，直到收到KeyboardInterrupt
+    :param db_file: 任务队列的sqlite文件，重启后从中恢复
+    :param host: HTTP监听地址
+    :param port: HTTP监听端口
+    :param socket_path: 不为None时改为监听这个Unix socket
+    :param gpu_workers: 同时运行的AlphaFold任务数
+    :param cpu_workers: 同时运行的obabel/vina任务数，默认为CPU核数，每个任务的vina使用 CPU核数 // cpu_workers 个CPU
+    :param max_queued: 每个任务池最多排队的任务数，超过后提交返回HTTP 429
+    :param memory_budget: 同时运行的AlphaFold任务的预测内存之和上限(bytes)，默认为启动时的可用内存
+    """
+    cpu_workers = cpu_workers or os.cpu_count() or 1
+    # Without an explicit --cpu every vina would use all cores, cpu_workers times over.
+    cpu_per_job = max(1, (os.cpu_count() or 1) // cpu_workers)
+    memory_budget = memory_budget or vina_scheduler.available_memory()
+    conn = open_queue(db_file)
+    recovered = recover(conn)
+    conn.close()
+    if recovered:
+        logging.info('Re-queued %d jobs interrupted by the last shutdown', recovered)
+
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixServer(socket_path, _Handler)
+    else:
+        server = _TCPServer((host, port), _Handler)
+    server.db_file = db_file
+    server.max_queued = max_queued
+    server.wake = threading.Condition()
+    stop = threading.Event()
+    workers = []
+    for pool, count in (('gpu', gpu_workers), ('cpu', cpu_workers)):
+        for i in range(count):
+            worker = threading.Thread(target=_worker_loop, name=f'{pool}-{i}', daemon=True,
+                                      args=(db_file, pool, f'{pool}-{i}', server.wake, stop,
+                                            memory_budget, cpu_per_job if pool == 'cpu' else None))
+            worker.start()
+            workers.append(worker)
+    logging.info('Serving jobs on %s with %d GPU and %d CPU workers',
+                 socket_path or f'http://{host}:{port}', gpu_workers, cpu_workers)
+    # A service manager stops the server with SIGTERM, which must take the same path as CTRL+C.
+    signal.signal(signal.SIGTERM, lambda unused_sig, unused_frame: _raise_interrupt())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Running jobs stay running in the queue and are re-queued on the next start, their
+        # containers and processes must not outlive the server or they would run twice.
+        stop.set()
+        _kill_running()
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_file', type=str, help='the sqlite job queue, e.g. /tmp/alphafold/jobs.sqlite')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='the HTTP address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='the HTTP port to listen on')
+    parser.add_argument('--socket', type=str, default=None, help='listen on this Unix socket instead of HTTP, e.g. /tmp/valphafold.sock')
+    parser.add_argument('--gpu_workers', type=int, default=1, help='number of concurrent AlphaFold jobs')
+    parser.add_argument('--cpu_workers', type=int, default=None, help='number of concurrent obabel/vina jobs, default is the number of cores')
+    parser.add_argument('--max_queued', type=int, default=1000, help='queued jobs per pool before submissions are rejected with HTTP 429')
+    parser.add_argument('--memory_budget_gb', type=float, default=None, help='predicted peak memory of concurrent AlphaFold jobs, default is the available memory')
+    args = parser.parse_args()
+    serve(args.db_file, host=args.host, port=args.port, socket_path=args.socket,
+          gpu_workers=args.gpu_workers, cpu_workers=args.cpu_workers, max_queued=args.max_queued,
+          memory_budget=int(args.memory_budget_gb * 2 ** 30) if args.memory_budget_gb else None)
@@ -0,0 +1,237 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import uuid
+
+from absl import logging
+
+from fasta_utils import read_sequences
+
+
+_MSA_DIR = 'msas'
+# One line per harvested monomer entry, used to find the parent of a point mutant.
+_INDEX_FILE = 'index.jsonl'
+# AlphaFold re-runs the template search on the uniref90 MSA even with use_precomputed_msas,
+# so the template hits of a derived entry are never copied from the parent.
+_TEMPLATE_HITS_PREFIX = 'pdb_hits.'
+
+_lock = threading.Lock()
+
+
+def msa_key(fasta_path, db_preset='full_dbs', model_preset='monomer'):
+    """
+    以规范化后的序列计算MSA的键
+    The MSA files depend on the databases searched (db_preset) and on whether
+    the multimer pipeline lays them out per chain, but not on the template date.
+    :param fasta_path: fasta文件路径，有后缀名
+    :return: sha256 hex digest
+    """
+    payload = {
+        'sequences': read_sequences(fasta_path),
+        'db_preset': db_preset,
+        'multimer': model_preset == 'multimer',
+    }
+    data = json.dumps(payload, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _entry_dir(store_dir, key):
+    return os.path.join(store_dir, key[:2], key)
+
+
+def has_msas(store_dir, key):
+    return os.path.isdir(os.path.join(_entry_dir(store_dir, key), _MSA_DIR))
+
+
+def stage_msas(store_dir, key, target_dir):
+    """
+    把共享MSA库中的MSA复制到AlphaFold输出目录下的msas文件夹
+    :param store_dir: 共享MSA库根目录
+    :param key: msa_key()的返回值
+    :param target_dir: AlphaFold的输出目录 output_dir/<name>
+    :return: 命中返回True
+    """
+    source = os.path.join(_entry_dir(store_dir, key), _MSA_DIR)
+    if not os.path.isdir(source):
+        return False
+    shutil.copytree(source, os.path.join(target_dir, _MSA_DIR),
+                    dirs_exist_ok=True)
+    logging.info('MSA store hit %s -> %s', key, target_dir)
+    return True
+
+
+def harvest_msas(store_dir, key, source_dir, fasta_path=None, db_preset='full_dbs',
+                 model_preset='monomer'):
+    """
+    把AlphaFold运行后生成的MSA收录进共享MSA库
+    :param store_dir: 共享MSA库根目录
+    :param key: msa_key()的返回值
+    :param source_dir: AlphaFold的输出目录 output_dir/<name>
+    :param fasta_path: 给出时把单链序列记入索引，之后它的突变体可以用derive_msas()派生MSA
+    :return: 新收录返回True，没有ranked_0.pdb(运行没有完成)时不收录
+    """
+    if not os.path.exists(os.path.join(source_dir, 'ranked_0.pdb')):
+        logging.warning('No ranked_0.pdb in %s, not harvesting its MSAs', source_dir)
+        return False
+    msa_dir = os.path.join(source_dir, _MSA_DIR)
+    if not os.path.isdir(msa_dir) or not os.listdir(msa_dir):
+        return False
+    entry_dir = _entry_dir(store_dir, key)
+    if os.path.isdir(entry_dir):
+        return False
+    parent = os.path.dirname(entry_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = os.path.join(parent, f'.{key}.{uuid.uuid4().hex}')
+    shutil.copytree(msa_dir, os.path.join(tmp_dir, _MSA_DIR))
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another job harvested the same sequence first.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+    logging.info('MSA store harvested %s <- %s', key, source_dir)
+    sequences = read_sequences(fasta_path) if fasta_path else []
+    if len(sequences) == 1 and model_preset != 'multimer':
+        line = json.dumps({'key': key, 'sequence': sequences[0], 'db_preset': db_preset}) + '\n'
+        with _lock:
+            fd = os.open(os.path.join(store_dir, _INDEX_FILE),
+                         os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode('utf-8'))
+            finally:
+                os.close(fd)
+    return True
+
+
+def find_parent(store_dir, sequence, db_preset='full_dbs', max_substitutions=3):
+    """
+    在索引中寻找与sequence等长、只有少数几个位置不同的已搜索序列
+    :return: (key, 亲本序列, [(位置, 亲本残基, 突变残基), ...])，差异最少的一个；没有时返回None
+    """
+    index_file = os.path.join(store_dir, _INDEX_FILE)
+    if not os.path.exists(index_file):
+        return None
+    best = None
+    with open(index_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            parent = entry['sequence']
+            if entry['db_preset'] != db_preset or len(parent) != len(sequence) or parent == sequence:
+                continue
+            substitutions = [(i, a, b) for i, (a, b) in enumerate(zip(parent, sequence)) if a != b]
+            if len(substitutions) <= max_substitutions and (
+                    best is None or len(substitutions) < len(best[2])):
+                if has_msas(store_dir, entry['key']):
+                    best = (entry['key'], parent, substitutions)
+    return best
+
+
+def _substitute_row(row, position, substitutions):
+    """
+    替换比对中一行(或一行的一段)的残基，跳过gap；position为这一段之前已经出现的残基数
+    :return: (替换后的行, 新的position)
+    """
+    chars = list(row)
+    for j, char in enumerate(chars):
+        if not char.isalpha():
+            continue
+        if position in substitutions:
+            parent_residue, residue = substitutions[position]
+            if char.upper() != parent_residue:
+                raise ValueError(f'query residue {position + 1} is {char}, expected {parent_residue}')
+            chars[j] = residue if char.isupper() else residue.lower()
+        position += 1
+    return ''.join(chars), position
+
+
+def _substitute_stockholm(text, substitutions, length):
+    """替换Stockholm格式MSA中查询序列(第一条序列)的残基，序列可以分成多个block"""
+    lines = text.splitlines(True)
+    query = None
+    position = 0
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#') or stripped == '//':
+            continue
+        parts = stripped.split(None, 1)
+        name, row = parts[0], parts[1] if len(parts) == 2 else ''
+        if query is None:
+            query = name
+        if name != query:
+            continue
+        new_row, position = _substitute_row(row, position, substitutions)
+        start = line.rindex(row)
+        lines[i] = line[:start] + new_row + line[start + len(row):]
+    if position != length:
+        raise ValueError(f'query row has {position} residues, expected {length}')
+    return ''.join(lines)
+
+
+def _substitute_a3m(text, substitutions, length):
+    """替换A3M格式MSA中查询序列(第一条记录)的残基"""
+    lines = text.splitlines(True)
+    position = 0
+    seen_header = False
+    for i, line in enumerate(lines):
+        if line.startswith('>'):
+            if seen_header:
+                break
+            seen_header = True
+            continue
+        if not seen_header:
+            continue
+        new_row, position = _substitute_row(line.rstrip('\r\n'), position, substitutions)
+        lines[i] = new_row + line[len(line.rstrip('\r\n')):]
+    if position != length:
+        raise ValueError(f'query row has {position} residues, expected {length}')
+    return ''.join(lines)
+
+
+def derive_msas(store_dir, fasta_path, target_dir, db_preset='full_dbs', max_substitutions=3):
+    """
+    点突变体不重新搜索MSA：找到共享MSA库中已经搜索过的亲本序列，把亲本MSA中的查询序列替换成突变体，
+    写到target_dir/msas，之后用use_precomputed_msas运行AlphaFold
+    模板搜索不复制，AlphaFold会用派生的uniref90 MSA重新搜索，模板特征对应突变体序列
+    :param fasta_path: 单链的fasta文件路径，有后缀名
+    :param target_dir: AlphaFold的输出目录 output_dir/<name>
+    :param max_substitutions: 与亲本最多相差的位置数
+    :return: 派生成功返回True
+    """
+    sequences = read_sequences(fasta_path)
+    if len(sequences) != 1 or max_substitutions <= 0:
+        return False
+    found = find_parent(store_dir, sequences[0], db_preset, max_substitutions)
+    if found is None:
+        return False
+    key, parent, substitutions = found
+    mutations = {i: (a, b) for i, a, b in substitutions}
+    source = os.path.join(_entry_dir(store_dir, key), _MSA_DIR)
+    derived = {}
+    try:
+        for name in os.listdir(source):
+            if name.startswith(_TEMPLATE_HITS_PREFIX):
+                continue
+            with open(os.path.join(source, name), 'r') as f:
+                text = f.read()
+            if name.endswith('.sto'):
+                derived[name] = _substitute_stockholm(text, mutations, len(parent))
+            elif name.endswith('.a3m'):
+                derived[name] = _substitute_a3m(text, mutations, len(parent))
+    except ValueError as e:
+        # The stored query row does not line up with the parent, search from scratch.
+        logging.warning('Cannot derive MSAs of %s from %s: %s', fasta_path, key, e)
+        return False
+    if not derived:
+        return False
+    msa_dir = os.path.join(target_dir, _MSA_DIR)
+    os.makedirs(msa_dir, exist_ok=True)
+    for name, text in derived.items():
+        with open(os.path.join(msa_dir, name), 'w') as f:
+            f.write(text)
+    logging.info('Derived MSAs of %s from %s with %s', fasta_path, key,
+                 ','.join(f'{a}{i + 1}{b}' for i, a, b in substitutions))
+    return True
@@ -1,3 +1,7 @@
+import concurrent.futures
+import importlib
+import importlib.machinery
+import importlib.util
 import os
 import pathlib
 import signal
@@ -11,15 +15,227 @@ from absl import logging
 import docker
 from docker import types
 
+import instrument
+import supervise
 
+
+
+def _import_pybel():
+    """
+    Open Babel 3的pybel在openbabel包中，Open Babel 2是顶层的pybel模块
+    本模块与openbabel包同名，从本目录导入时遮蔽了这个包，所以在其余的sys.path中按路径找到真正的包
+    :return: pybel模块，都没有安装时返回None
+    """
+    try:
+        from openbabel import pybel  # pylint: disable=import-outside-toplevel
+        return pybel
+    except ImportError:
+        pass
+    try:
+        import pybel  # pylint: disable=import-outside-toplevel
+        return pybel
+    except ImportError:
+        pass
+    here = os.path.dirname(os.path.abspath(__file__))
+    search_path = [entry for entry in sys.path if os.path.abspath(entry or os.curdir) != here]
+    spec = importlib.machinery.PathFinder.find_spec('openbabel', search_path)
+    if spec is None or not spec.submodule_search_locations:
+        return None
+    # pybel imports `openbabel.openbabel` while loading, so the real package has to be
+    # sys.modules['openbabel'] until it is done.
+    shadowed = sys.modules.get('openbabel')
+    package = importlib.util.module_from_spec(spec)
+    sys.modules['openbabel'] = package
+    try:
+        spec.loader.exec_module(package)
+        return importlib.import_module('openbabel.pybel')
+    except ImportError:
+        return None
+    finally:
+        if shadowed is not None:
+            sys.modules['openbabel'] = shadowed
+        else:
+            sys.modules.pop('openbabel', None)
+
+
+pybel = _import_pybel()
+
+
+# Formats that can hold several molecules in one file.
+MULTI_MOLECULE_FORMATS = ('sdf', 'mol2', 'smi')
+_MOL2_RECORD_START = '@<TRIPOS>MOLECULE'
+
+
+@instrument.instrumented('openbabel')
 def openbabel(ligand_file, format, out_file):
     """
     :ligand_file:为输入化合物文件名，无后缀名
     :format：为输入化合物文件格式
+    :return: supervise.StageResult
     """
     #past_file = 
-    cmd = f'obabel -i {format} {ligand_file}.{format} -o pdbqt -O {out_file}'
-    return os.popen(cmd, 'r')
+    cmd = ['obabel', '-i', format, f'{ligand_file}.{format}', '-o', 'pdbqt', '-O', out_file]
+    return supervise.run_command('openbabel', cmd, expected_output=out_file)
+
+
+def iter_records(library_file, format):
+    """
+    逐个返回多化合物文件中每个化合物的文本
+    :param library_file: 包含多个化合物的文件(sdf/mol2/smi)，有后缀名
+    :param format: 化合物文件格式
+    """
+    with open(library_file, 'r') as f:
+        if format == 'smi':
+            for line in f:
+                if line.strip() and not line.startswith('#'):
+                    yield line
+        elif format == 'sdf':
+            record = []
+            for line in f:
+                record.append(line)
+                if line.startswith('$$$$'):
+                    yield ''.join(record)
+                    record = []
+            if ''.join(record).strip():
+                yield ''.join(record)
+        elif format == 'mol2':
+            record = []
+            for line in f:
+                if line.startswith(_MOL2_RECORD_START) and record:
+                    yield ''.join(record)
+                    record = []
+                record.append(line)
+            if record:
+                yield ''.join(record)
+        else:
+            raise ValueError(f'Cannot split ligand library of format "{format}"')
+
+
+def _convert_with_pybel(records, format, out_files):
+    # pybel.readfile() silently skips records it cannot parse, which would shift the names
+    # of every later molecule, so each record is parsed on its own.
+    for record, out_file in zip(records, out_files):
+        try:
+            molecule = pybel.readstring(format, record)
+            if format == 'smi':
+                molecule.addh()
+                molecule.make3D()
+            molecule.write('pdbqt', out_file, overwrite=True)
+        except (IOError, ValueError) as e:
+            logging.warning('Skipping molecule %s: %s', out_file, e)
+
+
+def _convert_with_obabel(chunk_file, format, out_files, records):
+    # One obabel process splits the whole chunk, writing <prefix>1.pdbqt, ...
+    prefix = os.path.join(os.path.dirname(out_files[0]), f'.{os.path.basename(chunk_file)}_')
+    cmd = ['obabel', '-i', format, chunk_file, '-o', 'pdbqt', '-O', f'{prefix}.pdbqt', '-m']
+    if format == 'smi':
+        cmd += ['-h', '--gen3d']
+    supervise.run_command('openbabel', cmd, check=False)
+    written = [f'{prefix}{i + 1}.pdbqt' for i in range(len(out_files))]
+    if all(os.path.exists(path) for path in written) and \
+            not os.path.exists(f'{prefix}{len(out_files) + 1}.pdbqt'):
+        for path, out_file in zip(written, out_files):
+            os.replace(path, out_file)
+        return
+    # obabel skipped a molecule, so the numbering no longer lines up with the
+    # input. Redo this chunk one molecule at a time to keep names correct.
+    for path in written:
+        if os.path.exists(path):
+            os.remove(path)
+    for record, out_file in zip(records, out_files):
+        single = f'{out_file[:-len(".pdbqt")]}.{format}'
+        with open(single, 'w') as f:
+            f.write(record)
+        try:
+            openbabel(single[:-len(format) - 1], format, out_file)
+        except supervise.StageError as e:
+            logging.warning('Skipping molecule %s: %s', out_file, e)
+        os.remove(single)
+
+
+@instrument.instrumented('openbabel_bulk')
+def convert_chunk(chunk_file, format, out_files):
+    """
+    把一个多化合物文件转换成每个化合物一个pdbqt文件
+    有pybel时在进程内转换，否则调用一次 obabel -m
+    第i个化合物总是写入out_files[i]，化合物数与out_files不一致时抛出ValueError
+    :return: 成功写入的pdbqt文件列表
+    """
+    records = list(iter_records(chunk_file, format))
+    if len(records) != len(out_files):
+        raise ValueError(f'{chunk_file} holds {len(records)} molecules, '
+                         f'but {len(out_files)} output names were given')
+    if pybel is not None:
+        _convert_with_pybel(records, format, out_files)
+    else:
+        _convert_with_obabel(chunk_file, format, out_files, records)
+    os.remove(chunk_file)
+    return [out_file for out_file in out_files if os.path.exists(out_file)]
+
+
+def _iter_chunks(library_file, format, out_dir, chunk_size, skip=()):
+    """:return: 生成 (分块文件, 输出文件列表)，skip中的化合物单独生成 (None, [输出文件])"""
+    stem = os.path.splitext(os.path.basename(library_file))[0]
+    chunk = []
+    out_files = []
+    for index, record in enumerate(iter_records(library_file, format)):
+        # Skipped molecules keep their index, so the names of the others do not move.
+        out_file = os.path.join(out_dir, f'{stem}_{index}.pdbqt')
+        if f'{stem}_{index}' in skip:
+            yield None, [out_file]
+            continue
+        chunk.append(record)
+        out_files.append(out_file)
+        if len(chunk) == chunk_size:
+            yield _write_chunk(chunk, format, out_files)
+            chunk = []
+            out_files = []
+    if chunk:
+        yield _write_chunk(chunk, format, out_files)
+
+
+def _write_chunk(chunk, format, out_files):
+    # Named after its first molecule, so no two chunks of a library share a file.
+    name = os.path.splitext(os.path.basename(out_files[0]))[0]
+    chunk_file = os.path.join(os.path.dirname(out_files[0]), f'.{name}.{format}')
+    with open(chunk_file, 'w') as f:
+        f.writelines(chunk)
+    return chunk_file, out_files
+
+
+def bulk_openbabel(library_file, format, out_dir, processes=None, chunk_size=500, skip=()):
+    """
+    把整个化合物库转换成pdbqt，按chunk_size个化合物分块后在进程池中并行转换
+    :param library_file: 包含多个化合物的文件(sdf/mol2/smi)，有后缀名
+    :param format: 化合物文件格式
+    :param out_dir: 输出的路径，第i个化合物写入 f'{out_dir}/{stem}_{i}.pdbqt'
+    :param processes: 并行进程数，默认为CPU核数
+    :param chunk_size: 每个obabel进程转换的化合物数
+    :param skip: 不需要转换的化合物名称 f'{stem}_{i}'，例如继续被中断的筛选时已经对接过的化合物
+    :return: 按完成顺序生成写入的pdbqt文件路径，skip中的化合物直接生成其路径，文件不一定存在
+    """
+    if format not in MULTI_MOLECULE_FORMATS:
+        raise ValueError(f'Cannot split ligand library of format "{format}"')
+    os.makedirs(out_dir, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+    chunks = _iter_chunks(library_file, format, out_dir, chunk_size, skip)
+    # Only split a few chunks ahead of the workers so the library is streamed.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        in_flight = set()
+        for chunk_file, out_files in chunks:
+            if chunk_file is None:
+                yield from out_files
+                continue
+            in_flight.add(executor.submit(convert_chunk, chunk_file, format, out_files))
+            if len(in_flight) >= processes * 2:
+                done, in_flight = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in concurrent.futures.as_completed(in_flight):
+            yield from future.result()
+
 
 if __name__ == '__main__':
     import argparse
@@ -27,8 +243,18 @@ if __name__ == '__main__':
     parser.add_argument('ligand_file', type=str, help='the receptor file, absolute path without file extension, e.g. /tmp/alphafold/1')
     parser.add_argument('formate', type=str, help='the format of ligand file, e.g. mol2')
     parser.add_argument('out_file', type=str, help='the dictionary of output files, e.g. /tmp/alphafold/1.pdbqt')
+    parser.add_argument('--bulk', action='store_true', help='ligand_file is a multi-molecule library, out_file is the output directory')
+    parser.add_argument('--processes', type=int, default=None, help='number of parallel conversion processes in bulk mode')
+    parser.add_argument('--chunk_size', type=int, default=500, help='molecules per obabel process in bulk mode')
     args = parser.parse_args()
-    openbabel(args.ligand_file, args.formate, args.out_file)
+    if args.bulk:
+        count = 0
+        for _ in bulk_openbabel(f'{args.ligand_file}.{args.formate}', args.formate, args.out_file,
+                                processes=args.processes, chunk_size=args.chunk_size):
+            count += 1
+        print(f'{count} molecules converted')
+    else:
+        openbabel(args.ligand_file, args.formate, args.out_file)
 
     
     
\ No newline at end of file
@@ -0,0 +1,349 @@
+import fcntl
+import glob
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from absl import logging
+
+
+DEFAULT_SHARD_BYTES = 1 << 30
+_INDEX_FILE = 'index.sqlite'
+_SHARD_PREFIX = 'shard-'
+_SHARD_SUFFIX = '.pack'
+_RECORD_MAGIC = b'PACK '
+_CHUNK_BYTES = 1 << 20
+
+# File names of the per-file layout, used when exporting into a directory.
+ARTIFACT_NAMES = {
+    'ligand': '{ligand}.pdbqt',
+    'pose': '{receptor}_{ligand}.pdbqt',
+    'log': '{receptor}_{ligand}.txt',
+    'html': '{receptor}_{ligand}.html',
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    receptor TEXT NOT NULL,
+    ligand TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    shard TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    path TEXT,
+    packed_at REAL NOT NULL,
+    PRIMARY KEY (receptor, ligand, kind)
+);
+CREATE INDEX IF NOT EXISTS artifacts_shard_offset ON artifacts (shard, offset);
+"""
+
+
+def open_archive(archive_dir):
+    """
+    打开(或新建)打包输出目录
+    对接产生的小文件追加写入少数几个大的shard文件，偏移量索引在 f'{archive_dir}/index.sqlite'
+    :return: 索引的sqlite3.Connection
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(archive_dir, _INDEX_FILE), timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def _shards(archive_dir):
+    return sorted(os.path.basename(path) for path in
+                  glob.glob(os.path.join(archive_dir, f'{_SHARD_PREFIX}*{_SHARD_SUFFIX}')))
+
+
+def _current_shard(archive_dir, shard_bytes):
+    shards = _shards(archive_dir)
+    if shards and os.path.getsize(os.path.join(archive_dir, shards[-1])) < shard_bytes:
+        return shards[-1]
+    number = int(shards[-1][len(_SHARD_PREFIX):-len(_SHARD_SUFFIX)]) + 1 if shards else 0
+    return f'{_SHARD_PREFIX}{number:05d}{_SHARD_SUFFIX}'
+
+
+def pack(conn, archive_dir, receptor, ligand, files, shard_bytes=DEFAULT_SHARD_BYTES, remove=True):
+    """
+    把一对受体/化合物的结果文件追加到当前shard并写入索引，同一个键重复写入时索引指向新的内容
+    每条记录前有一行json头，索引丢失时可以用rebuild_index()从shard重建
+    :param files: {kind: 文件路径}，kind为ARTIFACT_NAMES中的键，不存在的文件被忽略
+    :param shard_bytes: shard超过这个大小后写入新的shard
+    :param remove: 写入后删除原来的文件
+    :return: 写入的kind列表
+    """
+    records = []
+    for kind, path in files.items():
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                records.append((kind, path, f.read()))
+    if not records:
+        return []
+    shard = _current_shard(archive_dir, shard_bytes)
+    rows = []
+    packed_at = time.time()
+    # Writers of other screens may append to the same shard, the lock keeps records contiguous.
+    with open(os.path.join(archive_dir, shard), 'ab') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            offset = f.seek(0, os.SEEK_END)
+            for kind, path, data in records:
+                header = _RECORD_MAGIC + json.dumps({
+                    'receptor': receptor, 'ligand': ligand, 'kind': kind,
+                    'length': len(data), 'path': os.path.abspath(path),
+                }).encode('utf-8') + b'\n'
+                f.write(header)
+                f.write(data)
+                rows.append((receptor, ligand, kind, shard, offset + len(header), len(data),
+                             os.path.abspath(path), packed_at))
+                offset += len(header) + len(data)
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    # The data is on disk before the index points to it, a crash in between only leaves garbage.
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    if remove:
+        for _, path, _ in records:
+            os.remove(path)
+    return [kind for kind, _, _ in records]
+
+
+def contains(conn, receptor, ligand, kind='log'):
+    return conn.execute('SELECT 1 FROM artifacts WHERE receptor = ? AND ligand = ? AND kind = ?',
+                        (receptor, ligand, kind)).fetchone() is not None
+
+
+def read(conn, archive_dir, receptor, ligand, kind):
+    """
+    按(受体, 化合物, kind)随机读取一个文件的内容
+    :return: bytes，不存在时返回None
+    """
+    row = conn.execute('SELECT shard, offset, length FROM artifacts '
+                       'WHERE receptor = ? AND ligand = ? AND kind = ?',
+                       (receptor, ligand, kind)).fetchone()
+    if row is None:
+        return None
+    shard, offset, length = row
+    fd = os.open(os.path.join(archive_dir, shard), os.O_RDONLY)
+    try:
+        data = os.pread(fd, length, offset)
+    finally:
+        os.close(fd)
+    if len(data) != length:
+        raise IOError(f'{shard} is truncated at {offset}, expected {length} bytes of '
+                      f'{receptor}/{ligand}/{kind}')
+    return data
+
+
+def entries(conn, receptor=None):
+    """:return: [(receptor, ligand, kind, length, path), ...]"""
+    query = 'SELECT receptor, ligand, kind, length, path FROM artifacts'
+    if receptor is None:
+        return conn.execute(f'{query} ORDER BY receptor, ligand, kind').fetchall()
+    return conn.execute(f'{query} WHERE receptor = ? ORDER BY ligand, kind', (receptor,)).fetchall()
+
+
+def export(conn, archive_dir, out_dir=None, receptor=None, ligands=None, kinds=None):
+    """
+    把打包的内容流式导出成单独的文件，按shard内的偏移顺序读取
+    :param out_dir: 导出到这个目录，文件名同ARTIFACT_NAMES；为None时恢复到打包前的路径
+    :param receptor: 只导出这个受体的结果
+    :param ligands: 只导出这些化合物
+    :param kinds: 只导出这些kind
+    :return: 导出的文件路径列表
+    """
+    query = 'SELECT receptor, ligand, kind, shard, offset, length, path FROM artifacts'
+    args = ()
+    if receptor is not None:
+        query += ' WHERE receptor = ?'
+        args = (receptor,)
+    ligands = None if ligands is None else set(ligands)
+    kinds = None if kinds is None else set(kinds)
+    exported = []
+    shard_file = None
+    shard_name = None
+    try:
+        for row_receptor, ligand, kind, shard, offset, length, path in conn.execute(
+                query + ' ORDER BY shard, offset', args):
+            if (ligands is not None and ligand not in ligands) or (kinds is not None and kind not in kinds):
+                continue
+            if out_dir is not None:
+                path = os.path.join(out_dir, ARTIFACT_NAMES.get(kind, '{receptor}_{ligand}.' + kind)
+                                    .format(receptor=row_receptor, ligand=ligand))
+            if shard != shard_name:
+                if shard_file is not None:
+                    shard_file.close()
+                shard_file = open(os.path.join(archive_dir, shard), 'rb')
+                shard_name = shard
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            shard_file.seek(offset)
+            with open(path, 'wb') as f:
+                remaining = length
+                while remaining:
+                    block = shard_file.read(min(remaining, _CHUNK_BYTES))
+                    if not block:
+                        raise IOError(f'{shard} is truncated at {offset}')
+                    f.write(block)
+                    remaining -= len(block)
+            exported.append(path)
+    finally:
+        if shard_file is not None:
+            shard_file.close()
+    logging.info('Exported %d files from %s', len(exported), archive_dir)
+    return exported
+
+
+def rebuild_index(archive_dir):
+    """
+    从shard中的记录头重建索引，同一个键以最后写入的记录为准，末尾不完整的记录被忽略
+    :return: 索引中的记录数
+    """
+    index_file = os.path.join(archive_dir, _INDEX_FILE)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(index_file + suffix):
+            os.remove(index_file + suffix)
+    conn = open_archive(archive_dir)
+    for shard in _shards(archive_dir):
+        shard_path = os.path.join(archive_dir, shard)
+        size = os.path.getsize(shard_path)
+        rows = []
+        with open(shard_path, 'rb') as f:
+            while True:
+                header_line = f.readline()
+                if not header_line.startswith(_RECORD_MAGIC) or not header_line.endswith(b'\n'):
+                    break
+                header = json.loads(header_line[len(_RECORD_MAGIC):])
+                offset = f.tell()
+                if offset + header['length'] > size:
+                    logging.warning('%s ends with a truncated record of %s/%s', shard,
+                                    header['receptor'], header['ligand'])
+                    break
+                rows.append((header['receptor'], header['ligand'], header['kind'], shard, offset,
+                             header['length'], header.get('path'), os.path.getmtime(shard_path)))
+                f.seek(offset + header['length'])
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    count = conn.execute('SELECT COUNT(*) FROM artifacts').fetchone()[0]
+    conn.close()
+    return count
+
+
+def benchmark(work_dir=None, pairs=10000, reads=1000, pose_bytes=20000, log_bytes=1500, seed=0):
+    """
+    比较单独文件和打包输出在写入、列出、随机读取和导出上的耗时
+    :param work_dir: 测试目录，应该和实际输出在同一个文件系统上，默认为临时目录
+    :param pairs: 模拟的受体/化合物对数
+    :param reads: 随机读取的次数
+    :return: {'per_file': {...}, 'packed': {...}}，值为秒数
+    """
+    rng = random.Random(seed)
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix='packed_archive_')
+    staging_dir = os.path.join(work_dir, 'staging')
+    files_dir = os.path.join(work_dir, 'per_file')
+    archive_dir = os.path.join(work_dir, 'packed')
+    export_dir = os.path.join(work_dir, 'export')
+    for path in (staging_dir, files_dir):
+        os.makedirs(path, exist_ok=True)
+    pose = b'ATOM\n' * (pose_bytes // 5)
+    log = b'-----+\n' * (log_bytes // 7)
+    ligands = [f'ligand{i:07d}' for i in range(pairs)]
+    sample = rng.sample(ligands, min(reads, pairs))
+    timings = {'per_file': {}, 'packed': {}}
+    try:
+        start = time.monotonic()
+        for ligand in ligands:
+            for name, data in ((f'rec_{ligand}.pdbqt', pose), (f'rec_{ligand}.txt', log)):
+                with open(os.path.join(files_dir, name), 'wb') as f:
+                    f.write(data)
+        timings['per_file']['write'] = time.monotonic() - start
+
+        conn = open_archive(archive_dir)
+        start = time.monotonic()
+        for ligand in ligands:
+            # Docking writes small files first in both layouts, packing adds the append.
+            paths = {'pose': os.path.join(staging_dir, 'pose.pdbqt'),
+                     'log': os.path.join(staging_dir, 'log.txt')}
+            for kind, data in (('pose', pose), ('log', log)):
+                with open(paths[kind], 'wb') as f:
+                    f.write(data)
+            pack(conn, archive_dir, 'rec', ligand, paths)
+        timings['packed']['write'] = time.monotonic() - start
+
+        start = time.monotonic()
+        count = sum(1 for _ in os.scandir(files_dir))
+        timings['per_file']['list'] = time.monotonic() - start
+        start = time.monotonic()
+        packed_count = len(entries(conn, 'rec'))
+        timings['packed']['list'] = time.monotonic() - start
+        assert count == packed_count == 2 * pairs, (count, packed_count)
+
+        start = time.monotonic()
+        for ligand in sample:
+            with open(os.path.join(files_dir, f'rec_{ligand}.pdbqt'), 'rb') as f:
+                f.read()
+        timings['per_file']['random_read'] = time.monotonic() - start
+        start = time.monotonic()
+        for ligand in sample:
+            read(conn, archive_dir, 'rec', ligand, 'pose')
+        timings['packed']['random_read'] = time.monotonic() - start
+
+        start = time.monotonic()
+        shutil.copytree(files_dir, os.path.join(work_dir, 'per_file_copy'))
+        timings['per_file']['copy'] = time.monotonic() - start
+        start = time.monotonic()
+        shutil.copytree(archive_dir, os.path.join(work_dir, 'packed_copy'))
+        timings['packed']['copy'] = time.monotonic() - start
+
+        start = time.monotonic()
+        export(conn, archive_dir, export_dir)
+        timings['packed']['export'] = time.monotonic() - start
+        conn.close()
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return timings
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('archive_dir', type=str, help='the packed output directory, e.g. /tmp/alphafold/archive')
+    parser.add_argument('--receptor', type=str, default=None, help='only list or export the results of this receptor')
+    parser.add_argument('--ligand', type=str, default=None, help='print one file of this ligand, needs --receptor')
+    parser.add_argument('--kind', type=str, default='log', help='the file printed with --ligand, one of ' + ', '.join(ARTIFACT_NAMES))
+    parser.add_argument('--export', type=str, default=None, help='write the packed results back as separate files into this directory, "original" restores the paths they were packed from')
+    parser.add_argument('--rebuild_index', action='store_true', help='rebuild index.sqlite from the record headers in the shards')
+    parser.add_argument('--benchmark', type=int, default=None, help='compare the per-file and packed layouts with this many pairs, using archive_dir as scratch space')
+    args = parser.parse_args()
+    if args.benchmark:
+        work_dir = tempfile.mkdtemp(prefix='benchmark_', dir=args.archive_dir)
+        try:
+            results = benchmark(work_dir, pairs=args.benchmark)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        for operation, seconds in results['per_file'].items():
+            print(f'{operation}\tper_file {seconds:.3f}s\tpacked {results["packed"][operation]:.3f}s')
+        print(f'export\tpacked {results["packed"]["export"]:.3f}s')
+    elif args.rebuild_index:
+        print(rebuild_index(args.archive_dir))
+    else:
+        conn = open_archive(args.archive_dir)
+        if args.ligand:
+            data = read(conn, args.archive_dir, args.receptor, args.ligand, args.kind)
+            if data is None:
+                raise SystemExit(f'{args.receptor}/{args.ligand}/{args.kind} is not in {args.archive_dir}')
+            print(data.decode('utf-8', errors='replace'), end='')
+        elif args.export:
+            export(conn, args.archive_dir, None if args.export == 'original' else args.export,
+                   receptor=args.receptor)
+        else:
+            for receptor, ligand, kind, length, path in entries(conn, args.receptor):
+                print(f'{receptor}\t{ligand}\t{kind}\t{length}\t{path}')
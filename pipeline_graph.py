@@ -0,0 +1,92 @@
+import collections
+import concurrent.futures
+import time
+
+from absl import logging
+
+
+StageTiming = collections.namedtuple('StageTiming', ['name', 'deps', 'start', 'end'])
+
+
+def run_stages(stages, max_workers=None):
+    """
+    按依赖关系并行执行流水线的各个阶段，一个阶段的依赖全部完成后立即开始
+    :param stages: [(name, fn, deps), ...]，fn不带参数，deps为依赖的阶段名称
+    :param max_workers: 最多同时执行的阶段数
+    :return: (results, timings)，两者都以阶段名称为键
+    """
+    by_name = collections.OrderedDict()
+    for name, fn, deps in stages:
+        if name in by_name:
+            raise ValueError(f'Duplicate stage "{name}"')
+        by_name[name] = (fn, tuple(deps))
+    for name, (_, deps) in by_name.items():
+        for dep in deps:
+            if dep not in by_name:
+                raise ValueError(f'Stage "{name}" depends on unknown stage "{dep}"')
+
+    results = {}
+    timings = {}
+    starts = {}
+    running = {}
+    failure = None
+    origin = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_ready():
+            for name, (fn, deps) in by_name.items():
+                if name in results or name in running.values():
+                    continue
+                if all(dep in results for dep in deps):
+                    starts[name] = time.monotonic() - origin
+                    running[executor.submit(fn)] = name
+
+        submit_ready()
+        while running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                timings[name] = StageTiming(name, by_name[name][1], starts[name],
+                                            time.monotonic() - origin)
+                try:
+                    results[name] = future.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    logging.error('Stage %s failed: %s', name, e)
+                    failure = failure or e
+            # After a failure let the running stages finish but start nothing new.
+            if failure is None:
+                submit_ready()
+    if failure is not None:
+        raise failure
+    if len(results) != len(by_name):
+        raise ValueError('Stage dependencies contain a cycle')
+    return results, timings
+
+
+def critical_path(timings):
+    """
+    返回决定总耗时的阶段链，从第一个阶段到最后结束的阶段
+    :param timings: run_stages()返回的timings
+    :return: [StageTiming, ...]
+    """
+    if not timings:
+        return []
+    path = [max(timings.values(), key=lambda t: t.end)]
+    while path[-1].deps:
+        path.append(max((timings[dep] for dep in path[-1].deps), key=lambda t: t.end))
+    return path[::-1]
+
+
+def log_report(timings):
+    """记录每个阶段的耗时以及关键路径上耗时最长的阶段"""
+    for timing in sorted(timings.values(), key=lambda t: t.start):
+        logging.info('stage %-30s start %8.1fs  duration %8.1fs',
+                     timing.name, timing.start, timing.end - timing.start)
+    path = critical_path(timings)
+    if path:
+        dominant = max(path, key=lambda t: t.end - t.start)
+        logging.info('critical path %s (%.1fs), dominated by %s (%.1fs)',
+                     ' -> '.join(t.name for t in path), path[-1].end,
+                     dominant.name, dominant.end - dominant.start)
+        return dominant.name
+    return None
@@ -0,0 +1,200 @@
+import os
+import shutil
+
+import numpy as np
+from absl import logging
+
+from receptor_prep import read_pdb
+
+
+_GRID_SPACING = 1.0
+_PROBE_RADIUS = 1.6
+_MAX_SCAN = 10.0
+# Scan directions for buriedness: the 3 axes and the 4 cube diagonals.
+_DIRECTIONS = np.array([[1, 0, 0], [0, 1, 0], [0, 0, 1],
+                        [1, 1, 1], [1, 1, -1], [1, -1, 1], [-1, 1, 1]])
+_BOX_LINES = ('center_x', 'center_y', 'center_z', 'size_x', 'size_y', 'size_z')
+
+
+def _shift(grid, offset, fill):
+    """grid shifted so that result[p] == grid[p + offset], out of range is fill."""
+    result = np.full_like(grid, fill)
+    src = []
+    dst = []
+    for o, n in zip(offset, grid.shape):
+        if o >= 0:
+            src.append(slice(o, n))
+            dst.append(slice(0, n - o))
+        else:
+            src.append(slice(0, n + o))
+            dst.append(slice(-o, n))
+    result[tuple(dst)] = grid[tuple(src)]
+    return result
+
+
+def _occupancy(coords, origin, shape, radius):
+    """Mark grid points closer than radius to any atom."""
+    occupied = np.zeros(shape, dtype=bool)
+    reach = int(np.ceil(radius / _GRID_SPACING))
+    base = np.rint((coords - origin) / _GRID_SPACING).astype(np.int64)
+    stencil = np.arange(-reach, reach + 1)
+    for dx in stencil:
+        for dy in stencil:
+            for dz in stencil:
+                index = base + np.array([dx, dy, dz])
+                points = origin + index * _GRID_SPACING
+                close = np.sum((points - coords) ** 2, axis=1) < radius ** 2
+                inside = np.all((index >= 0) & (index < shape), axis=1)
+                index = index[close & inside]
+                occupied[index[:, 0], index[:, 1], index[:, 2]] = True
+    return occupied
+
+
+def _buriedness(occupied):
+    """Number of scan directions in which an empty point is enclosed on both sides."""
+    steps = int(_MAX_SCAN / _GRID_SPACING)
+    count = np.zeros(occupied.shape, dtype=np.int64)
+    for direction in _DIRECTIONS:
+        forward = np.zeros(occupied.shape, dtype=bool)
+        backward = np.zeros(occupied.shape, dtype=bool)
+        for step in range(1, steps + 1):
+            forward |= _shift(occupied, direction * step, False)
+            backward |= _shift(occupied, -direction * step, False)
+        count += forward & backward
+    return np.where(occupied, 0, count)
+
+
+def _label(mask):
+    """Connected components of mask (6-neighbourhood), -1 outside mask."""
+    points = np.argwhere(mask)
+    flat = np.ravel_multi_index(points.T, mask.shape)
+    parent = np.arange(len(flat))
+    neighbours = []
+    for axis in range(3):
+        for o in (1, -1):
+            moved = points.copy()
+            moved[:, axis] += o
+            valid = (moved[:, axis] >= 0) & (moved[:, axis] < mask.shape[axis])
+            index = np.full(len(flat), -1)
+            target = np.ravel_multi_index(moved[valid].T, mask.shape)
+            pos = np.minimum(np.searchsorted(flat, target), len(flat) - 1)
+            index[np.flatnonzero(valid)] = np.where(flat[pos] == target, pos, -1)
+            neighbours.append(index)
+    # Min-label propagation over the mask points with pointer jumping.
+    while True:
+        best = parent.copy()
+        for index in neighbours:
+            has = index >= 0
+            best[has] = np.minimum(best[has], parent[index[has]])
+        best = best[best]
+        if np.array_equal(best, parent):
+            break
+        parent = best
+    labels = np.full(mask.shape, -1, dtype=np.int64)
+    labels[tuple(points.T)] = parent
+    return labels
+
+
+def find_pockets(pdb_file, min_buriedness=5, min_points=20, use_plddt=True, padding=5.0,
+                 min_size=15.0):
+    """
+    在网格上寻找被蛋白包围的空腔作为口袋
+    :param pdb_file: 受体pdb文件，例如AlphaFold输出的ranked_0.pdb
+    :param min_buriedness: 7个扫描方向中至少有几个方向两侧都被蛋白挡住
+    :param min_points: 口袋最少的网格点数(1 A^3 每点)
+    :param use_plddt: 用B-factor列中的pLDDT给口袋打分加权，低置信度区域的口袋排在后面
+    :param padding: 对接盒子在口袋范围外每边增加的距离
+    :param min_size: 对接盒子每边的最小长度
+    :return: [{'center', 'size', 'volume', 'score', 'plddt'}, ...]，按score从高到低
+    """
+    atoms = read_pdb(pdb_file)
+    heavy = atoms['element'] != 'H'
+    coords = atoms['coords'][heavy]
+    bfactor = atoms['bfactor'][heavy]
+
+    origin = coords.min(axis=0) - _MAX_SCAN / 2
+    shape = tuple(np.ceil((coords.max(axis=0) + _MAX_SCAN / 2 - origin) / _GRID_SPACING)
+                  .astype(np.int64) + 1)
+    occupied = _occupancy(coords, origin, shape, _PROBE_RADIUS)
+    buried = _buriedness(occupied) >= min_buriedness
+    labels = _label(buried)
+
+    ids, counts = np.unique(labels[labels >= 0], return_counts=True)
+    pockets = []
+    for pocket_id, count in zip(ids, counts):
+        if count < min_points:
+            continue
+        points = origin + np.argwhere(labels == pocket_id) * _GRID_SPACING
+        # Atoms lining the pocket: within 4 A of any pocket point.
+        lo, hi = points.min(axis=0) - 4.0, points.max(axis=0) + 4.0
+        near = np.all((coords > lo) & (coords < hi), axis=1)
+        lining = near.copy()
+        if np.any(near):
+            d2 = np.min(np.sum((coords[near][:, None, :] - points[None, :, :]) ** 2, axis=-1), axis=1)
+            lining[near] = d2 < 16.0
+        plddt = float(np.mean(bfactor[lining])) if np.any(lining) else 0.0
+        score = float(count)
+        if use_plddt and 0.0 < plddt <= 100.0:
+            score *= plddt / 100.0
+        extent = points.max(axis=0) - points.min(axis=0)
+        pockets.append({
+            'center': (points.max(axis=0) + points.min(axis=0)) / 2,
+            'size': np.maximum(extent + 2 * padding, min_size),
+            'volume': float(count) * _GRID_SPACING ** 3,
+            'plddt': plddt,
+            'score': score,
+        })
+    pockets.sort(key=lambda p: -p['score'])
+    return pockets
+
+
+def write_vina_config(config_file, center, size, template_config=None):
+    """
+    写vina的配置文件，盒子之外的设置(exhaustiveness, num_modes, seed, ...)从template_config复制
+    """
+    lines = []
+    if template_config and os.path.exists(template_config):
+        with open(template_config, 'r') as f:
+            for line in f:
+                key = line.split('=', 1)[0].strip()
+                if key not in _BOX_LINES:
+                    lines.append(line if line.endswith('\n') else line + '\n')
+    for axis, value in zip('xyz', center):
+        lines.append(f'center_{axis} = {value:.3f}\n')
+    for axis, value in zip('xyz', size):
+        lines.append(f'size_{axis} = {value:.1f}\n')
+    with open(config_file, 'w') as f:
+        f.writelines(lines)
+    return config_file
+
+
+def receptor_config(pdb_file, config_file, template_config='/tmp/autodock_vina/config.txt',
+                    num_pockets=1, use_plddt=True):
+    """
+    找口袋并写出该受体专用的vina配置文件
+    :param num_pockets: 盒子覆盖得分最高的几个口袋
+    :return: config_file，没有找到口袋时复制template_config
+    """
+    pockets = find_pockets(pdb_file, use_plddt=use_plddt)[:num_pockets]
+    if not pockets:
+        logging.warning('No pocket found in %s, using the box of %s', pdb_file, template_config)
+        shutil.copyfile(template_config, config_file)
+        return config_file
+    for pocket in pockets:
+        logging.info('Pocket center %s size %s volume %.0f pLDDT %.1f', np.round(pocket['center'], 1),
+                     pocket['size'], pocket['volume'], pocket['plddt'])
+    lo = np.min([p['center'] - p['size'] / 2 for p in pockets], axis=0)
+    hi = np.max([p['center'] + p['size'] / 2 for p in pockets], axis=0)
+    return write_vina_config(config_file, (lo + hi) / 2, hi - lo, template_config)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pdb_file', type=str, help='the receptor pdb file, e.g. /tmp/alphafold/Y265H/ranked_0.pdb')
+    parser.add_argument('config_file', type=str, help='the vina config file to write, e.g. /tmp/alphafold/Y265H_config.txt')
+    parser.add_argument('--num_pockets', type=int, default=1, help='number of top pockets the box has to cover')
+    parser.add_argument('--no_plddt', action='store_true', help='do not weight pockets by the pLDDT in the B-factor column')
+    args = parser.parse_args()
+    print(receptor_config(args.pdb_file, args.config_file, num_pockets=args.num_pockets,
+                          use_plddt=not args.no_plddt))
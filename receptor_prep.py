@@ -0,0 +1,478 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import supervise
+
+
+# Covalent radii (A) used for distance based bond perception.
+_COVALENT_RADII = {'H': 0.31, 'C': 0.76, 'N': 0.71, 'O': 0.66, 'S': 1.05,
+                   'P': 1.07, 'F': 0.57, 'CL': 1.02, 'BR': 1.20, 'I': 1.39,
+                   'SE': 1.20}
+_BOND_TOLERANCE = 0.45
+
+# Gasteiger-Marsili PEOE parameters (a, b, c) by element and hybridization.
+_GASTEIGER_PARAMS = {
+    ('H', 0): (7.17, 6.24, -0.56),
+    ('C', 3): (7.98, 9.18, 1.88),
+    ('C', 2): (8.79, 9.32, 1.51),
+    ('N', 3): (11.54, 10.82, 1.36),
+    ('N', 2): (12.87, 11.15, 0.85),
+    ('O', 3): (14.18, 12.92, 1.39),
+    ('O', 2): (17.07, 13.79, 0.47),
+    ('S', 3): (10.14, 9.13, 1.38),
+    ('P', 3): (8.90, 8.24, 0.96),
+    ('F', 3): (14.66, 13.85, 2.31),
+    ('CL', 3): (11.00, 9.69, 1.35),
+    ('BR', 3): (10.08, 8.47, 1.16),
+    ('I', 3): (9.90, 7.96, 0.96),
+}
+_HYDROGEN_CHI_PLUS = 20.02
+_GASTEIGER_ITERATIONS = 6
+
+# sp2 heavy atoms of the standard residues, everything else is treated as sp3.
+_BACKBONE_SP2 = {'N', 'C', 'O', 'OXT'}
+_SIDECHAIN_SP2 = {
+    'ARG': {'NE', 'CZ', 'NH1', 'NH2'},
+    'ASN': {'CG', 'OD1', 'ND2'},
+    'ASP': {'CG', 'OD1', 'OD2'},
+    'GLN': {'CD', 'OE1', 'NE2'},
+    'GLU': {'CD', 'OE1', 'OE2'},
+    'HIS': {'CG', 'ND1', 'CD2', 'CE1', 'NE2'},
+    'PHE': {'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ'},
+    'TYR': {'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ'},
+    'TRP': {'CG', 'CD1', 'CD2', 'NE1', 'CE2', 'CE3', 'CZ2', 'CZ3', 'CH2'},
+}
+# Carbons written with the AutoDock aromatic type 'A'.
+_AROMATIC_CARBONS = {
+    'HIS': {'CG', 'CD2', 'CE1'},
+    'PHE': {'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ'},
+    'TYR': {'CG', 'CD1', 'CD2', 'CE1', 'CE2', 'CZ'},
+    'TRP': {'CG', 'CD1', 'CD2', 'CE2', 'CE3', 'CZ2', 'CZ3', 'CH2'},
+}
+
+# Polar hydrogens added when the input has none, as
+# (hydrogen name, parent, geometry, reference atoms, dihedrals).
+# 'bisector': in the plane of the two references, opposite their bisector.
+# 'nerf': placed from (angle reference, dihedral reference) at each dihedral.
+_POLAR_HYDROGENS = {
+    'SER': [('HG', 'OG', 'nerf', ('CB', 'CA'), (180.0,))],
+    'THR': [('HG1', 'OG1', 'nerf', ('CB', 'CA'), (180.0,))],
+    'TYR': [('HH', 'OH', 'nerf', ('CZ', 'CE1'), (180.0,))],
+    'LYS': [('HZ', 'NZ', 'nerf', ('CE', 'CD'), (180.0, 60.0, -60.0))],
+    'ARG': [('HE', 'NE', 'bisector', ('CD', 'CZ'), ()),
+            ('HH1', 'NH1', 'nerf', ('CZ', 'NE'), (0.0, 180.0)),
+            ('HH2', 'NH2', 'nerf', ('CZ', 'NE'), (0.0, 180.0))],
+    'ASN': [('HD2', 'ND2', 'nerf', ('CG', 'CB'), (0.0, 180.0))],
+    'GLN': [('HE2', 'NE2', 'nerf', ('CD', 'CG'), (0.0, 180.0))],
+    'HIS': [('HE2', 'NE2', 'bisector', ('CD2', 'CE1'), ())],
+    'TRP': [('HE1', 'NE1', 'bisector', ('CD1', 'CE2'), ())],
+}
+_HYDROGEN_BOND_LENGTH = {'N': 1.01, 'O': 0.96}
+_SP2_ANGLE = 120.0
+_SP3_ANGLE = 109.5
+
+_WATER = {'HOH', 'WAT', 'DOD'}
+
+
+def _element_of(line):
+    element = line[76:78].strip().upper()
+    if element:
+        return element
+    name = line[12:16]
+    # Two letter elements are right aligned to column 13 in the atom name.
+    if name[0] != ' ' and not name[0].isdigit() and name[:2].strip().upper() in _COVALENT_RADII:
+        return name[:2].strip().upper()
+    return name.strip().lstrip('0123456789')[:1].upper()
+
+
+def _float(text, default):
+    text = text.strip()
+    return float(text) if text else default
+
+
+def read_pdb(pdb_file):
+    """
+    把pdb文件中第一个模型的原子读成NumPy数组
+    :param pdb_file: pdb文件路径
+    :return: dict，每个字段是长度为原子数的数组
+    """
+    records = []
+    with open(pdb_file, 'r') as f:
+        for line in f:
+            if line.startswith('ENDMDL'):
+                break
+            if not line.startswith(('ATOM', 'HETATM')):
+                continue
+            if line[16] not in (' ', 'A', '1'):
+                continue
+            resname = line[17:20].strip()
+            if resname in _WATER:
+                continue
+            records.append((line[:6].strip(), line[12:16], resname, line[21],
+                            int(line[22:26]), line[26], float(line[30:38]),
+                            float(line[38:46]), float(line[46:54]),
+                            _float(line[54:60], 1.0), _float(line[60:66], 0.0),
+                            _element_of(line)))
+    if not records:
+        raise ValueError(f'No atoms found in {pdb_file}')
+    columns = list(zip(*records))
+    atoms = {
+        'record': np.array(columns[0]),
+        'name_field': np.array(columns[1]),
+        'name': np.array([name.strip() for name in columns[1]]),
+        'resname': np.array(columns[2]),
+        'chain': np.array(columns[3]),
+        'resseq': np.array(columns[4], dtype=np.int64),
+        'icode': np.array(columns[5]),
+        'coords': np.stack([columns[6], columns[7], columns[8]], axis=1),
+        'occupancy': np.array(columns[9]),
+        'bfactor': np.array(columns[10]),
+        'element': np.array(columns[11]),
+    }
+    # A residue index that changes whenever chain, number or insertion code does.
+    keys = np.char.add(np.char.add(atoms['chain'], atoms['resseq'].astype(str)), atoms['icode'])
+    changed = np.ones(len(keys), dtype=bool)
+    changed[1:] = keys[1:] != keys[:-1]
+    atoms['residue'] = np.cumsum(changed) - 1
+    return atoms
+
+
+def find_bonds(atoms):
+    """
+    按共价半径判断成键，只比较同一残基以及相邻残基中的原子
+    :return: (n_bonds, 2)的原子下标数组，i < j
+    """
+    coords = atoms['coords']
+    residue = atoms['residue']
+    radii = np.array([_COVALENT_RADII.get(e, 1.5) for e in atoms['element']])
+    n_residues = residue[-1] + 1
+    starts = np.searchsorted(residue, np.arange(n_residues + 1))
+    width = int(np.max(np.diff(starts)))
+
+    # Pad residue r and r + 1 into one block so peptide bonds are found too.
+    block = np.full((n_residues, 2 * width), -1, dtype=np.int64)
+    offsets = np.arange(width)
+    for shift in (0, 1):
+        res = np.arange(n_residues) + shift
+        valid_res = res < n_residues
+        index = starts[np.minimum(res, n_residues - 1)][:, None] + offsets[None, :]
+        in_residue = (index < starts[np.minimum(res, n_residues - 1) + 1][:, None]) & valid_res[:, None]
+        block[:, shift * width:(shift + 1) * width] = np.where(in_residue, index, -1)
+
+    mask = block >= 0
+    safe = np.where(mask, block, 0)
+    xyz = coords[safe]
+    square = np.einsum('rad,rad->ra', xyz, xyz)
+    dist2 = square[:, :, None] + square[:, None, :] - 2 * np.einsum('rad,rbd->rab', xyz, xyz)
+    cutoff = radii[safe][:, :, None] + radii[safe][:, None, :] + _BOND_TOLERANCE
+    bonded = (dist2 < cutoff ** 2) & (dist2 > 0.16) & mask[:, :, None] & mask[:, None, :]
+    r, a, b = np.nonzero(bonded)
+    pairs = np.stack([block[r, a], block[r, b]], axis=1)
+    pairs = pairs[pairs[:, 0] < pairs[:, 1]]
+    # Two hydrogens are never bonded to each other in a receptor.
+    hydrogen = atoms['element'] == 'H'
+    pairs = pairs[~(hydrogen[pairs[:, 0]] & hydrogen[pairs[:, 1]])]
+
+    # Disulfide bridges between residues that are far apart in sequence.
+    sulfur = np.nonzero((atoms['element'] == 'S') & (atoms['name'] == 'SG'))[0]
+    if len(sulfur) > 1:
+        d = np.linalg.norm(coords[sulfur][:, None] - coords[sulfur][None, :], axis=-1)
+        i, j = np.nonzero(np.triu(d < 2.5, k=1))
+        pairs = np.concatenate([pairs, np.stack([sulfur[i], sulfur[j]], axis=1)])
+    return np.unique(pairs, axis=0)
+
+
+def _unit(v):
+    return v / np.linalg.norm(v, axis=-1, keepdims=True)
+
+
+def _place_nerf(parent, angle_ref, dihedral_ref, length, angle, dihedral):
+    """Place atoms at length/angle/dihedral from (dihedral_ref, angle_ref, parent)."""
+    bc = _unit(parent - angle_ref)
+    n = _unit(np.cross(angle_ref - dihedral_ref, bc))
+    m = np.cross(n, bc)
+    angle = np.radians(angle)
+    dihedral = np.radians(dihedral)
+    d = (-length * np.cos(angle) * bc
+         + length * np.sin(angle) * np.cos(dihedral) * m
+         + length * np.sin(angle) * np.sin(dihedral) * n)
+    return parent + d
+
+
+def _place_bisector(parent, ref_a, ref_b, length):
+    direction = _unit(_unit(parent - ref_a) + _unit(parent - ref_b))
+    return parent + length * direction
+
+
+def _hydrogen_name(base, count, k):
+    name = f'{base}{k + 1}' if count > 1 else base
+    return name if len(name) == 4 else f' {name:<3}'
+
+
+def add_polar_hydrogens(atoms):
+    """
+    为没有氢原子的结构加上极性氢(骨架酰胺氢和侧链N/O上的氢)
+    :return: 新的atoms，氢原子紧跟在所连接的重原子之后
+    """
+    lookup = {}
+    for i, (res, name) in enumerate(zip(atoms['residue'], atoms['name'])):
+        lookup[(res, name)] = i
+    coords = atoms['coords']
+    chain = atoms['chain']
+    new = []  # (parent index, order, name field, coords)
+
+    def add(parent, ref_a, ref_b, names, geometry, dihedrals, parent_element):
+        if not len(parent):
+            return
+        length = _HYDROGEN_BOND_LENGTH[parent_element]
+        p, a, b = coords[parent], coords[ref_a], coords[ref_b]
+        if geometry == 'bisector':
+            positions = [_place_bisector(p, a, b, length)]
+        else:
+            angle = _SP3_ANGLE if len(dihedrals) != 2 else _SP2_ANGLE
+            positions = [_place_nerf(p, a, b, length, angle, dihedral)
+                         for dihedral in dihedrals]
+        for k, xyz in enumerate(positions):
+            for i, parent_index in enumerate(parent):
+                new.append((parent_index, k, names[k], xyz[i]))
+
+    # Backbone amide hydrogens, or three hydrogens on a chain's first nitrogen.
+    n_index = np.nonzero(atoms['name'] == 'N')[0]
+    amide, n_term = [], []
+    for i in n_index:
+        res = atoms['residue'][i]
+        ca = lookup.get((res, 'CA'))
+        if ca is None:
+            continue
+        prev_c = lookup.get((res - 1, 'C'))
+        if prev_c is not None and chain[prev_c] == chain[i] and \
+                np.linalg.norm(coords[prev_c] - coords[i]) < 2.0:
+            if atoms['resname'][i] != 'PRO':
+                amide.append((i, prev_c, ca))
+        elif (res, 'C') in lookup:
+            n_term.append((i, ca, lookup[(res, 'C')]))
+    if amide:
+        amide = np.array(amide)
+        add(amide[:, 0], amide[:, 1], amide[:, 2], [' H  '], 'bisector', (), 'N')
+    if n_term:
+        n_term = np.array(n_term)
+        add(n_term[:, 0], n_term[:, 1], n_term[:, 2],
+            [_hydrogen_name('H', 3, k) for k in range(3)], 'nerf',
+            (180.0, 60.0, -60.0), 'N')
+
+    for resname, rules in _POLAR_HYDROGENS.items():
+        residues = np.unique(atoms['residue'][atoms['resname'] == resname])
+        for base, parent_name, geometry, refs, dihedrals in rules:
+            found = [(lookup.get((r, parent_name)), lookup.get((r, refs[0])),
+                      lookup.get((r, refs[1]))) for r in residues]
+            found = np.array([f for f in found if None not in f], dtype=np.int64).reshape(-1, 3)
+            count = max(1, len(dihedrals))
+            names = [_hydrogen_name(base, count, k) for k in range(count)]
+            add(found[:, 0], found[:, 1], found[:, 2], names, geometry,
+                dihedrals, parent_name[0])
+
+    if not new:
+        return atoms
+    parents = np.array([n[0] for n in new])
+    # Order hydrogens right after their parent atom.
+    order_key = np.concatenate([np.arange(len(coords), dtype=np.float64),
+                                parents + 0.1 + 0.01 * np.array([n[1] for n in new])])
+    order = np.argsort(order_key, kind='stable')
+    result = {}
+    for field, values in atoms.items():
+        if field == 'coords':
+            extra = np.array([n[3] for n in new])
+        elif field == 'name_field':
+            extra = np.array([n[2] for n in new])
+        elif field == 'name':
+            extra = np.array([n[2].strip() for n in new])
+        elif field == 'element':
+            extra = np.array(['H'] * len(new))
+        else:
+            extra = values[parents]
+        result[field] = np.concatenate([values, extra])[order]
+    return result
+
+
+def _hybridization(atoms):
+    hyb = np.full(len(atoms['name']), 3, dtype=np.int64)
+    hyb[atoms['element'] == 'H'] = 0
+    is_backbone_sp2 = np.isin(atoms['name'], list(_BACKBONE_SP2)) & (atoms['record'] == 'ATOM')
+    hyb[is_backbone_sp2] = 2
+    for resname, names in _SIDECHAIN_SP2.items():
+        hyb[(atoms['resname'] == resname) & np.isin(atoms['name'], list(names))] = 2
+    return hyb
+
+
+def gasteiger_charges(atoms, bonds):
+    """
+    向量化的Gasteiger-Marsili PEOE电荷计算
+    :return: 每个原子的部分电荷
+    """
+    n = len(atoms['name'])
+    hyb = _hybridization(atoms)
+    params = np.zeros((n, 3))
+    has_params = np.zeros(n, dtype=bool)
+    for i, (element, h) in enumerate(zip(atoms['element'], hyb)):
+        p = _GASTEIGER_PARAMS.get((element, h)) or _GASTEIGER_PARAMS.get((element, 3))
+        if p is not None:
+            params[i] = p
+            has_params[i] = True
+    a, b, c = params[:, 0], params[:, 1], params[:, 2]
+    chi_plus = np.where(atoms['element'] == 'H', _HYDROGEN_CHI_PLUS, a + b + c)
+
+    # Atoms without parameters (metals) keep a zero charge and take no part.
+    bonds = bonds[has_params[bonds[:, 0]] & has_params[bonds[:, 1]]]
+    i, j = bonds[:, 0], bonds[:, 1]
+    q = np.zeros(n)
+    damping = 1.0
+    for _ in range(_GASTEIGER_ITERATIONS):
+        damping *= 0.5
+        chi = a + b * q + c * q * q
+        donor_chi_plus = np.where(chi[i] < chi[j], chi_plus[i], chi_plus[j])
+        dq = damping * (chi[j] - chi[i]) / donor_chi_plus
+        np.add.at(q, i, dq)
+        np.add.at(q, j, -dq)
+    return q
+
+
+def autodock_types(atoms, bonds):
+    """按AutoDock4的规则给原子分配类型 (C, A, N, NA, OA, SA, HD, ...)"""
+    n = len(atoms['name'])
+    element = atoms['element']
+    neighbors = np.zeros(n, dtype=np.int64)
+    hydrogens = np.zeros(n, dtype=np.int64)
+    np.add.at(neighbors, bonds.ravel(), 1)
+    is_h = element == 'H'
+    np.add.at(hydrogens, bonds[:, 0], is_h[bonds[:, 1]])
+    np.add.at(hydrogens, bonds[:, 1], is_h[bonds[:, 0]])
+    heavy_neighbors = neighbors - hydrogens
+
+    types = np.array([e.capitalize() for e in element], dtype='<U2')
+    types[element == 'C'] = 'C'
+    for resname, names in _AROMATIC_CARBONS.items():
+        types[(atoms['resname'] == resname) & np.isin(atoms['name'], list(names))] = 'A'
+    nitrogen = element == 'N'
+    types[nitrogen] = 'N'
+    types[nitrogen & (hydrogens == 0) & (heavy_neighbors < 3)] = 'NA'
+    types[element == 'O'] = 'OA'
+    types[element == 'S'] = 'SA'
+    types[is_h] = 'H'
+    # Hydrogens bonded to N or O are polar and become hydrogen bond donors.
+    for x, y in ((bonds[:, 0], bonds[:, 1]), (bonds[:, 1], bonds[:, 0])):
+        polar = is_h[x] & np.isin(element[y], ['N', 'O'])
+        types[x[polar]] = 'HD'
+    return types
+
+
+def _merge_nonpolar_hydrogens(atoms, bonds, charges, types):
+    """把非极性氢的电荷加到所连的重原子上并删除这些氢"""
+    nonpolar = types == 'H'
+    charges = charges.copy()
+    for x, y in ((bonds[:, 0], bonds[:, 1]), (bonds[:, 1], bonds[:, 0])):
+        merge = nonpolar[x] & ~nonpolar[y]
+        np.add.at(charges, y[merge], charges[x[merge]])
+    keep = ~nonpolar
+    atoms = {field: values[keep] for field, values in atoms.items()}
+    return atoms, charges[keep], types[keep]
+
+
+def write_pdbqt(atoms, charges, types, pdbqt_file):
+    lines = []
+    previous_chain = None
+    for k in range(len(charges)):
+        chain = atoms['chain'][k]
+        if previous_chain is not None and chain != previous_chain:
+            lines.append('TER\n')
+        previous_chain = chain
+        x, y, z = atoms['coords'][k]
+        lines.append('%-6s%5d %4s %3s %1s%4d%1s   %8.3f%8.3f%8.3f%6.2f%6.2f    %6.3f %-2s\n' % (
+            atoms['record'][k], (k + 1) % 100000, atoms['name_field'][k],
+            atoms['resname'][k], chain, atoms['resseq'][k], atoms['icode'][k],
+            x, y, z, atoms['occupancy'][k], atoms['bfactor'][k], charges[k], types[k]))
+    lines.append('TER\n')
+    with open(pdbqt_file, 'w') as f:
+        f.writelines(lines)
+
+
+def prepare_receptor(pdb_file, pdbqt_file):
+    """
+    在进程内把受体pdb转换成pdbqt：加极性氢、分配AutoDock原子类型、计算Gasteiger电荷
+    输入已有氢原子(例如AlphaFold relax后的结构)时保留极性氢，非极性氢的电荷合并到重原子上
+    :param pdb_file: 输入的pdb文件
+    :param pdbqt_file: 输出的pdbqt文件
+    :return: 写入的原子数
+    """
+    atoms = read_pdb(pdb_file)
+    if not np.any(atoms['element'] == 'H'):
+        atoms = add_polar_hydrogens(atoms)
+    bonds = find_bonds(atoms)
+    charges = gasteiger_charges(atoms, bonds)
+    types = autodock_types(atoms, bonds)
+    atoms, charges, types = _merge_nonpolar_hydrogens(atoms, bonds, charges, types)
+    write_pdbqt(atoms, charges, types, pdbqt_file)
+    return len(charges)
+
+
+def _read_pdbqt_atoms(pdbqt_file):
+    atoms = {}
+    with open(pdbqt_file, 'r') as f:
+        for line in f:
+            if line.startswith(('ATOM', 'HETATM')):
+                key = (line[21], int(line[22:26]), line[12:16].strip())
+                atoms[key] = (float(line[70:76]), line[77:79].strip())
+    return atoms
+
+
+def compare_with_obabel(pdb_file, repeats=3, work_dir=None):
+    """
+    与 obabel -xr 的速度和输出做比较
+    :return: dict，包含两者的平均耗时、共同重原子上原子类型一致的比例和电荷的RMSD
+    """
+    created = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp()
+    ours = os.path.join(work_dir, 'native.pdbqt')
+    theirs = os.path.join(work_dir, 'obabel.pdbqt')
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        prepare_receptor(pdb_file, ours)
+    native_time = (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        supervise.run_command('obabel', ['obabel', '-ipdb', pdb_file, '-xr', '-h',
+                                         '--partialcharge', 'gasteiger',
+                                         '-opdbqt', '-O', theirs],
+                              expected_output=theirs)
+    obabel_time = (time.perf_counter() - start) / repeats
+
+    a, b = _read_pdbqt_atoms(ours), _read_pdbqt_atoms(theirs)
+    common = [key for key in a if key in b and b[key][1] not in ('H', 'HD')]
+    type_agreement = np.mean([a[key][1] == b[key][1] for key in common]) if common else 0.0
+    charge_rmsd = float(np.sqrt(np.mean([(a[key][0] - b[key][0]) ** 2 for key in common]))) \
+        if common else float('nan')
+    if created:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {'native_seconds': native_time,
+            'obabel_seconds': obabel_time,
+            'common_heavy_atoms': len(common),
+            'type_agreement': float(type_agreement),
+            'charge_rmsd': charge_rmsd}
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pdb_file', type=str, help='the receptor pdb file, e.g. /tmp/alphafold/Y265H/ranked_0.pdb')
+    parser.add_argument('pdbqt_file', type=str, help='the output pdbqt file, e.g. /tmp/alphafold/Y265H.pdbqt')
+    parser.add_argument('--compare_obabel', action='store_true', help='benchmark against obabel and report output differences')
+    args = parser.parse_args()
+    if args.compare_obabel:
+        print(compare_with_obabel(args.pdb_file))
+    else:
+        prepare_receptor(args.pdb_file, args.pdbqt_file)
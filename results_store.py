@@ -0,0 +1,161 @@
+import itertools
+import re
+import sqlite3
+import time
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dockings (
+    receptor TEXT NOT NULL,
+    ligand TEXT NOT NULL,
+    best_affinity REAL,
+    num_modes INTEGER NOT NULL,
+    out_file TEXT,
+    log_file TEXT,
+    ingested_at REAL NOT NULL,
+    fingerprint TEXT,
+    PRIMARY KEY (receptor, ligand)
+);
+CREATE TABLE IF NOT EXISTS poses (
+    receptor TEXT NOT NULL,
+    ligand TEXT NOT NULL,
+    mode INTEGER NOT NULL,
+    affinity REAL NOT NULL,
+    rmsd_lb REAL NOT NULL,
+    rmsd_ub REAL NOT NULL,
+    PRIMARY KEY (receptor, ligand, mode)
+);
+CREATE INDEX IF NOT EXISTS dockings_receptor_affinity ON dockings (receptor, best_affinity);
+CREATE INDEX IF NOT EXISTS dockings_ligand ON dockings (ligand);
+CREATE INDEX IF NOT EXISTS dockings_affinity ON dockings (best_affinity);
+"""
+
+# "   1         -7.2      0.000      0.000" rows of the vina result table.
+_MODE_LINE = re.compile(r'^\s*(\d+)\s+(-?\d+\.?\d*)\s+(\d+\.?\d*)\s+(\d+\.?\d*)\s*$')
+
+
+def parse_vina_log(log_file):
+    """
+    解析vina的打分值文件
+    :param log_file: autodock_vina_run()输出的txt文件
+    :return: [(mode, affinity, rmsd_lb, rmsd_ub), ...]，按mode排序
+    """
+    modes = []
+    in_table = False
+    with open(log_file, 'r') as f:
+        for line in f:
+            if line.startswith('-----+'):
+                in_table = True
+                continue
+            if not in_table:
+                continue
+            match = _MODE_LINE.match(line)
+            if match is None:
+                break
+            modes.append((int(match.group(1)), float(match.group(2)),
+                          float(match.group(3)), float(match.group(4))))
+    return modes
+
+
+def open_store(db_file):
+    """
+    打开(或新建)对接结果库
+    使用WAL模式，筛选进行中写入结果的同时可以查询
+    :param db_file: sqlite文件路径
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(db_file, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(_SCHEMA)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(dockings)')]
+    if 'fingerprint' not in columns:
+        # Stores created before resumable screens.
+        conn.execute('ALTER TABLE dockings ADD COLUMN fingerprint TEXT')
+    return conn
+
+
+def ingest(conn, receptor, ligand, log_file, out_file=None, modes=None, fingerprint=None):
+    """
+    把一次对接的结果写入结果库，同一对receptor/ligand重复写入时覆盖
+    :param modes: 已解析的结果，为None时解析log_file
+    :param fingerprint: 受体、对接盒子和vina参数的哈希，用于中断后继续筛选时判断结果是否仍然有效
+    :return: 最优结合能，log中没有结果时为None
+    """
+    if modes is None:
+        modes = parse_vina_log(log_file)
+    best = min((m[1] for m in modes), default=None)
+    with conn:
+        conn.execute('DELETE FROM poses WHERE receptor = ? AND ligand = ?', (receptor, ligand))
+        conn.executemany(
+            'INSERT INTO poses (receptor, ligand, mode, affinity, rmsd_lb, rmsd_ub) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [(receptor, ligand) + tuple(mode) for mode in modes])
+        conn.execute(
+            'INSERT OR REPLACE INTO dockings '
+            '(receptor, ligand, best_affinity, num_modes, out_file, log_file, ingested_at, fingerprint) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (receptor, ligand, best, len(modes), out_file, log_file, time.time(), fingerprint))
+    return best
+
+
+def completed_ligands(conn, receptor, fingerprint):
+    """
+    用相同fingerprint对接过的化合物
+    :return: {ligand: (out_file, log_file)}
+    """
+    return {ligand: (out_file, log_file) for ligand, out_file, log_file in conn.execute(
+        'SELECT ligand, out_file, log_file FROM dockings WHERE receptor = ? AND fingerprint = ?',
+        (receptor, fingerprint))}
+
+
+def ranked_ligands(conn, receptor, fingerprint=None):
+    """
+    按结合能从低到高逐行读取某个受体的化合物，不一次读入内存
+    :param fingerprint: 只包含用这个fingerprint对接的结果，为None时包含全部
+    :return: 生成 (ligand, best_affinity, out_file)
+    """
+    query = ('SELECT ligand, best_affinity, out_file FROM dockings '
+             'WHERE receptor = ? AND best_affinity IS NOT NULL')
+    args = (receptor,)
+    if fingerprint is not None:
+        query += ' AND fingerprint = ?'
+        args += (fingerprint,)
+    yield from conn.execute(query + ' ORDER BY best_affinity', args)
+
+
+def top_ligands(conn, receptor, k=1000, fingerprint=None):
+    """
+    某个受体结合能最低的k个化合物
+    :param fingerprint: 只包含用这个fingerprint对接的结果，为None时包含全部
+    :return: [(ligand, best_affinity, out_file), ...]
+    """
+    return list(itertools.islice(ranked_ligands(conn, receptor, fingerprint), k))
+
+
+def ligand_results(conn, ligand):
+    """
+    一个化合物在所有受体上的结果
+    :return: [(receptor, best_affinity, out_file), ...]
+    """
+    return conn.execute(
+        'SELECT receptor, best_affinity, out_file FROM dockings '
+        'WHERE ligand = ? ORDER BY best_affinity', (ligand,)).fetchall()
+
+
+def poses(conn, receptor, ligand):
+    """:return: [(mode, affinity, rmsd_lb, rmsd_ub), ...]"""
+    return conn.execute(
+        'SELECT mode, affinity, rmsd_lb, rmsd_ub FROM poses '
+        'WHERE receptor = ? AND ligand = ? ORDER BY mode', (receptor, ligand)).fetchall()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_file', type=str, help='the results database, e.g. /tmp/alphafold/results.sqlite')
+    parser.add_argument('receptor', type=str, help='the receptor name, e.g. Y265H')
+    parser.add_argument('--top', type=int, default=1000, help='number of ligands to list')
+    args = parser.parse_args()
+    for ligand, affinity, out_file in top_ligands(open_store(args.db_file), args.receptor, args.top):
+        print(f'{ligand}\t{affinity:.1f}\t{out_file}')
@@ -0,0 +1,220 @@
+import hashlib
+import html
+import json
+import os
+import time
+
+from absl import logging
+
+import results_store
+
+
+DEFAULT_PAGE_SIZE = 500
+_STATE_FILE = 'report.json'
+_PAGE_NAME = 'page-{:05d}.html'
+
+# Sorts the rows of one page by the clicked column, pages themselves are ordered by affinity.
+_SORT_SCRIPT = """<script>
+function sortTable(column, numeric) {
+  var body = document.getElementById('results').tBodies[0];
+  var rows = Array.prototype.slice.call(body.rows);
+  var ascending = body.getAttribute('data-column') != column || body.getAttribute('data-order') != 'asc';
+  rows.sort(function (a, b) {
+    var x = a.cells[column].getAttribute('data-value'), y = b.cells[column].getAttribute('data-value');
+    var d = numeric ? parseFloat(x) - parseFloat(y) : x.localeCompare(y);
+    return ascending ? d : -d;
+  });
+  rows.forEach(function (row) { body.appendChild(row); });
+  body.setAttribute('data-column', column);
+  body.setAttribute('data-order', ascending ? 'asc' : 'desc');
+}
+</script>"""
+
+_STYLE = """<style>
+body { font-family: sans-serif; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #ccc; padding: 2px 8px; text-align: left; }
+th { cursor: pointer; background: #eee; }
+</style>"""
+
+
+def _link(path, report_dir, text, archive_key=None):
+    if archive_key is not None:
+        # The file was packed and deleted after ingest, there is nothing on disk to link to.
+        return f'<span title="{html.escape(archive_key)}">packed</span>'
+    if not path:
+        return ''
+    return f'<a href="{html.escape(os.path.relpath(path, report_dir))}">{text}</a>'
+
+
+def _navigation(page, has_next):
+    # The total page count is left out so that new results do not touch every page.
+    links = ['<a href="index.html">summary</a>']
+    if page > 1:
+        links.append(f'<a href="{_PAGE_NAME.format(page - 1)}">previous</a>')
+    links.append(f'page {page}')
+    if has_next:
+        links.append(f'<a href="{_PAGE_NAME.format(page + 1)}">next</a>')
+    return '<p>' + ' | '.join(links) + '</p>'
+
+
+def _write_atomic(path, text):
+    # Readers refreshing the report while a screen is running never see half a page.
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(text)
+    os.replace(tmp_file, path)
+
+
+def _render_page(receptor, rows, first_rank, page, has_next, report_dir, archive_dir=None):
+    lines = [
+        '<!DOCTYPE html>',
+        '<html lang="en">',
+        f'<head><meta charset="UTF-8"><title>{html.escape(receptor)} page {page}</title>{_STYLE}</head>',
+        '<body>',
+        f'<h2>{html.escape(receptor)}: ranks {first_rank}-{first_rank + len(rows) - 1}</h2>',
+        _navigation(page, has_next),
+        '<table id="results">',
+        '<thead><tr><th onclick="sortTable(0, true)">rank</th><th onclick="sortTable(1, false)">ligand</th>'
+        '<th onclick="sortTable(2, true)">best affinity (kcal/mol)</th><th onclick="sortTable(3, true)">modes</th>'
+        '<th>pose</th><th>log</th></tr></thead>',
+        '<tbody>',
+    ]
+    for rank, (ligand, affinity, num_modes, out_file, log_file) in enumerate(rows, first_rank):
+        pose_key = log_key = None
+        if archive_dir:
+            pose_key, log_key = f'{receptor}/{ligand}/pose', f'{receptor}/{ligand}/log'
+        lines.append(
+            f'<tr><td data-value="{rank}">{rank}</td>'
+            f'<td data-value="{html.escape(ligand)}">{html.escape(ligand)}</td>'
+            f'<td data-value="{affinity}">{affinity:.1f}</td>'
+            f'<td data-value="{num_modes}">{num_modes}</td>'
+            f'<td>{_link(out_file, report_dir, "pdbqt", pose_key)}</td>'
+            f'<td>{_link(log_file, report_dir, "txt", log_key)}</td></tr>')
+    lines += ['</tbody>', '</table>', _navigation(page, has_next), _SORT_SCRIPT, '</body>', '</html>', '']
+    return '\n'.join(lines)
+
+
+def _render_index(receptor, pages, total, failed, updated_at, archive_dir=None):
+    lines = [
+        '<!DOCTYPE html>',
+        '<html lang="en">',
+        f'<head><meta charset="UTF-8"><title>{html.escape(receptor)} screen</title>{_STYLE}</head>',
+        '<body>',
+        f'<h2>Virtual screen of {html.escape(receptor)}</h2>',
+        f'<p>{total} ligands docked, {failed} without a pose. '
+        f'Updated {time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(updated_at))}.</p>',
+    ]
+    if archive_dir:
+        lines.append(
+            f'<p>Poses and logs are packed in {html.escape(archive_dir)} (hover "packed" for the key). '
+            f'Read one with <code>python packed_archive.py {html.escape(archive_dir)} '
+            f'--receptor {html.escape(receptor)} --ligand LIGAND --kind pose</code> or restore all of '
+            f'them with <code>--export original</code>.</p>')
+    lines += [
+        '<table>',
+        '<thead><tr><th>page</th><th>ranks</th><th>best affinity (kcal/mol)</th></tr></thead>',
+        '<tbody>',
+    ]
+    for page, entry in enumerate(pages, 1):
+        lines.append(f'<tr><td><a href="{_PAGE_NAME.format(page)}">{page}</a></td>'
+                     f'<td>{entry["first_rank"]}-{entry["last_rank"]}</td>'
+                     f'<td>{entry["best"]:.1f} to {entry["worst"]:.1f}</td></tr>')
+    lines += ['</tbody>', '</table>', '</body>', '</html>', '']
+    return '\n'.join(lines)
+
+
+def _load_state(report_dir):
+    state_file = os.path.join(report_dir, _STATE_FILE)
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def update_report(conn, receptor, report_dir, page_size=DEFAULT_PAGE_SIZE, force=False,
+                  archive_dir=None):
+    """
+    把一个受体的筛选结果写成一份分页的html报告，代替每对受体/化合物一个html
+    f'{report_dir}/index.html' 是汇总页，各页按最优结合能排序，每页page_size个化合物
+    结果从结果库中按页流式读取，内存占用与化合物总数无关；
+    只重写内容发生变化的页，结果库自上次更新后没有新结果时直接返回，可以在筛选进行中反复调用
+    :param conn: results_store.open_store()返回的连接
+    :param receptor: 结果库中的受体名称
+    :param force: 重写所有页
+    :param archive_dir: 对接结果和打分值文件被packed_archive打包后原文件已删除，
+    这时不生成指向它们的链接，只显示打包的键，汇总页说明如何读取或导出
+    :return: 重写的页数
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    total, failed, last_ingested = conn.execute(
+        'SELECT COUNT(*), SUM(best_affinity IS NULL), MAX(ingested_at) FROM dockings WHERE receptor = ?',
+        (receptor,)).fetchone()
+    failed = failed or 0
+    state = {} if force else _load_state(report_dir)
+    same_layout = (state.get('page_size') == page_size
+                   and state.get('archive_dir') == archive_dir)
+    if same_layout and state.get('total') == total and state.get('last_ingested') == last_ingested:
+        return 0
+    old_pages = state.get('pages', []) if same_layout else []
+    docked = total - failed
+    num_pages = max(1, -(-docked // page_size))
+
+    cursor = conn.execute(
+        'SELECT ligand, best_affinity, num_modes, out_file, log_file FROM dockings '
+        'WHERE receptor = ? AND best_affinity IS NOT NULL ORDER BY best_affinity, ligand',
+        (receptor,))
+    pages = []
+    written = 0
+    while True:
+        rows = cursor.fetchmany(page_size)
+        if not rows and pages:
+            break
+        page = len(pages) + 1
+        has_next = page < num_pages
+        digest = hashlib.sha256(json.dumps([rows, has_next]).encode('utf-8')).hexdigest()
+        first_rank = (page - 1) * page_size + 1
+        pages.append({'digest': digest, 'first_rank': first_rank,
+                      'last_rank': first_rank + len(rows) - 1,
+                      'best': rows[0][1] if rows else 0.0, 'worst': rows[-1][1] if rows else 0.0})
+        page_file = os.path.join(report_dir, _PAGE_NAME.format(page))
+        if (page > len(old_pages) or old_pages[page - 1]['digest'] != digest
+                or not os.path.exists(page_file)):
+            _write_atomic(page_file, _render_page(receptor, rows, first_rank, page, has_next,
+                                                  report_dir, archive_dir))
+            written += 1
+        if not rows:
+            break
+    for page in range(len(pages) + 1, len(old_pages) + 1):
+        page_file = os.path.join(report_dir, _PAGE_NAME.format(page))
+        if os.path.exists(page_file):
+            os.remove(page_file)
+
+    updated_at = time.time()
+    _write_atomic(os.path.join(report_dir, 'index.html'),
+                  _render_index(receptor, pages, total, failed, updated_at, archive_dir))
+    _write_atomic(os.path.join(report_dir, _STATE_FILE), json.dumps({
+        'receptor': receptor, 'page_size': page_size, 'archive_dir': archive_dir, 'total': total,
+        'last_ingested': last_ingested, 'updated_at': updated_at, 'pages': pages,
+    }, indent=2))
+    logging.info('Report of %s: %d ligands on %d pages, rewrote %d', receptor, total, len(pages), written)
+    return written
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('db_file', type=str, help='the results database, e.g. /tmp/alphafold/results.sqlite')
+    parser.add_argument('receptor', type=str, help='the receptor name in the results database, e.g. Y265H')
+    parser.add_argument('report_dir', type=str, help='directory of the html report, e.g. /tmp/alphafold/report')
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='number of ligands per page')
+    parser.add_argument('--force', action='store_true', help='rewrite every page')
+    parser.add_argument('--archive_dir', type=str, default=None, help='the poses and logs were packed into this packed_archive directory')
+    parser.add_argument('--watch', type=float, default=None, help='update the report every this many seconds until interrupted')
+    args = parser.parse_args()
+    conn = results_store.open_store(args.db_file)
+    update_report(conn, args.receptor, args.report_dir, args.page_size, args.force, args.archive_dir)
+    while args.watch:
+        time.sleep(args.watch)
+        update_report(conn, args.receptor, args.report_dir, args.page_size,
+                      archive_dir=args.archive_dir)
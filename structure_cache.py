@@ -0,0 +1,172 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from absl import logging
+
+from fasta_utils import read_sequences
+
+
+# Files copied from output_dir/<name>/ into a cache entry. MSAs are copied as a
+# whole directory.
+_CACHED_PATTERNS = ['ranked_*.pdb', 'ranking_debug.json']
+_MSA_DIR = 'msas'
+_ENTRY_FILE = 'entry.json'
+DEFAULT_MAX_BYTES = 200 * 1024 ** 3
+
+
+def cache_key(fasta_path,
+              model_preset='monomer',
+              db_preset='full_dbs',
+              max_template_date='2020-05-14',
+              run_relax=True,
+              num_multimer_predictions_per_model=5):
+    """
+    以规范化后的序列和预测参数计算缓存键
+    :param fasta_path: fasta文件路径，有后缀名
+    :return: sha256 hex digest
+    """
+    payload = {
+        'sequences': read_sequences(fasta_path),
+        'model_preset': model_preset,
+        'db_preset': db_preset,
+        'max_template_date': str(max_template_date),
+        'run_relax': bool(run_relax),
+    }
+    if model_preset == 'multimer':
+        payload['num_multimer_predictions_per_model'] = \
+            num_multimer_predictions_per_model
+    data = json.dumps(payload, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+def _entry_dir(cache_dir, key):
+    return os.path.join(cache_dir, key[:2], key)
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _read_entry(entry_dir):
+    with open(os.path.join(entry_dir, _ENTRY_FILE), 'r') as f:
+        return json.load(f)
+
+
+def _write_entry(entry_dir, entry):
+    tmp_file = os.path.join(entry_dir, f'.{_ENTRY_FILE}.{uuid.uuid4().hex}')
+    with open(tmp_file, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp_file, os.path.join(entry_dir, _ENTRY_FILE))
+
+
+def lookup(cache_dir, key, target_dir):
+    """
+    缓存命中时把结构文件复制到target_dir
+    :param cache_dir: 缓存根目录
+    :param key: cache_key()的返回值
+    :param target_dir: AlphaFold的输出目录 output_dir/<name>
+    :return: 命中返回True
+    """
+    entry_dir = _entry_dir(cache_dir, key)
+    if not os.path.exists(os.path.join(entry_dir, _ENTRY_FILE)):
+        return False
+    os.makedirs(target_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(entry_dir, '*')):
+        name = os.path.basename(path)
+        if name == _ENTRY_FILE:
+            continue
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(target_dir, name),
+                            dirs_exist_ok=True)
+        else:
+            shutil.copy2(path, os.path.join(target_dir, name))
+    try:
+        entry = _read_entry(entry_dir)
+        entry['last_used'] = time.time()
+        _write_entry(entry_dir, entry)
+    except (OSError, ValueError):
+        # Entry was evicted by another process while we were copying it.
+        pass
+    logging.info('Structure cache hit %s -> %s', key, target_dir)
+    return True
+
+
+def store(cache_dir, key, source_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    把一次AlphaFold运行的结果写入缓存
+    :param cache_dir: 缓存根目录
+    :param key: cache_key()的返回值
+    :param source_dir: AlphaFold的输出目录 output_dir/<name>
+    :param max_bytes: 缓存总大小上限，超出时按最近最少使用淘汰
+    :return: 写入成功返回True
+    """
+    if not os.path.exists(os.path.join(source_dir, 'ranked_0.pdb')):
+        logging.warning('No ranked_0.pdb in %s, not caching', source_dir)
+        return False
+    entry_dir = _entry_dir(cache_dir, key)
+    if os.path.exists(entry_dir):
+        return True
+    # Build the entry next to its final location and rename it into place so
+    # readers never see a partially written entry.
+    parent = os.path.dirname(entry_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = os.path.join(parent, f'.{key}.{uuid.uuid4().hex}')
+    os.makedirs(tmp_dir)
+    for pattern in _CACHED_PATTERNS:
+        for path in glob.glob(os.path.join(source_dir, pattern)):
+            shutil.copy2(path, tmp_dir)
+    msa_dir = os.path.join(source_dir, _MSA_DIR)
+    if os.path.isdir(msa_dir):
+        shutil.copytree(msa_dir, os.path.join(tmp_dir, _MSA_DIR))
+    now = time.time()
+    _write_entry(tmp_dir, {'key': key,
+                           'size': _dir_size(tmp_dir),
+                           'created': now,
+                           'last_used': now})
+    try:
+        os.rename(tmp_dir, entry_dir)
+    except OSError:
+        # Another process stored the same key first.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    evict(cache_dir, max_bytes)
+    return True
+
+
+def entries(cache_dir):
+    """Return the entry metadata of every cached structure."""
+    result = []
+    for entry_file in glob.glob(os.path.join(cache_dir, '*', '*', _ENTRY_FILE)):
+        try:
+            entry = _read_entry(os.path.dirname(entry_file))
+        except (OSError, ValueError):
+            continue
+        entry['path'] = os.path.dirname(entry_file)
+        result.append(entry)
+    return result
+
+
+def evict(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """
+    删除最近最少使用的缓存项，直到缓存总大小不超过max_bytes
+    :return: 被删除的缓存键列表
+    """
+    all_entries = sorted(entries(cache_dir), key=lambda e: e['last_used'])
+    total = sum(e['size'] for e in all_entries)
+    removed = []
+    for entry in all_entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry['path'], ignore_errors=True)
+        total -= entry['size']
+        removed.append(entry['key'])
+        logging.info('Structure cache evicted %s', entry['key'])
+    return removed
@@ -0,0 +1,173 @@
+import asyncio
+import collections
+import os
+import signal
+import subprocess
+import threading
+import time
+
+from absl import logging
+
+import instrument
+
+
+# usage is the resource.struct_rusage of the child process, None for containers.
+StageResult = collections.namedtuple(
+    'StageResult', ['name', 'returncode', 'wall_time', 'output', 'usage'], defaults=(None,))
+
+
+class StageError(RuntimeError):
+    """Raised when a pipeline stage exits with an error or leaves no output."""
+
+    def __init__(self, result, message):
+        super().__init__(f'{result.name}: {message}')
+        self.result = result
+
+
+def check_result(result, expected_output=None):
+    if result.returncode != 0:
+        raise StageError(result, f'exited with status {result.returncode}\n'
+                                 f'{result.output}')
+    if expected_output and not os.path.exists(expected_output):
+        raise StageError(result, f'finished without writing {expected_output}\n'
+                                 f'{result.output}')
+
+
+def run_command(name, args, expected_output=None, check=True, timeout=None):
+    """
+    运行外部程序并等待其退出
+    :param name: 阶段名称，用于日志和报错
+    :param args: 命令参数列表，不经过shell
+    :param expected_output: 程序应当生成的文件，不存在时视为失败
+    :param check: 为True时退出码非0或缺少输出文件会抛出StageError
+    :param timeout: 超时秒数，超时后子进程被杀死
+    :return: StageResult
+    """
+    start = time.monotonic()
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        process.kill()
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        output = process.stdout.read()
+        process.stdout.close()
+        # wait4 instead of wait() to get the resource usage of this child alone,
+        # which stays correct while other stages run in parallel threads.
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        instrument.add_child_usage(usage)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if timed_out.is_set():
+        raise subprocess.TimeoutExpired(args, timeout, output)
+    result = StageResult(name, process.returncode, time.monotonic() - start,
+                         output.decode('utf-8', errors='replace'), usage)
+    logging.info('%s finished with status %d in %.1fs',
+                 name, result.returncode, result.wall_time)
+    if check:
+        check_result(result, expected_output)
+    return result
+
+
+async def run_command_async(name, args, expected_output=None, check=True, timeout=None):
+    """
+    run_command()的asyncio版本，一个事件循环可以同时监管大量子进程
+    协程被取消或超时时杀死子进程
+    :return: StageResult
+    """
+    start = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException as e:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        if isinstance(e, asyncio.TimeoutError):
+            raise subprocess.TimeoutExpired(args, timeout) from e
+        raise
+    result = StageResult(name, process.returncode, time.monotonic() - start,
+                         output.decode('utf-8', errors='replace'))
+    logging.info('%s finished with status %d in %.1fs',
+                 name, result.returncode, result.wall_time)
+    if check:
+        check_result(result, expected_output)
+    return result
+
+
+def _descendants(pid):
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                # The command name in parentheses may contain spaces, the ppid follows the state.
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    found = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+def kill_descendants():
+    """
+    杀死当前进程的所有子孙进程，包括进程池的工作进程以及它们启动的vina/obabel
+    :return: 被杀死的进程数
+    """
+    killed = 0
+    for pid in _descendants(os.getpid()):
+        try:
+            os.kill(pid, signal.SIGKILL)
+            killed += 1
+        except ProcessLookupError:
+            pass
+    return killed
+
+
+def wait_container(name, container, expected_output=None, check=True, on_line=None):
+    """
+    转发容器日志并等待容器退出
+    :param name: 阶段名称，用于日志和报错
+    :param container: docker容器对象，创建时不能设置remove=True
+    :param expected_output: 容器应当生成的文件，不存在时视为失败
+    :param check: 为True时退出码非0或缺少输出文件会抛出StageError
+    :param on_line: 每一行日志的回调 on_line(str)
+    :return: StageResult
+    """
+    start = time.monotonic()
+    try:
+        for line in container.logs(stream=True):
+            line = line.strip().decode('utf-8')
+            logging.info(line)
+            if on_line is not None:
+                on_line(line)
+        status = container.wait()
+    finally:
+        # force=True also stops a container that is still running after an error or interrupt.
+        try:
+            container.remove(force=True)
+        except Exception as e:
+            logging.warning('Failed to remove the %s container: %s', name, e)
+    result = StageResult(name, status.get('StatusCode', -1),
+                         time.monotonic() - start, '')
+    logging.info('%s finished with status %d in %.1fs',
+                 name, result.returncode, result.wall_time)
+    if check:
+        check_result(result, expected_output)
+    return result
@@ -11,62 +11,102 @@ from absl import logging
 import docker
 from docker import types
 
+import docking_cache
+import instrument
+import packed_archive
+import receptor_prep
+import supervise
 
 
+VINA_BINARY = '/home/xyzhang/autodock/autodock_vina_1_1_2_linux_x86/bin/vina'
+
+
+@instrument.instrumented('pdb_to_pdbqt')
 def pdb_to_pdbqt(receptor, out_dir):
     """
     将pdb文件(f'{out_dir}/{receptor}.pdb')转化为pdbqt格式并保存为f'{out_dir}/{receptor}.pdbqt'
     :param receptor: 输入的是蛋白序列文件的名称，无后缀名
     :param out_dir:输出的路径
-    :return:
+    :return: 写入pdbqt的原子数
     """
     file_name = os.path.join(out_dir, receptor)  # f'/tmp/alphafold/{receptor}/ranked_0.pdb'
-    f = open(file_name, 'r')
-    #读取每一行数据
-    lines = f.readlines()
-    new_lines = lines[:-1]
-    f_w = open(os.path.join(out_dir, f'{receptor}.pdbqt'), "w")
-    for line in new_lines:
-        f_w.write(line)
-    f.close()
-    f_w.close()
+    # 加极性氢、分配AutoDock原子类型并计算Gasteiger电荷，不需要调用外部程序
+    return receptor_prep.prepare_receptor(file_name, os.path.join(out_dir, f'{receptor}.pdbqt'))
 
+@instrument.instrumented('openbabel')
 def openbabel(ligand_file, format, out_file):
     """
     :ligand_file:为输入化合物文件名，无后缀名
     :format：为输入化合物文件格式
+    :return: supervise.StageResult
     """
     #past_file =
-    cmd = f'obabel -i {format} {ligand_file}.{format} -opdbqt -O {out_file}'
-    return os.popen(cmd, 'r')
+    cmd = ['obabel', '-i', format, f'{ligand_file}.{format}', '-opdbqt', '-O', out_file]
+    return supervise.run_command('openbabel', cmd, expected_output=out_file)
 
-def autodock_vina_run(receptor_file, ligand_file, out_file, log_file):
+def vina_command(receptor_file, ligand_file, out_file, log_file, cpu=None,
+                 config_file='/tmp/autodock_vina/config.txt', exhaustiveness=None, num_modes=None):
+    """
+    vina的命令参数，参数含义同autodock_vina_run()
+    :return: (命令参数列表, 会影响对接结果的额外参数)
+    """
+    cmd = [VINA_BINARY, '--config', config_file,
+           '--receptor', receptor_file, '--ligand', ligand_file, '--out', out_file, '--log', log_file]
+    if cpu is not None:
+        cmd += ['--cpu', str(cpu)]
+    extra_args = []
+    if exhaustiveness is not None:
+        extra_args += ['--exhaustiveness', str(exhaustiveness)]
+    if num_modes is not None:
+        extra_args += ['--num_modes', str(num_modes)]
+    return cmd + extra_args, extra_args
+
+@instrument.instrumented('vina')
+def autodock_vina_run(receptor_file, ligand_file, out_file, log_file, cpu=None,
+                      docking_cache_dir=None, config_file='/tmp/autodock_vina/config.txt',
+                      exhaustiveness=None, num_modes=None):
     """
     用于给蛋白质pdbqt格式和化合物pdbqt格式做分子对接 autodock vina
     :param receptor_file:输入的是蛋白序列文件的名称，有后缀名, 绝对路径
     :param ligand_file:输入的是化合物文件的名称，又后缀名, 绝对路径
     :param out_file:输出的对接结果文件，为pdbqt格式
     :param log_file：输出的对接结果打分值，为txt文件
-    :return:
+    :param cpu: vina使用的CPU数，为None时使用config中的设置
+    :param docking_cache_dir: 对接缓存目录，相同的受体、化合物、配置和vina版本直接返回缓存的结果
+    :param config_file: vina配置文件，可以用pocket_finder.receptor_config()生成受体专用的对接盒子
+    :param exhaustiveness: 覆盖config中的exhaustiveness，为None时使用config中的设置
+    :param num_modes: 覆盖config中的num_modes，为None时使用config中的设置
+    :return: supervise.StageResult
     """
     # log_file = '/tmp/autodock_vina/log.txt'
     # out_file = '/tmp/autodock_vina/out.pdbqt'
     # ligand_file = '/tmp/autodock_vina/1.pdbqt'
     # receptor_file = '/tmp/autodock_vina/000001.pdbqt'
-    config_file = '/tmp/autodock_vina/config.txt'
-    cmd = f'/home/xyzhang/autodock/autodock_vina_1_1_2_linux_x86/bin/vina --config {config_file}' \
-        f' --receptor {receptor_file} --ligand {ligand_file} --out {out_file} --log {log_file}'
+    cmd, extra_args = vina_command(receptor_file, ligand_file, out_file, log_file, cpu,
+                                   config_file, exhaustiveness, num_modes)
+    if docking_cache_dir:
+        key = docking_cache.docking_key(receptor_file, ligand_file, config_file, VINA_BINARY,
+                                        extra_args)
+        if docking_cache.lookup(docking_cache_dir, key, out_file, log_file):
+            return supervise.StageResult('vina', 0, 0.0, 'docking cache hit')
     # print(cmd)
-    return os.popen(cmd, 'r')
+    result = supervise.run_command('vina', cmd, expected_output=log_file)
+    if docking_cache_dir:
+        docking_cache.store(docking_cache_dir, key, out_file, log_file)
+    return result
 
 
-def openbabel_vina(receptor, ligand_file, format, out_dir, job_id=0):
+def openbabel_vina(receptor, ligand_file, format, out_dir, job_id=0, docking_cache_dir=None,
+                   archive_dir=None, cpu=None):
     """
     用于给不同格式的化合物进行格式转换
     :param receptor: 输入的是蛋白序列文件的名称，无后缀名
     :param ligand_file: 输入的是化合物文件的名称，无后缀名
     :param format：为输入化合物文件格式
     :param out_dir:输出的路径
+    :param docking_cache_dir: 对接缓存目录，为None时不使用缓存
+    :param archive_dir: 完成后把化合物、对接结果、打分值和html文件打包到这个目录，见packed_archive
+    :param cpu: vina使用的CPU数，为None时使用config中的设置
     """
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
@@ -81,10 +121,8 @@ def openbabel_vina(receptor, ligand_file, format, out_dir, job_id=0):
     autodock_vina_run(f'{receptor}.pdbqt',
                       f'{ligand_file}.pdbqt',
                       os.path.join(out_dir, f'{receptor_name}_{ligand_name}.pdbqt'),
-                      os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt'))
-    file_name = os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt')
-    while not os.path.exists(file_name):  # 判断文件是否存在
-        time.sleep(0.5)
+                      os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt'),
+                      cpu=cpu, docking_cache_dir=docking_cache_dir)
     print('vina finish!')
 
     generate_html(outdir=out_dir,
@@ -95,8 +133,18 @@ def openbabel_vina(receptor, ligand_file, format, out_dir, job_id=0):
                   autodock_vina_molecular_docking_result=f'{receptor_name}_{ligand_name}.pdbqt',
                   autodock_vina_molecular_docking_scoring_value=f'{receptor_name}_{ligand_name}.txt'
                   )
-
-
+    if archive_dir:
+        conn = packed_archive.open_archive(archive_dir)
+        packed_archive.pack(conn, archive_dir, receptor_name, ligand_name, {
+            'ligand': os.path.join(out_dir, f'{ligand_name}.pdbqt'),
+            'pose': os.path.join(out_dir, f'{receptor_name}_{ligand_name}.pdbqt'),
+            'log': os.path.join(out_dir, f'{receptor_name}_{ligand_name}.txt'),
+            'html': os.path.join(out_dir, f'{receptor_name}_{ligand_name}.html'),
+        })
+        conn.close()
+
+
+@instrument.instrumented('html')
 def generate_html(outdir,
                   html_name,
                   job_id=0,
@@ -151,6 +199,14 @@ if __name__ == '__main__':
     parser.add_argument('ligand', type=str, help='the ligand file, absolute path without file extension, e.g. /tmp/alphafold/1')
     parser.add_argument('formate', type=str, help='the format of ligand file, e.g. mol2')
     parser.add_argument('outdir', type=str, help='the dictionary of output files, e.g. /tmp/alphafold/Y265H_1')
+    parser.add_argument('--docking_cache_dir', type=str, default=None, help='directory of the docking result cache, e.g. /tmp/vina_cache')
+    parser.add_argument('--archive_dir', type=str, default=None, help='pack the ligand, pose, log and html files into shard files in this directory, e.g. /tmp/alphafold/archive')
+    parser.add_argument('--trace_file', type=str, default=None, help='append a JSON line with the wall/CPU time, memory and I/O of every stage, e.g. /tmp/alphafold/trace.jsonl')
+    parser.add_argument('--metrics_file', type=str, default=None, help='write the stage totals of trace_file in Prometheus text format, e.g. /tmp/alphafold/metrics.prom')
     args = parser.parse_args()
-    openbabel_vina(args.receptor, args.ligand, args.formate, args.outdir)
+    instrument.configure(args.trace_file)
+    openbabel_vina(args.receptor, args.ligand, args.formate, args.outdir,
+                   docking_cache_dir=args.docking_cache_dir, archive_dir=args.archive_dir)
+    if args.trace_file and args.metrics_file:
+        instrument.write_prometheus(args.trace_file, args.metrics_file)
 
@@ -0,0 +1,206 @@
+import collections
+import concurrent.futures
+import json
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+from absl import logging
+
+from vina import autodock_vina_run
+
+
+VinaPlan = collections.namedtuple('VinaPlan', ['processes', 'cpu', 'exhaustiveness', 'ligands_per_hour'])
+
+DEFAULT_PLAN_FILE = os.path.expanduser('~/.vina_plans.json')
+# Each probe process gets at least this many Monte Carlo runs, and at least one per thread
+# so that a wide --cpu option is not timed with idle threads.
+_PROBE_EXHAUSTIVENESS = 8
+
+
+def available_cores():
+    """本进程可以使用的CPU核数"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    """系统可用内存(bytes)，读取失败时使用物理内存总量"""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def config_exhaustiveness(config_file, default=8):
+    """读取vina配置文件中的exhaustiveness"""
+    with open(config_file, 'r') as f:
+        for line in f:
+            key, _, value = line.split('#', 1)[0].partition('=')
+            if key.strip() == 'exhaustiveness' and value.strip():
+                return int(value)
+    return default
+
+
+def _exhaustiveness_for(cpu, exhaustiveness):
+    # vina runs the Monte Carlo searches on its threads, round up so none idles.
+    return max(cpu, -(-exhaustiveness // cpu) * cpu)
+
+
+def _cpu_options(cores):
+    options = []
+    cpu = 1
+    while cpu <= cores:
+        options.append(cpu)
+        cpu *= 2
+    return options
+
+
+def _probe(receptor_file, ligand_file, config_file, work_dir, processes, cpu, exhaustiveness):
+    """
+    并行运行processes个vina
+    :return: (总耗时, 单个vina进程的最大RSS(bytes))，RSS取自各次运行自己的wait4结果
+    """
+    start = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(autodock_vina_run, receptor_file, ligand_file,
+                                   os.path.join(work_dir, f'probe_{cpu}_{i}.pdbqt'),
+                                   os.path.join(work_dir, f'probe_{cpu}_{i}.txt'),
+                                   cpu=cpu, config_file=config_file,
+                                   exhaustiveness=exhaustiveness)
+                   for i in range(processes)]
+        results = [future.result() for future in futures]
+    wall = time.monotonic() - start
+    # ru_maxrss is in KB on Linux.
+    rss = max((result.usage.ru_maxrss for result in results if result.usage is not None), default=0)
+    return wall, rss * 1024
+
+
+def calibrate(receptor_file, ligand_file, config_file='/tmp/autodock_vina/config.txt',
+              max_cores=None, max_memory=None, cpu_options=None, work_dir=None):
+    """
+    在本机上用一个受体和一个化合物做短时间的基准测试，选出每小时对接化合物数最多的组合
+    每个候选的--cpu值都按核数预算同时运行多个vina，测到的是实际的并发吞吐量
+    :param receptor_file: 受体pdbqt文件
+    :param ligand_file: 化合物pdbqt文件
+    :param config_file: vina配置文件，最终方案的exhaustiveness以其中的设置为准
+    :param max_cores: 可以使用的CPU核数，默认为本进程可用的核数
+    :param max_memory: 可以使用的内存(bytes)，默认为系统可用内存
+    :param cpu_options: 候选的每个vina的CPU数，默认为1, 2, 4, ... 直到max_cores
+    :param work_dir: 基准测试输出的目录，默认为临时目录，结束后删除
+    :return: VinaPlan
+    """
+    max_cores = max_cores or available_cores()
+    max_memory = max_memory or available_memory()
+    cpu_options = [cpu for cpu in (cpu_options or _cpu_options(max_cores)) if cpu <= max_cores]
+    exhaustiveness = config_exhaustiveness(config_file)
+    created = work_dir is None
+    if created:
+        work_dir = tempfile.mkdtemp(prefix='vina_calibrate_')
+    try:
+        # A single run first, for the memory footprint of one vina process.
+        _, rss = _probe(receptor_file, ligand_file, config_file, work_dir, 1, 1,
+                        _PROBE_EXHAUSTIVENESS)
+        rss = max(rss, 1)
+        memory_slots = max(1, int(max_memory // rss))
+        logging.info('vina uses up to %.0f MB, memory allows %d processes', rss / 2 ** 20, memory_slots)
+
+        best = None
+        for cpu in cpu_options:
+            processes = min(max_cores // cpu, memory_slots)
+            if processes < 1:
+                continue
+            probe_exhaustiveness = _exhaustiveness_for(cpu, _PROBE_EXHAUSTIVENESS)
+            wall, probe_rss = _probe(receptor_file, ligand_file, config_file, work_dir, processes,
+                                     cpu, probe_exhaustiveness)
+            if probe_rss > rss:
+                # More threads may need more memory, the next options are held to it.
+                rss = probe_rss
+                memory_slots = max(1, int(max_memory // rss))
+            # Ligands per hour at the configured exhaustiveness, the work scales
+            # linearly with the number of Monte Carlo runs.
+            run_exhaustiveness = _exhaustiveness_for(cpu, exhaustiveness)
+            rate = processes * 3600.0 / wall * probe_exhaustiveness / run_exhaustiveness
+            logging.info('%3d vina x %2d cpu: %.1fs, %.0f ligands/hour', processes, cpu, wall, rate)
+            if best is None or rate > best.ligands_per_hour:
+                best = VinaPlan(processes, cpu, run_exhaustiveness, rate)
+    finally:
+        if created:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    if best is None:
+        raise ValueError(f'No cpu option in {cpu_options} fits in {max_cores} cores')
+    logging.info('vina plan: %d processes x %d cpu, exhaustiveness %d, %.0f ligands/hour',
+                 best.processes, best.cpu, best.exhaustiveness, best.ligands_per_hour)
+    return best
+
+
+def _plan_key(config_file, max_cores, max_memory):
+    return f'{socket.gethostname()}:{max_cores}:{max_memory}:{config_exhaustiveness(config_file)}'
+
+
+def load_plan(config_file='/tmp/autodock_vina/config.txt', max_cores=None, max_memory=None,
+              plan_file=DEFAULT_PLAN_FILE):
+    """读取本机已经标定过的方案，没有时返回None"""
+    key = _plan_key(config_file, max_cores or available_cores(), max_memory)
+    if not os.path.exists(plan_file):
+        return None
+    with open(plan_file, 'r') as f:
+        plans = json.load(f)
+    return VinaPlan(*plans[key]) if key in plans else None
+
+
+def save_plan(plan, config_file='/tmp/autodock_vina/config.txt', max_cores=None, max_memory=None,
+              plan_file=DEFAULT_PLAN_FILE):
+    key = _plan_key(config_file, max_cores or available_cores(), max_memory)
+    plans = {}
+    if os.path.exists(plan_file):
+        with open(plan_file, 'r') as f:
+            plans = json.load(f)
+    plans[key] = list(plan)
+    tmp_file = f'{plan_file}.{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(plans, f, indent=2)
+    os.replace(tmp_file, plan_file)
+
+
+def plan(receptor_file, ligand_file, config_file='/tmp/autodock_vina/config.txt',
+         max_cores=None, max_memory=None, plan_file=DEFAULT_PLAN_FILE, recalibrate=False):
+    """
+    本机的vina并发方案，每台机器、核数/内存预算和exhaustiveness只标定一次
+    :param plan_file: 保存标定结果的json文件
+    :param recalibrate: 忽略已保存的方案重新标定
+    :return: VinaPlan
+    """
+    if not recalibrate:
+        saved = load_plan(config_file, max_cores, max_memory, plan_file)
+        if saved is not None:
+            logging.info('Using saved vina plan %s', saved)
+            return saved
+    result = calibrate(receptor_file, ligand_file, config_file, max_cores=max_cores,
+                       max_memory=max_memory)
+    save_plan(result, config_file, max_cores, max_memory, plan_file)
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('receptor', type=str, help='the receptor pdbqt file, e.g. /tmp/alphafold/Y265H.pdbqt')
+    parser.add_argument('ligand', type=str, help='the ligand pdbqt file used for the benchmark, e.g. /tmp/alphafold/1.pdbqt')
+    parser.add_argument('--config', type=str, default='/tmp/autodock_vina/config.txt', help='the vina config file')
+    parser.add_argument('--max_cores', type=int, default=None, help='number of cores vina may use, default is all available cores')
+    parser.add_argument('--max_memory_gb', type=float, default=None, help='memory vina may use in GB, default is the available memory')
+    parser.add_argument('--plan_file', type=str, default=DEFAULT_PLAN_FILE, help='the json file the calibrated plans are kept in')
+    parser.add_argument('--recalibrate', action='store_true', help='run the benchmark even if a plan was saved')
+    args = parser.parse_args()
+    max_memory = int(args.max_memory_gb * 2 ** 30) if args.max_memory_gb else None
+    print(plan(args.receptor, args.ligand, args.config, max_cores=args.max_cores,
+               max_memory=max_memory, plan_file=args.plan_file, recalibrate=args.recalibrate))
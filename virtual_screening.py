@@ -0,0 +1,419 @@
+import concurrent.futures
+import glob
+import hashlib
+import itertools
+import json
+import math
+import os
+import re
+import time
+
+from absl import logging
+
+import checkpoint
+import instrument
+import packed_archive
+import pocket_finder
+import results_store
+import screen_report
+import vina_scheduler
+from openbabel import MULTI_MOLECULE_FORMATS, bulk_openbabel, iter_records
+from supervise import StageError
+from vina import VINA_BINARY, autodock_vina_run, openbabel, pdb_to_pdbqt
+
+
+# Seconds between two updates of the html report while a screen is running.
+REPORT_INTERVAL = 60.0
+
+
+def _safe_name(name):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', name)[:64]
+
+
+def iter_ligands(ligand_path, format, ligand_dir, processes=None, skip=()):
+    """
+    遍历化合物库中的每个化合物
+    :param ligand_path: 化合物所在的文件夹，或者包含多个化合物的文件(sdf/mol2/smi)
+    :param format: 化合物文件格式
+    :param ligand_dir: 多化合物文件批量转换成pdbqt后的存放路径
+    :param processes: 批量转换的并行进程数
+    :param skip: 批量转换时跳过的化合物名称，仍然生成，但不转换，见bulk_openbabel()
+    :return: 生成 (ligand_name, 无后缀名的化合物文件路径, 文件格式)
+    """
+    if os.path.isdir(ligand_path):
+        for path in sorted(glob.glob(os.path.join(ligand_path, f'*.{format}'))):
+            yield os.path.splitext(os.path.basename(path))[0], path[:-len(format) - 1], format
+        return
+    if format not in MULTI_MOLECULE_FORMATS:
+        raise ValueError(f'Cannot split ligand library of format "{format}", '
+                         f'use a directory of single molecule files instead.')
+    # Multi-molecule libraries are converted in bulk, a chunk per obabel process.
+    for pdbqt_file in bulk_openbabel(ligand_path, format, ligand_dir, processes=processes, skip=skip):
+        ligand_file = pdbqt_file[:-len('.pdbqt')]
+        yield os.path.basename(ligand_file), ligand_file, 'pdbqt'
+
+
+def _calibration_sample(ligand_path, format, ligand_dir):
+    """
+    把化合物库的第一个化合物单独转换成pdbqt，供vina_scheduler标定，不启动批量转换
+    :return: pdbqt文件，化合物库为空时返回None
+    """
+    os.makedirs(ligand_dir, exist_ok=True)
+    if os.path.isdir(ligand_path):
+        paths = sorted(glob.glob(os.path.join(ligand_path, f'*.{format}')))
+        if not paths:
+            return None
+        if format == 'pdbqt':
+            return paths[0]
+        ligand_file = paths[0][:-len(format) - 1]
+        sample = os.path.join(ligand_dir, f'{os.path.basename(ligand_file)}.pdbqt')
+    else:
+        record = next(iter_records(ligand_path, format), None)
+        if record is None:
+            return None
+        stem = os.path.splitext(os.path.basename(ligand_path))[0]
+        ligand_file = os.path.join(ligand_dir, f'.{stem}_calibration')
+        with open(f'{ligand_file}.{format}', 'w') as f:
+            f.write(record)
+        sample = f'{ligand_file}.pdbqt'
+    openbabel(ligand_file, format, sample)
+    return sample
+
+
+def dock_ligand(receptor_file, receptor_name, ligand_name, ligand_file, format,
+                out_dir, cpu=1, docking_cache_dir=None,
+                config_file='/tmp/autodock_vina/config.txt', exhaustiveness=None,
+                num_modes=None, docking_dir='docking'):
+    """
+    在子进程中转换单个化合物并与已经准备好的受体做对接
+    :param docking_dir: 对接结果存放的子目录，相对于out_dir
+    :return: (ligand_name, 对接结果文件, 打分值文件, vina耗时秒数)，失败时返回None
+    """
+    if format == 'pdbqt':
+        ligand_pdbqt = f'{ligand_file}.pdbqt'
+    else:
+        ligand_pdbqt = os.path.join(out_dir, 'ligands', f'{ligand_name}.pdbqt')
+    out_file = os.path.join(out_dir, docking_dir, f'{receptor_name}_{ligand_name}.pdbqt')
+    log_file = os.path.join(out_dir, docking_dir, f'{receptor_name}_{ligand_name}.txt')
+    try:
+        if format != 'pdbqt':
+            openbabel(ligand_file, format, ligand_pdbqt)
+        result = autodock_vina_run(receptor_file, ligand_pdbqt, out_file, log_file, cpu=cpu,
+                                   docking_cache_dir=docking_cache_dir, config_file=config_file,
+                                   exhaustiveness=exhaustiveness, num_modes=num_modes)
+    except StageError as e:
+        # One broken molecule must not abort the whole screen.
+        logging.warning('Skipping ligand %s: %s', ligand_name, e)
+        return None
+    return ligand_name, out_file, log_file, result.wall_time
+
+
+def _prepare_receptor(receptor, out_dir, auto_box=False):
+    """受体转换成pdbqt，返回 (receptor_file, receptor_name, config_file)"""
+    os.makedirs(os.path.join(out_dir, 'ligands'), exist_ok=True)
+    pdb_to_pdbqt(receptor, out_dir)
+    receptor_file = os.path.join(out_dir, f'{receptor}.pdbqt')
+    receptor_name = _safe_name(os.path.splitext(receptor)[0].replace(os.sep, '_'))
+    config_file = '/tmp/autodock_vina/config.txt'
+    if auto_box:
+        config_file = pocket_finder.receptor_config(os.path.join(out_dir, receptor),
+                                                    os.path.join(out_dir, f'{receptor_name}_config.txt'))
+    return receptor_file, receptor_name, config_file
+
+
+def _run_fingerprint(receptor_file, config_file, exhaustiveness=None, num_modes=None):
+    """受体、对接盒子和vina参数的哈希，其中任何一个变化时之前的对接结果不能再沿用"""
+    digest = hashlib.sha256()
+    for part in (checkpoint.file_digest(receptor_file), checkpoint.file_digest(config_file),
+                 os.path.basename(VINA_BINARY), str(exhaustiveness), str(num_modes)):
+        digest.update(part.encode('utf-8') + b'\0')
+    return digest.hexdigest()
+
+
+def _resumable(conn, store_name, fingerprint, archive_dir=None):
+    """
+    结果库中用相同受体、盒子和参数已经对接过，并且打分值文件还在或已经打包的化合物
+    :return: {ligand_name: (对接结果文件, 打分值文件)}
+    """
+    completed = results_store.completed_ligands(conn, store_name, fingerprint)
+    if not archive_dir:
+        return {ligand: files for ligand, files in completed.items() if os.path.exists(files[1])}
+    archive = packed_archive.open_archive(archive_dir)
+    resumable = {ligand: files for ligand, files in completed.items() if os.path.exists(files[1])
+                 or packed_archive.contains(archive, store_name, ligand)}
+    archive.close()
+    return resumable
+
+
+def _dock_all(ligands, receptor_file, receptor_name, out_dir, conn, processes, cpu_per_vina,
+              docking_cache_dir=None, config_file='/tmp/autodock_vina/config.txt',
+              exhaustiveness=None, num_modes=None, docking_dir='docking', store_name=None,
+              resume=True, archive_dir=None, report_dir=None):
+    """
+    在进程池中对接ligands中的所有化合物，每完成一个就写入结果库
+    :param store_name: 结果库中使用的受体名称，默认为receptor_name
+    :param resume: 跳过结果库中用相同受体、盒子和参数已经对接过的化合物，用于继续被中断的筛选
+    :param archive_dir: 对接结果和打分值文件写入结果库后打包到这个目录并删除，见packed_archive
+    :param report_dir: 对接过程中定期更新 f'{report_dir}/{store_name}/index.html' 分页报告
+    :return: ([(ligand_name, 对接结果文件, 打分值文件), ...], vina总耗时秒数)，包含跳过的化合物
+    """
+    os.makedirs(os.path.join(out_dir, docking_dir), exist_ok=True)
+    store_name = store_name or receptor_name
+    fingerprint = _run_fingerprint(receptor_file, config_file, exhaustiveness, num_modes)
+    completed = _resumable(conn, store_name, fingerprint, archive_dir) if resume else {}
+    archive = packed_archive.open_archive(archive_dir) if archive_dir else None
+    results = []
+    vina_seconds = [0.0]
+    if report_dir:
+        report_dir = os.path.join(report_dir, store_name)
+    last_report = [time.monotonic()]
+
+    def collect(future):
+        result = future.result()
+        if result is not None:
+            ligand_name, out_file, log_file, seconds = result
+            results_store.ingest(conn, store_name, ligand_name, log_file, out_file,
+                                 fingerprint=fingerprint)
+            if archive is not None:
+                packed_archive.pack(archive, archive_dir, store_name, ligand_name,
+                                    {'pose': out_file, 'log': log_file})
+            results.append((ligand_name, out_file, log_file))
+            vina_seconds[0] += seconds * cpu_per_vina
+        if report_dir and time.monotonic() - last_report[0] >= REPORT_INTERVAL:
+            screen_report.update_report(conn, store_name, report_dir, archive_dir=archive_dir)
+            last_report[0] = time.monotonic()
+
+    # Keep only a bounded number of ligands in flight so that million compound
+    # libraries are streamed instead of being converted up front.
+    max_in_flight = processes * 4
+    skipped = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        in_flight = set()
+        for ligand_name, ligand_file, ligand_format in ligands:
+            done_files = completed.get(ligand_name)
+            if done_files is not None:
+                results.append((ligand_name,) + done_files)
+                skipped += 1
+                continue
+            in_flight.add(executor.submit(dock_ligand, receptor_file, receptor_name,
+                                          ligand_name, ligand_file, ligand_format,
+                                          out_dir, cpu_per_vina, docking_cache_dir,
+                                          config_file, exhaustiveness, num_modes, docking_dir))
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = concurrent.futures.wait(
+                    in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+        for future in concurrent.futures.as_completed(in_flight):
+            collect(future)
+    if archive is not None:
+        archive.close()
+    if report_dir:
+        screen_report.update_report(conn, store_name, report_dir, archive_dir=archive_dir)
+    if skipped:
+        logging.info('Resumed %s: %d ligands were already docked', store_name, skipped)
+    return results, vina_seconds[0]
+
+
+def virtual_screening(receptor, ligand_path, format, out_dir, processes=None,
+                      cpu_per_vina=1, results_db=None, docking_cache_dir=None,
+                      auto_box=False, auto_tune=False, max_cores=None, max_memory=None,
+                      resume=True, archive_dir=None, report_dir=None):
+    """
+    一个受体对多个化合物的虚拟筛选
+    受体只转换一次，化合物的格式转换和对接分发到进程池中并行执行
+    :param receptor: 受体pdb文件名，相对于out_dir，例如 Y265H/ranked_0.pdb
+    :param ligand_path: 化合物所在的文件夹，或者包含多个化合物的文件
+    :param format: 化合物文件格式
+    :param out_dir: 输出的路径
+    :param processes: 并行进程数，默认为CPU核数
+    :param cpu_per_vina: 每个vina进程使用的CPU数
+    :param results_db: 对接结果库，默认为 f'{out_dir}/results.sqlite'，每完成一个对接就写入
+    :param docking_cache_dir: 对接缓存目录，为None时不使用缓存
+    :param auto_box: 在受体上寻找口袋，生成受体专用的对接盒子代替config.txt中的盒子
+    :param auto_tune: 用本机标定的vina_scheduler方案决定并行进程数、每个vina的CPU数和exhaustiveness
+    :param max_cores: auto_tune时vina可以使用的CPU核数
+    :param max_memory: auto_tune时vina可以使用的内存(bytes)
+    :param resume: 跳过结果库中已经用相同受体、盒子和参数对接过的化合物
+    :param archive_dir: 把对接结果和打分值文件打包到这个目录，不再每个化合物留下两个小文件，
+    返回的文件路径可以用packed_archive.export()恢复
+    :param report_dir: 写出按结合能排序的分页html报告，对接过程中定期更新；
+    同时使用archive_dir时报告中不链接已打包删除的文件，只显示打包的键
+    :return: [(ligand_name, 对接结果文件, 打分值文件), ...]，不包含失败的化合物
+    """
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1) // cpu_per_vina)
+    receptor_file, receptor_name, config_file = _prepare_receptor(receptor, out_dir, auto_box)
+    conn = results_store.open_store(results_db or os.path.join(out_dir, 'results.sqlite'))
+
+    exhaustiveness = None
+    if auto_tune:
+        # Calibrate on the first ligand of the library, converted on its own: the plan decides
+        # the fingerprint, which decides what the bulk conversion below can skip.
+        sample = _calibration_sample(ligand_path, format, os.path.join(out_dir, 'ligands'))
+        if sample is not None:
+            vina_plan = vina_scheduler.plan(receptor_file, sample, config_file,
+                                            max_cores=max_cores, max_memory=max_memory)
+            processes, cpu_per_vina, exhaustiveness = vina_plan[:3]
+    skip = set()
+    if resume:
+        fingerprint = _run_fingerprint(receptor_file, config_file, exhaustiveness, None)
+        skip = set(_resumable(conn, receptor_name, fingerprint, archive_dir))
+    ligands = iter_ligands(ligand_path, format, os.path.join(out_dir, 'ligands'),
+                           processes=processes, skip=skip)
+    results, _ = _dock_all(ligands, receptor_file, receptor_name, out_dir, conn, processes,
+                           cpu_per_vina, docking_cache_dir, config_file, exhaustiveness,
+                           resume=resume, archive_dir=archive_dir, report_dir=report_dir)
+    conn.close()
+    logging.info('Docked %d ligands against %s', len(results), receptor)
+    return results
+
+
+def funnel_screening(receptor, ligand_path, format, out_dir, keep_fraction=0.05, min_keep=1,
+                     fast_exhaustiveness=1, fast_num_modes=1, final_exhaustiveness=32,
+                     final_num_modes=9, processes=None, cpu_per_vina=1, results_db=None,
+                     docking_cache_dir=None, auto_box=False, resume=True, archive_dir=None,
+                     report_dir=None):
+    """
+    两级漏斗筛选：先用低exhaustiveness、单个构象对接整个化合物库，
+    只把结合能排在前keep_fraction的化合物用高exhaustiveness重新对接
+    第一轮结果以 f'{receptor_name}@fast' 为受体名称写入结果库，重新对接的结果以receptor_name写入
+    :param keep_fraction: 进入第二轮的化合物比例
+    :param min_keep: 进入第二轮的最少化合物数
+    :param fast_exhaustiveness: 第一轮的exhaustiveness
+    :param fast_num_modes: 第一轮输出的构象数
+    :param final_exhaustiveness: 第二轮的exhaustiveness
+    :param final_num_modes: 第二轮输出的构象数
+    其余参数同virtual_screening()
+    :return: 漏斗报告，同时写入 f'{out_dir}/{receptor_name}_funnel.json'
+    """
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1) // cpu_per_vina)
+    receptor_file, receptor_name, config_file = _prepare_receptor(receptor, out_dir, auto_box)
+    conn = results_store.open_store(results_db or os.path.join(out_dir, 'results.sqlite'))
+    fast_name = f'{receptor_name}@fast'
+
+    # Remember where each ligand's pdbqt ends up so that survivors are not converted again.
+    pdbqt_files = {}
+    ligand_dir = os.path.join(out_dir, 'ligands')
+    skip = set()
+    if resume and os.path.isdir(ligand_dir):
+        # Survivors are docked again from their pdbqt, so only ligands whose converted
+        # file is still there can skip the conversion.
+        converted = {os.path.splitext(name)[0] for name in os.listdir(ligand_dir)}
+        fingerprint = _run_fingerprint(receptor_file, config_file, fast_exhaustiveness, fast_num_modes)
+        skip = converted.intersection(_resumable(conn, fast_name, fingerprint, archive_dir))
+
+    def fast_ligands():
+        for ligand_name, ligand_file, ligand_format in iter_ligands(
+                ligand_path, format, ligand_dir, processes=processes, skip=skip):
+            if ligand_format == 'pdbqt':
+                pdbqt_files[ligand_name] = ligand_file
+            else:
+                pdbqt_files[ligand_name] = os.path.join(out_dir, 'ligands', ligand_name)
+            yield ligand_name, ligand_file, ligand_format
+
+    start = time.monotonic()
+    fast_results, fast_seconds = _dock_all(
+        fast_ligands(), receptor_file, receptor_name, out_dir, conn, processes, cpu_per_vina,
+        docking_cache_dir, config_file, fast_exhaustiveness, fast_num_modes,
+        docking_dir='docking_fast', store_name=fast_name, resume=resume, archive_dir=archive_dir,
+        report_dir=report_dir)
+    fast_wall = time.monotonic() - start
+
+    keep = max(min_keep, int(math.ceil(keep_fraction * len(fast_results))))
+    # Rank only this run's library at this run's settings, the store may hold older screens
+    # of other libraries, boxes or exhaustiveness under the same name.
+    fingerprint = _run_fingerprint(receptor_file, config_file, fast_exhaustiveness, fast_num_modes)
+    docked = {ligand for ligand, _, _ in fast_results}
+    ranked = results_store.ranked_ligands(conn, fast_name, fingerprint)
+    survivors = list(itertools.islice((row for row in ranked if row[0] in docked), keep))
+    ranked.close()
+    logging.info('Funnel: %d of %d ligands pass the fast stage (best %.1f, cutoff %.1f)',
+                 len(survivors), len(fast_results),
+                 survivors[0][1] if survivors else float('nan'),
+                 survivors[-1][1] if survivors else float('nan'))
+
+    start = time.monotonic()
+    final_results, final_seconds = _dock_all(
+        ((ligand, pdbqt_files[ligand], 'pdbqt') for ligand, _, _ in survivors),
+        receptor_file, receptor_name, out_dir, conn, processes, cpu_per_vina,
+        docking_cache_dir, config_file, final_exhaustiveness, final_num_modes, resume=resume,
+        archive_dir=archive_dir, report_dir=report_dir)
+    final_wall = time.monotonic() - start
+    conn.close()
+
+    # Cost of docking the whole library at the final settings, from the measured
+    # cost per survivor.
+    full_seconds = final_seconds / max(1, len(final_results)) * len(fast_results)
+    report = {
+        'receptor': receptor_name,
+        'ligands': len(fast_results),
+        'survivors': len(final_results),
+        'keep_fraction': keep_fraction,
+        'fast': {'exhaustiveness': fast_exhaustiveness, 'num_modes': fast_num_modes,
+                 'wall_seconds': fast_wall, 'vina_cpu_seconds': fast_seconds},
+        'final': {'exhaustiveness': final_exhaustiveness, 'num_modes': final_num_modes,
+                  'wall_seconds': final_wall, 'vina_cpu_seconds': final_seconds},
+        'estimated_full_cpu_seconds': full_seconds,
+        'saved_cpu_seconds': full_seconds - fast_seconds - final_seconds,
+        'speedup': full_seconds / max(1e-9, fast_seconds + final_seconds),
+    }
+    with open(os.path.join(out_dir, f'{receptor_name}_funnel.json'), 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info('Funnel: %.0f vina cpu seconds instead of an estimated %.0f (%.1fx), saved %.0f',
+                 fast_seconds + final_seconds, full_seconds, report['speedup'],
+                 report['saved_cpu_seconds'])
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('receptor', type=str, help='the receptor pdb file relative to outdir, e.g. Y265H/ranked_0.pdb')
+    parser.add_argument('ligands', type=str, help='a directory of ligand files or a multi-molecule file, e.g. /tmp/ligands.sdf')
+    parser.add_argument('formate', type=str, help='the format of ligand files, e.g. sdf')
+    parser.add_argument('outdir', type=str, help='the dictionary of output files, e.g. /tmp/alphafold')
+    parser.add_argument('--processes', type=int, default=None, help='number of parallel docking processes, default is the number of cores')
+    parser.add_argument('--cpu_per_vina', type=int, default=1, help='the --cpu value passed to each vina process')
+    parser.add_argument('--results_db', type=str, default=None, help='the sqlite results database, default is outdir/results.sqlite')
+    parser.add_argument('--docking_cache_dir', type=str, default=None, help='directory of the docking result cache, e.g. /tmp/vina_cache')
+    parser.add_argument('--auto_tune', action='store_true', help='choose processes, cpu_per_vina and exhaustiveness from a benchmark calibrated on this host')
+    parser.add_argument('--max_cores', type=int, default=None, help='number of cores vina may use with --auto_tune')
+    parser.add_argument('--max_memory_gb', type=float, default=None, help='memory vina may use with --auto_tune, in GB')
+    parser.add_argument('--funnel', action='store_true', help='dock the library at low exhaustiveness first and re-dock only the best ligands')
+    parser.add_argument('--keep_fraction', type=float, default=0.05, help='fraction of ligands re-docked in the second funnel stage')
+    parser.add_argument('--fast_exhaustiveness', type=int, default=1, help='exhaustiveness of the first funnel stage')
+    parser.add_argument('--final_exhaustiveness', type=int, default=32, help='exhaustiveness of the second funnel stage')
+    parser.add_argument('--final_num_modes', type=int, default=9, help='number of poses of the second funnel stage')
+    parser.add_argument('--auto_box', action='store_true', help='dock into the pockets found on the receptor instead of the box in config.txt')
+    parser.add_argument('--no_resume', action='store_true', help='dock every ligand again instead of skipping the ones already in the results database')
+    parser.add_argument('--archive_dir', type=str, default=None, help='append poses and logs to a few large shard files in this directory instead of keeping two files per ligand, e.g. /tmp/alphafold/archive')
+    parser.add_argument('--report_dir', type=str, default=None, help='keep a paginated html report of the ligands sorted by affinity in this directory, e.g. /tmp/alphafold/report')
+    parser.add_argument('--trace_file', type=str, default=None, help='append a JSON line with the wall/CPU time, memory and I/O of every stage, e.g. /tmp/alphafold/trace.jsonl')
+    parser.add_argument('--metrics_file', type=str, default=None, help='write the stage totals of trace_file in Prometheus text format, e.g. /tmp/alphafold/metrics.prom')
+    args = parser.parse_args()
+    instrument.configure(args.trace_file)
+    if args.funnel:
+        funnel_screening(args.receptor, args.ligands, args.formate, args.outdir,
+                         keep_fraction=args.keep_fraction,
+                         fast_exhaustiveness=args.fast_exhaustiveness,
+                         final_exhaustiveness=args.final_exhaustiveness,
+                         final_num_modes=args.final_num_modes,
+                         processes=args.processes, cpu_per_vina=args.cpu_per_vina,
+                         results_db=args.results_db,
+                         docking_cache_dir=args.docking_cache_dir,
+                         auto_box=args.auto_box, resume=not args.no_resume,
+                         archive_dir=args.archive_dir, report_dir=args.report_dir)
+    else:
+        virtual_screening(args.receptor, args.ligands, args.formate, args.outdir,
+                          processes=args.processes, cpu_per_vina=args.cpu_per_vina,
+                          results_db=args.results_db,
+                          docking_cache_dir=args.docking_cache_dir,
+                          auto_box=args.auto_box, auto_tune=args.auto_tune,
+                          max_cores=args.max_cores,
+                          max_memory=int(args.max_memory_gb * 2 ** 30) if args.max_memory_gb else None,
+                          resume=not args.no_resume, archive_dir=args.archive_dir,
+                          report_dir=args.report_dir)
+    if args.trace_file and args.metrics_file:
+        instrument.write_prometheus(args.trace_file, args.metrics_file)